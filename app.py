@@ -1,21 +1,34 @@
 """
 Cloud Run service for processing orders from Pub/Sub.
+The Flask app is created on first access of `app` (python app.py, or a WSGI server loading app:app),
+so modules that only reuse process_order and the configuration never import Flask.
 """
 
+# First, so the startup breakdown covers every import below
+import startup
 import os
+import time
 from datetime import timedelta
-import io
 import base64
-from flask import Flask, request, jsonify
-import avro
-from avro.io import BinaryDecoder, DatumReader
+import binascii
 from datetime import datetime
-from google.cloud import pubsub_v1
-from google.pubsub_v1.types import Schema
-from google.cloud import firestore
+from avro_codec import get_codec
+from schema_registry import get_schema_cache
+from firestore_writer import get_order_writer, FIRESTORE_WRITE_TIMEOUT_SECONDS
+from metrics import (
+    REGISTRY, CONTENT_TYPE, MESSAGES, ERRORS, NACKS, REDELIVERIES,
+    SCHEMA_LOOKUP_SECONDS, DECODE_SECONDS, VALIDATE_SECONDS, PROCESS_SECONDS, FIRESTORE_WRITE_SECONDS
+)
+from structured_logging import get_logger
+from dedupe import get_dedupe_cache
+from order_validation import validate_order, OrderRejected
+from enrichment import get_enricher
+from failure_handling import get_failure_handler
+from envelope import unpack, EnvelopeError
 
+startup.mark("imports")
 
-app = Flask(__name__)
+logger = get_logger("order-service")
 
 # Project configuration
 SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "/Users/royaldsouza/Downloads/my_gcp_project.json") # for local dev
@@ -30,121 +43,307 @@ if not PROJECT_ID:
     raise EnvironmentError("PROJECT_ID environment variable must be set")
 
 def get_schema():
-    """Fetch the Avro schema from the schema registry."""
-    schema_client = pubsub_v1.SchemaServiceClient()
-    schema_path = schema_client.schema_path(PROJECT_ID, SCHEMA_NAME)
-
-    # Get the schema definition
-    schema = schema_client.get_schema(name=schema_path)
-    # Check if the schema is of type AVRO and has a definition
-    # If not, raise an error
-    if not schema:
-        raise ValueError(f"Schema {SCHEMA_NAME} not found.")
-    if schema.type_ != Schema.Type.AVRO:
-        raise ValueError(f"Schema {SCHEMA_NAME} is not of type AVRO.")
-    if not schema.definition:
-        raise ValueError(f"Schema {SCHEMA_NAME} has no definition.")
-
-    print("Schema fetched from registry")
-    return schema.definition
+    """Fetch the Avro schema from the schema registry (served from the shared schema cache)."""
+    return get_schema_cache(PROJECT_ID, SCHEMA_NAME).get_schema()
 
 def deserialize_from_avro(binary_data, schema_str):
     """Deserialize Avro binary data using the provided schema."""
     try:
-        schema = avro.schema.parse(schema_str)
-        
-        # Create a BytesIO object from the binary data
-        bytes_io = io.BytesIO(binary_data)
-        
-        # Deserialize the binary data
-        decoder = BinaryDecoder(bytes_io)
-        reader = DatumReader(schema)
-
-        order = reader.read(decoder)
-
-        bytes_io.close()
-        print(f"Deserialized Avro data")
+        # Reuse the reader compiled for this schema
+        order = get_codec(schema_str).decode(binary_data)
+        logger.debug("Deserialized Avro data", order_id=order.get('order_id'))
 
         return order
     except Exception as e:
-        print(f"Error deserializing Avro data: {e}")
+        logger.error("Error deserializing Avro data", error=str(e))
         return None
     
-def process_order(order):
-    """Process an order by adding a fulfillment status and timestamp."""
+def process_order(order, prefetched=False):
+    """Process an order by adding a fulfillment status and timestamp.
+    Batch callers set prefetched once get_enricher().prefetch has read the batch's reference data."""
     try:
         # Add fulfillment status and timestamp
         order['processing_timestamp'] = datetime.now().isoformat()
         order['status'] = "PROCESSED"
 
+        # Warehouse routing, customer tier and product categories from the cached reference data
+        warehouse_id, transit_days = get_enricher().enrich(order, prefetched)
+
         # Add fulfillment information
         order['fulfillment'] = {
             "status": "FULFILLED",
             "timestamp": datetime.now().isoformat(),
-            "estimated_delivery": (datetime.now() + timedelta(days=3)).isoformat(),
-            "warehouse_id": f"WH-{order['shipping_address']['state']}"
+            "estimated_delivery": (datetime.now() + timedelta(days=transit_days)).isoformat(),
+            "warehouse_id": warehouse_id
         }
 
-        print(f"Processed order {order['order_id']} with status {order['status']}")
+        logger.info("Processed order", order_id=order['order_id'], status=order['status'])
         
         return order
     except Exception as e:
-        print(f"Error processing order {order['order_id']}: {e}")
+        logger.error("Error processing order", order_id=order.get('order_id'), error=str(e))
         return None
     
-def save_to_firestore(processed_order):
-    """Save the processed order to Firestore."""
+def save_to_firestore(processed_orders):
+    """Save the processed orders of a push to Firestore, returning only once every write is durable; raises on failure."""
     try:
-        # Initialize Firestore client
-        firestore_client = firestore.Client()
-        
-        # Define the Firestore collection
-        doc_ref = firestore_client.collection(FIRESTORE_COLLECTION).document(processed_order['order_id'])
-        
-        # Store the processed order in Firestore
-        doc_ref.set(processed_order)
-        print(f"Processed order stored in Firestore: {processed_order['order_id']}")
+        # Queue the writes on the pooled BulkWriter together and wait for Firestore to confirm them
+        with FIRESTORE_WRITE_SECONDS.time():
+            writer = get_order_writer()
+            for future in [writer.submit(processed_order) for processed_order in processed_orders]:
+                future.result(timeout=FIRESTORE_WRITE_TIMEOUT_SECONDS)
+        logger.debug("Processed orders stored in Firestore", order_ids=[order['order_id'] for order in processed_orders])
     except Exception as e:
-        print(f"Error storing processed order in Firestore: {e}")
-        return jsonify({"error": "Failed to store processed order in Firestore"}), 500
-    
-@app.route('/', methods=['POST'])
+        logger.error("Error storing processed orders in Firestore",
+                     order_ids=[order['order_id'] for order in processed_orders], error=str(e))
+        raise
+
+def validate_push_orders(message_id, orders):
+    """Validate the orders of a push, logging each invalid one. Returns every rejection, an envelope is rejected as a whole."""
+    rejections = []
+    for order in orders:
+        order_rejections = validate_order(order)
+        if order_rejections:
+            logger.warning("Rejected invalid order", message_id=message_id, order_id=order.get('order_id'),
+                           rejections=[rejection._asdict() for rejection in order_rejections])
+            rejections.extend(order_rejections)
+    return rejections
+
+def process_orders(orders):
+    """Enrich and process the orders of a push, reading the reference data of an envelope at once.
+    Returns the processed orders, None in place of those that failed."""
+    if len(orders) == 1:
+        return [process_order(orders[0])]
+    get_enricher().prefetch(orders)
+    return [process_order(order, prefetched=True) for order in orders]
+
+def processed_response(message_id, orders, processed_orders):
+    """Body of a successful push: the processed order, or a summary for a multi-order envelope."""
+    if len(orders) == 1:
+        return processed_orders[0]
+    return {"status": "processed", "message_id": message_id, "orders": len(orders),
+            "processed": len(processed_orders), "duplicates": len(orders) - len(processed_orders)}
+
+class MalformedPush(ValueError):
+    """A push request body that is not a Pub/Sub push with base64 message data."""
+
+def parse_push(pubsub_message):
+    """Return the (message_id, data, attributes) of a push body, raising MalformedPush when it is not a valid push."""
+    message = pubsub_message.get('message') if isinstance(pubsub_message, dict) else None
+    if not isinstance(message, dict) or not isinstance(message.get('data'), str):
+        raise MalformedPush("Push body has no message data")
+    try:
+        message_data = base64.b64decode(message['data'], validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise MalformedPush(f"Message data is not valid base64: {e}") from None
+    attributes = message.get('attributes') or {}
+    if not isinstance(attributes, dict):
+        raise MalformedPush("Message attributes are not an object")
+    return message.get('messageId') or message.get('message_id'), message_data, attributes
+
+def dead_letter_push(pubsub_message, message_data, stage, error):
+    """
+    Route a failed push to the dead letters when it can never succeed or has used up its attempts.
+    Returns True when it was dead-lettered; other failures are retried by the subscription's retry policy.
+    Malformed pushes are dead-lettered with the raw request body as their data.
+    Without DEAD_LETTER_TOPIC a dead letter only reaches this instance's local spool, which Cloud Run
+    loses with the instance, so False is returned and the push is still answered with an error.
+    """
+    pubsub_message = pubsub_message if isinstance(pubsub_message, dict) else {}
+    envelope = pubsub_message.get('message') if isinstance(pubsub_message.get('message'), dict) else {}
+    attributes = envelope.get('attributes') if isinstance(envelope.get('attributes'), dict) else None
+    handler = get_failure_handler("push", PROJECT_ID)
+    dead_lettered, _ = handler.handle_failure(
+        envelope.get('messageId') or envelope.get('message_id'), message_data, attributes,
+        pubsub_message.get('deliveryAttempt'), error, stage)
+    return dead_lettered and bool(handler.router.topic)
+
+def warn_without_dead_letter_topic():
+    """Log at startup when push dead letters would only be spooled locally."""
+    if not get_failure_handler("push", PROJECT_ID).router.topic:
+        logger.warning("DEAD_LETTER_TOPIC is not set: failed pushes are spooled on this instance only and answered "
+                       "with an error, set a dead-letter policy on the push subscription to keep them")
+
+class PushResponse(Exception):
+    """Ends a push early with the JSON body and status code it is answered with."""
+
+    def __init__(self, body, status_code):
+        super().__init__(body.get('error') or body.get('status'))
+        self.body = body
+        self.status_code = status_code
+
+class Push:
+    """
+    One Pub/Sub push going through the pipeline stages below, shared by app.py and asgi_app.py.
+    A stage that ends the push early raises a PushResponse; the handlers only turn it into their framework's response.
+    """
+
+    def __init__(self, pubsub_message=None):
+        self.pubsub_message = pubsub_message
+        self.message_id = self.message_data = self.attributes = None
+        self.schema_str = None
+        self.records = self.orders = self.pending = self.processed_orders = None
+
+    def fail(self, stage, message, status_code, error, rejections=None, data=None):
+        """Count a failed push for the given stage and return its PushResponse, dead-lettering it when it is final.
+        Dead-lettered messages are answered with a 200 so Pub/Sub stops redelivering them."""
+        data = self.message_data if data is None else data
+        dead_lettered = data is not None and dead_letter_push(self.pubsub_message, data, stage, error)
+        ERRORS.inc(path="push", stage=stage)
+        body = {"error": message}
+        if rejections:
+            body["rejections"] = [rejection._asdict() for rejection in rejections]
+        if dead_lettered:
+            return PushResponse({"status": "dead_lettered", **body}, 200)
+        NACKS.inc(path="push")
+        return PushResponse(body, status_code)
+
+def receive_push(push, raw_body):
+    """Parse the push, skip redeliveries of processed messages, resolve its schema and unpack its encoded orders."""
+    try:
+        push.message_id, push.message_data, push.attributes = parse_push(push.pubsub_message)
+    except MalformedPush as e:
+        # A body that is not a push can never succeed, it is dead-lettered as received
+        raise push.fail("parse", str(e), 400, e, data=raw_body)
+    # deliveryAttempt is only set on subscriptions with a dead-letter policy
+    if (push.pubsub_message.get('deliveryAttempt') or 1) > 1:
+        REDELIVERIES.inc(path="push")
+
+    # Skip redeliveries of messages that were already processed, before any decode or write
+    if get_dedupe_cache().seen_message(push.message_id):
+        logger.info("Skipping already processed message", message_id=push.message_id)
+        raise PushResponse({"status": "duplicate", "message_id": push.message_id}, 200)
+
+    # Resolve the Avro schema from the cache, messages naming a known revision never hit the registry
+    with SCHEMA_LOOKUP_SECONDS.time():
+        push.schema_str = get_schema_cache(PROJECT_ID, SCHEMA_NAME).entry_for_attributes(push.attributes).definition
+
+    # Multi-order envelopes are unpacked into their encoded orders, a plain message holds one
+    try:
+        push.records = unpack(push.message_data, push.attributes, "avro")
+    except EnvelopeError as e:
+        raise push.fail("unpack", str(e), 400, e)
+
+def decode_push(push):
+    """Deserialize the Avro orders of a push, None in place of those that fail."""
+    with DECODE_SECONDS.time():
+        return [deserialize_from_avro(record, push.schema_str) for record in push.records]
+
+def accept_orders(push, orders):
+    """Check the decoded orders of a push against the business rules and skip the orders already processed.
+    orders is None, or holds a None, when decoding failed."""
+    if orders is None or any(order is None for order in orders):
+        raise push.fail("decode", "Failed to deserialize message", 400, "Failed to deserialize message")
+    push.orders = orders
+
+    # Reject orders that break the business rules before order dedupe, processing or Firestore work
+    with VALIDATE_SECONDS.time():
+        rejections = validate_push_orders(push.message_id, orders)
+    if rejections:
+        raise push.fail("validate", "Order failed validation", 400, OrderRejected(rejections), rejections)
+
+    # The same order republished under a new message ID is skipped before processing and writing
+    dedupe = get_dedupe_cache()
+    push.pending = []
+    for order in orders:
+        order_key = dedupe.order_key(order)
+        if dedupe.seen_order(order_key):
+            logger.info("Skipping already processed order", message_id=push.message_id, order_id=order['order_id'])
+        else:
+            push.pending.append((order_key, order))
+    if not push.pending:
+        raise PushResponse({"status": "duplicate", "order_id": orders[0]['order_id']} if len(orders) == 1 else
+                           {"status": "duplicate", "message_id": push.message_id, "orders": len(orders)}, 200)
+
+def process_push(push):
+    """Process the pending orders of a push."""
+    with PROCESS_SECONDS.time():
+        push.processed_orders = process_orders([order for _, order in push.pending])
+    if any(processed_order is None for processed_order in push.processed_orders):
+        raise push.fail("process", "Failed to process order", 500, "Failed to process order")
+
+def persist_failed(push, error):
+    """PushResponse of a push whose orders could not be stored.
+    Write failures are transient, retried until FAILURE_MAX_ATTEMPTS and then dead-lettered."""
+    return push.fail("persist", "Failed to store processed order in Firestore", 500, error)
+
+def complete_push(push):
+    """Record a push whose orders are durable as processed and return the body to answer it with."""
+    dedupe = get_dedupe_cache()
+    for order_key, _ in push.pending:
+        dedupe.mark_processed(push.message_id, order_key)
+    return processed_response(push.message_id, push.orders, push.processed_orders)
+
 def process_pubsub_message():
     """Process incoming Pub/Sub messages."""
+    from flask import request, jsonify
+    started = time.perf_counter()
+    push = Push()
     try:
         # Get the Pub/Sub message from the request
-        pubsub_message = request.get_json()
-        
-        # Decode the message data
-        message_data = base64.b64decode(pubsub_message['message']['data'])
-        
-        # Fetch the Avro schema
-        schema_str = get_schema()
-        
-        # Deserialize the Avro message
-        order = deserialize_from_avro(message_data, schema_str)
-        
-        if order is None:
-            return jsonify({"error": "Failed to deserialize message"}), 400
-        
-        # Process the order
-        processed_order = process_order(order)
+        push.pubsub_message = request.get_json(silent=True)
+        MESSAGES.inc(path="push")
+        receive_push(push, request.get_data())
+        accept_orders(push, decode_push(push))
+        process_push(push)
 
-        if processed_order is None:
-            return jsonify({"error": "Failed to process order"}), 500
+        # Only acknowledge once the processed orders are durable in Firestore
+        try:
+            save_to_firestore(push.processed_orders)
+        except Exception as e:
+            raise persist_failed(push, e)
+        return jsonify(complete_push(push)), 200
 
-        # Save the processed order to Firestore
-        save_to_firestore(processed_order)
-        
-        return jsonify(processed_order), 200
-    
+    except PushResponse as response:
+        return jsonify(response.body), response.status_code
     except Exception as e:
-        print(f"Error processing Pub/Sub message: {e}")
-        return jsonify({"error": str(e)}), 500
-    
-    except ValueError as ve:
-        print(f"ValueError: {ve}")
-        return jsonify({"error": str(ve)}), 400
+        logger.error("Error processing Pub/Sub message", error=str(e))
+        # Counted towards the message's attempts like any other transient failure
+        response = push.fail("handler", str(e), 500, e)
+        return jsonify(response.body), response.status_code
+    finally:
+        # Logged once, for the cold-start latency breakdown
+        startup.record_request(time.perf_counter() - started, WARMUP)
+
+def metrics():
+    """Expose pipeline metrics in the Prometheus text format."""
+    return REGISTRY.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+def ready():
+    """Readiness for Cloud Run startup probes: 503 until the clients and schema are warm."""
+    return WARMUP.status(), 200 if WARMUP.ready() else 503
+
+# Clients, schema and reference data warmed in the background once the service starts
+WARMUP = (
+    startup.Warmup("order-service")
+    .add("schema", lambda: startup.warm_schema(PROJECT_ID, SCHEMA_NAME))
+    .add("firestore", lambda: startup.warm_firestore(FIRESTORE_COLLECTION))
+    .add("enrichment", startup.warm_enrichment, required=False)
+    .add("dedupe", startup.warm_dedupe, required=False)
+)
+
+def create_app():
+    """Create the Flask app and start warming up the service in the background."""
+    flask = startup.import_module("flask")
+    flask_app = flask.Flask(__name__)
+    flask_app.add_url_rule('/', view_func=process_pubsub_message, methods=['POST'])
+    flask_app.add_url_rule('/metrics', view_func=metrics, methods=['GET'])
+    flask_app.add_url_rule('/ready', view_func=ready, methods=['GET'])
+    warn_without_dead_letter_topic()
+    startup.mark("app")
+    WARMUP.start()
+    return flask_app
+
+_app = None
+
+def __getattr__(name):
+    # `app` is built on first access, so importing this module for process_order does not import Flask
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=8080)
\ No newline at end of file
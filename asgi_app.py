@@ -0,0 +1,198 @@
+"""
+Asyncio-native Cloud Run service for processing orders from Pub/Sub.
+Same Pub/Sub push envelope and responses as app.py, but served by an ASGI server (uvicorn)
+so one instance keeps many pushes in flight: Firestore writes use the async client,
+in-flight requests are capped per instance and CPU-bound Avro decoding runs in a worker pool.
+
+Run locally with:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 8080
+"""
+
+# First, so the startup breakdown covers every import below
+import startup
+import os
+import json
+import time
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from app import (
+    PROJECT_ID, SCHEMA_NAME, FIRESTORE_COLLECTION, Push, PushResponse, MalformedPush, receive_push, accept_orders,
+    process_push, persist_failed, complete_push, warn_without_dead_letter_topic
+)
+from avro_codec import get_codec
+from schema_registry import get_schema_cache
+from metrics import REGISTRY, CONTENT_TYPE, MESSAGES, DECODE_SECONDS, FIRESTORE_WRITE_SECONDS
+from structured_logging import get_logger
+
+startup.mark("imports")
+
+# Maximum number of pushes processed at once by this instance
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "80"))
+# Avro decode worker processes, 0 decodes inline on the event loop
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", str(os.cpu_count() or 1)))
+
+_state = {}
+logger = get_logger("order-service-asgi")
+
+
+def decode_orders(records, schema_str):
+    """Decode the Avro orders of a message; runs in the decode pool, where each worker caches its own codec."""
+    codec = get_codec(schema_str)
+    return [codec.decode(record) for record in records]
+
+
+async def deserialize_from_avro(records, schema_str):
+    """Deserialize the Avro records of a message without blocking the event loop, None if any fails."""
+    try:
+        pool = _state.get("decode_pool")
+        if pool is None:
+            return decode_orders(records, schema_str)
+        # An envelope's orders are decoded in one task, so they cost one round trip to the pool
+        return await asyncio.get_running_loop().run_in_executor(pool, decode_orders, records, schema_str)
+    except Exception as e:
+        logger.error("Error deserializing Avro data", error=str(e))
+        return None
+
+
+async def save_to_firestore(processed_orders):
+    """Save the processed orders of a push to Firestore with the pooled async client, concurrently."""
+    collection = _state["firestore"].collection(FIRESTORE_COLLECTION)
+    with FIRESTORE_WRITE_SECONDS.time():
+        await asyncio.gather(*(
+            collection.document(processed_order['order_id']).set(processed_order) for processed_order in processed_orders
+        ))
+    logger.debug("Processed orders stored in Firestore", order_ids=[order['order_id'] for order in processed_orders])
+
+
+def json_response(response):
+    """Starlette response of a PushResponse."""
+    return JSONResponse(response.body, status_code=response.status_code)
+
+
+async def process_pubsub_message(request):
+    """Process incoming Pub/Sub messages."""
+    started = time.perf_counter()
+    try:
+        return await handle_pubsub_message(request)
+    finally:
+        # Logged once, for the cold-start latency breakdown
+        startup.record_request(time.perf_counter() - started, _state.get("warmup"))
+
+
+async def handle_pubsub_message(request):
+    """
+    Run one Pub/Sub push through the pipeline stages of app.py.
+    The synchronous stages can call the schema registry, Firestore reference data or the dead-letter topic,
+    so they run off the event loop; only the decode pool and the Firestore writes are async.
+    """
+    async with _state["limiter"]:
+        push = Push()
+        try:
+            # Get the Pub/Sub message from the request
+            body = await request.body()
+            MESSAGES.inc(path="push")
+            try:
+                push.pubsub_message = json.loads(body)
+            except ValueError as e:
+                error = MalformedPush(f"Push body is not JSON: {e}")
+                return json_response(await asyncio.to_thread(push.fail, "parse", str(error), 400, error, data=body))
+            await asyncio.to_thread(receive_push, push, body)
+
+            # Deserialize the Avro message
+            with DECODE_SECONDS.time():
+                orders = await deserialize_from_avro(push.records, push.schema_str)
+            await asyncio.to_thread(accept_orders, push, orders)
+            await asyncio.to_thread(process_push, push)
+
+            # Only acknowledge once the processed orders are durable in Firestore
+            try:
+                await save_to_firestore(push.processed_orders)
+            except Exception as e:
+                logger.error("Error storing processed orders in Firestore",
+                             order_ids=[order['order_id'] for order in push.processed_orders], error=str(e))
+                return json_response(await asyncio.to_thread(persist_failed, push, e))
+            return JSONResponse(complete_push(push), status_code=200)
+
+        except PushResponse as response:
+            return json_response(response)
+        except Exception as e:
+            logger.error("Error processing Pub/Sub message", error=str(e))
+            # Counted towards the message's attempts like any other transient failure
+            return json_response(await asyncio.to_thread(push.fail, "handler", str(e), 500, e))
+
+
+async def metrics(request):
+    """Expose pipeline metrics in the Prometheus text format."""
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+async def ready(request):
+    """Readiness for Cloud Run startup probes: 503 until the clients, schema and decode pool are warm."""
+    warmup = _state["warmup"]
+    return JSONResponse(warmup.status(), status_code=200 if warmup.ready() else 503)
+
+
+def warm_decoder(schema_str):
+    """Compile the codec in a decode worker, so the first messages it gets are not slowed by it."""
+    get_codec(schema_str)
+
+
+def warm_decode_pool(pool):
+    """Start the decode worker processes and compile the latest schema's codec in each of them."""
+    schema_str = get_schema_cache(PROJECT_ID, SCHEMA_NAME).latest().definition
+    # One task per worker, the workers that pick up several just find the codec cached
+    for future in [pool.submit(warm_decoder, schema_str) for _ in range(DECODE_WORKERS)]:
+        future.result()
+
+
+def warm_async_firestore(loop):
+    """Open the async Firestore client's channel with one document read, on the event loop."""
+    from google.api_core.retry import AsyncRetry
+    document = _state["firestore"].collection(FIRESTORE_COLLECTION).document("_warmup")
+    timeout = startup.STARTUP_RPC_TIMEOUT_SECONDS
+    asyncio.run_coroutine_threadsafe(document.get(retry=AsyncRetry(timeout=timeout), timeout=timeout), loop).result(timeout + 1)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Create the pooled clients and worker pool once per instance, then warm them up in the background."""
+    _state["limiter"] = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    warn_without_dead_letter_topic()
+    _state["decode_pool"] = ProcessPoolExecutor(max_workers=DECODE_WORKERS) if DECODE_WORKERS > 0 else None
+    if _state["decode_pool"] is not None:
+        # With fork the first task starts every worker; fork them before the warm-up threads and gRPC channels exist
+        _state["decode_pool"].submit(os.getpid).result()
+    firestore = startup.import_module("google.cloud.firestore")
+    _state["firestore"] = firestore.AsyncClient()
+    startup.mark("lifespan")
+    loop = asyncio.get_running_loop()
+    warmup = startup.Warmup("order-service-asgi")
+    warmup.add("schema", lambda: startup.warm_schema(PROJECT_ID, SCHEMA_NAME))
+    warmup.add("firestore", lambda: warm_async_firestore(loop))
+    if _state["decode_pool"] is not None:
+        warmup.add("decode_pool", lambda: warm_decode_pool(_state["decode_pool"]))
+    warmup.add("enrichment", startup.warm_enrichment, required=False)
+    warmup.add("dedupe", startup.warm_dedupe, required=False)
+    _state["warmup"] = warmup.start()
+    print(f"ASGI order service started (max {MAX_CONCURRENT_REQUESTS} concurrent requests, {DECODE_WORKERS} decode workers)")
+    try:
+        yield
+    finally:
+        if _state["decode_pool"] is not None:
+            _state["decode_pool"].shutdown(wait=True)
+        _state["firestore"].close()
+        _state.clear()
+
+
+app = Starlette(
+    routes=[
+        Route('/', process_pubsub_message, methods=['POST']),
+        Route('/metrics', metrics, methods=['GET']),
+        Route('/ready', ready, methods=['GET']),
+    ],
+    lifespan=lifespan
+)
@@ -0,0 +1,403 @@
+"""
+Avro Object Container File archival sink for the order stream.
+Appends raw (already Avro-encoded) or decoded orders into container files written with the
+orders.avsc schema, compressing each block with the null, deflate or zstandard codec.
+Files roll by size or age and are written under a temporary name, then fsynced and atomically
+renamed on finalize. Full blocks are sealed and written by the writer's own thread, so appending
+never waits on (or fails with) a disk write. A block whose write fails is cut back off the file
+and retried on the next tick; after ARCHIVE_MAX_FLUSH_ATTEMPTS attempts it is dropped and its
+tokens are failed through on_flush. A memory-mapped reader iterates an archive block by block.
+"""
+
+import os
+import mmap
+import time
+import zlib
+import json
+import threading
+from collections import deque
+from datetime import datetime
+from avro_codec import get_codec
+
+ARCHIVE_CODEC = os.getenv("ARCHIVE_CODEC", "deflate")
+ARCHIVE_BLOCK_BYTES = int(os.getenv("ARCHIVE_BLOCK_BYTES", str(256 * 1024)))
+ARCHIVE_BLOCK_SECONDS = float(os.getenv("ARCHIVE_BLOCK_SECONDS", "5"))
+ARCHIVE_MAX_FILE_BYTES = int(os.getenv("ARCHIVE_MAX_FILE_BYTES", str(128 * 1024 * 1024)))
+ARCHIVE_MAX_FILE_SECONDS = float(os.getenv("ARCHIVE_MAX_FILE_SECONDS", "600"))
+ARCHIVE_MAX_FLUSH_ATTEMPTS = int(os.getenv("ARCHIVE_MAX_FLUSH_ATTEMPTS", "3"))
+
+MAGIC = b"Obj\x01"
+SYNC_SIZE = 16
+TMP_SUFFIX = ".tmp"
+
+# Codec names as written in the avro.codec header, "zstd" is accepted as an alias
+CODEC_ALIASES = {"zstd": "zstandard"}
+
+
+def _encode_long(value):
+    """Avro zig-zag varint encoding of a long."""
+    value = (value << 1) ^ (value >> 63)
+    out = bytearray()
+    while value & ~0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _decode_long(buffer, offset):
+    """Decode a zig-zag varint long from buffer at offset, returning (value, new_offset)."""
+    shift = 0
+    result = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return (result >> 1) ^ -(result & 1), offset
+        shift += 7
+
+
+def _encode_bytes(value):
+    return _encode_long(len(value)) + value
+
+
+def _compressor(codec):
+    """Return the block compression function for a container codec name."""
+    if codec == "null":
+        return bytes
+    if codec == "deflate":
+        # Avro deflate blocks are raw deflate streams without zlib headers
+        def compress(data):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            return compressor.compress(data) + compressor.flush()
+        return compress
+    if codec == "zstandard":
+        import zstandard
+        return zstandard.ZstdCompressor().compress
+    raise ValueError(f"Unsupported Avro container codec: {codec}")
+
+
+def _decompressor(codec):
+    """Return the block decompression function for a container codec name."""
+    if codec == "null":
+        return bytes
+    if codec == "deflate":
+        return lambda data: zlib.decompress(data, -15)
+    if codec == "zstandard":
+        import zstandard
+        # Blocks may not record their content size, so use a streaming decompressor per block
+        return lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    raise ValueError(f"Unsupported Avro container codec: {codec}")
+
+
+class SealedBlock:
+    """A block waiting to be written: its records, compressed once, and the tokens appended with them."""
+
+    def __init__(self, records, tokens):
+        self.records = records
+        self.tokens = tokens
+        self.data = None
+        self.attempts = 0
+
+
+class ArchiveWriter:
+    """Streams orders into rolling, atomically finalized Avro container files."""
+
+    def __init__(self, directory, schema_str, codec=ARCHIVE_CODEC, block_bytes=ARCHIVE_BLOCK_BYTES,
+                 block_seconds=ARCHIVE_BLOCK_SECONDS, max_file_bytes=ARCHIVE_MAX_FILE_BYTES,
+                 max_file_seconds=ARCHIVE_MAX_FILE_SECONDS, max_attempts=ARCHIVE_MAX_FLUSH_ATTEMPTS,
+                 prefix="orders", on_flush=None):
+        self.directory = directory
+        self.schema_str = schema_str
+        self.codec = CODEC_ALIASES.get(codec, codec)
+        self.block_bytes = block_bytes
+        self.block_seconds = block_seconds
+        self.max_file_bytes = max_file_bytes
+        self.max_file_seconds = max_file_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.prefix = prefix
+        # Optional callback(tokens, error=None) invoked once the records appended with those tokens are on
+        # disk, or with the error once their block is given up on
+        self.on_flush = on_flush
+
+        self._compress = _compressor(self.codec)
+        self._encode = get_codec(schema_str).encode
+        # _lock guards the pending block and the sealed queue, _write_lock the file and the writing of sealed blocks
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._sync = None
+        self._file_bytes = 0
+        self._file_opened_at = 0.0
+        self._sequence = 0
+        self._block = []
+        self._block_size = 0
+        self._block_tokens = []
+        self._block_started_at = 0.0
+        self._sealed = deque()
+        self._closed = False
+        self._wake = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+        self._ticker = threading.Thread(target=self._tick_loop, name="archive-ticker", daemon=True)
+        self._ticker.start()
+
+    def _open_file(self):
+        self._sequence += 1
+        name = f"{self.prefix}-{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}-{self._sequence:05d}.avro"
+        path = os.path.join(self.directory, name)
+        sync = os.urandom(SYNC_SIZE)
+
+        # Header: magic, metadata map (schema and codec), sync marker
+        metadata = {"avro.schema": self.schema_str.encode("utf-8"), "avro.codec": self.codec.encode("utf-8")}
+        header = bytearray(MAGIC)
+        header += _encode_long(len(metadata))
+        for key, value in metadata.items():
+            header += _encode_bytes(key.encode("utf-8")) + _encode_bytes(value)
+        header += _encode_long(0)
+        header += sync
+        archive = open(path + TMP_SUFFIX, "wb")
+        try:
+            archive.write(header)
+        except Exception:
+            archive.close()
+            os.remove(path + TMP_SUFFIX)
+            raise
+        self._file, self._path, self._sync = archive, path, sync
+        self._file_bytes = len(header)
+        self._file_opened_at = time.monotonic()
+
+    def append_encoded(self, avro_binary, token=None):
+        """Append one record that is already Avro-encoded with this writer's schema."""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("ArchiveWriter is closed")
+            if not self._block:
+                self._block_started_at = time.monotonic()
+            self._block.append(avro_binary)
+            self._block_size += len(avro_binary)
+            if token is not None:
+                self._block_tokens.append(token)
+            if self._block_size >= self.block_bytes:
+                self._seal()
+                self._wake.set()
+
+    def append(self, order, token=None):
+        """Append one decoded order."""
+        self.append_encoded(self._encode(order), token=token)
+
+    def _seal(self):
+        """Move the pending block to the queue of blocks to write. Called with _lock held."""
+        if not self._block:
+            return
+        self._sealed.append(SealedBlock(self._block, self._block_tokens))
+        self._block = []
+        self._block_size = 0
+        self._block_tokens = []
+
+    def _write_block(self, sealed):
+        """Append one block to the current file and fsync it, cutting a partial write back off on failure."""
+        if self._file is None:
+            self._open_file()
+        if sealed.data is None:
+            data = self._compress(b"".join(sealed.records))
+            sealed.data = _encode_long(len(sealed.records)) + _encode_long(len(data)) + data
+        block = sealed.data + self._sync
+        try:
+            self._file.write(block)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except Exception:
+            # Later blocks must not follow a torn one, so the file goes back to its last complete block
+            try:
+                self._file.truncate(self._file_bytes)
+                self._file.seek(self._file_bytes)
+            except Exception as e:
+                print(f"Error truncating {self._path}{TMP_SUFFIX} to {self._file_bytes} bytes, abandoning it: {e}")
+                self._abandon_file()
+            raise
+        self._file_bytes += len(block)
+
+    def _abandon_file(self):
+        # The complete blocks stay readable up to the last good offset in the .tmp file, which is not renamed
+        try:
+            self._file.close()
+        except Exception:
+            pass
+        self._file = None
+        self._path = None
+
+    def _write_sealed(self, final=False):
+        """Write the sealed blocks in order, stopping at one that fails so it is retried on the next tick."""
+        with self._write_lock:
+            while True:
+                with self._lock:
+                    if not self._sealed:
+                        return
+                    sealed = self._sealed[0]
+                try:
+                    self._write_block(sealed)
+                except Exception as e:
+                    sealed.attempts += 1
+                    if not final and sealed.attempts < self.max_attempts:
+                        print(f"Error writing archive block (attempt {sealed.attempts}), retrying: {e}")
+                        return
+                    print(f"Giving up on an archive block of {len(sealed.records)} records after {sealed.attempts} attempts: {e}")
+                    error = e
+                else:
+                    error = None
+                with self._lock:
+                    self._sealed.popleft()
+                if sealed.tokens and self.on_flush is not None:
+                    try:
+                        self.on_flush(sealed.tokens, error)
+                    except Exception as e:
+                        print(f"Error settling archive block: {e}")
+                if self._file is not None and self._file_bytes >= self.max_file_bytes:
+                    self._finalize_file()
+
+    def _finalize_file(self):
+        """Close the current file and atomically move it to its final name. Called with _write_lock held."""
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._path + TMP_SUFFIX, self._path)
+        print(f"Archived {self._file_bytes} bytes to {self._path}")
+        self._file = None
+        self._path = None
+
+    def _tick_loop(self):
+        # Time-based flushing, so a quiet stream still gets its blocks written and files rolled
+        while not self._closed:
+            self._wake.wait(min(self.block_seconds, 1.0))
+            self._wake.clear()
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"Error flushing archive: {e}")
+
+    def tick(self):
+        """Write a block older than block_seconds and roll a file older than max_file_seconds."""
+        now = time.monotonic()
+        roll = self._file is not None and now - self._file_opened_at >= self.max_file_seconds
+        with self._lock:
+            if self._block and (roll or now - self._block_started_at >= self.block_seconds):
+                self._seal()
+        self._write_sealed()
+        if roll:
+            with self._write_lock:
+                self._finalize_file()
+
+    def flush(self):
+        """Write the pending block and any blocks waiting to be written."""
+        with self._lock:
+            self._seal()
+        self._write_sealed()
+
+    def close(self):
+        """Stop the writer thread, write what is left and finalize the current file."""
+        with self._lock:
+            self._closed = True
+            self._seal()
+        self._wake.set()
+        self._ticker.join(timeout=5)
+        self._write_sealed(final=True)
+        with self._write_lock:
+            self._finalize_file()
+
+
+class ArchiveReader:
+    """Memory-mapped reader over an Avro container file, one block at a time."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        self.metadata, self._data_start = self._read_header()
+        self.schema_str = self.metadata["avro.schema"].decode("utf-8")
+        self.codec = self.metadata.get("avro.codec", b"null").decode("utf-8")
+        self._decompress = _decompressor(self.codec)
+
+    def _read_header(self):
+        view = self._view
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{self.path} is not an Avro container file")
+        offset = len(MAGIC)
+        metadata = {}
+        while True:
+            count, offset = _decode_long(view, offset)
+            if count == 0:
+                break
+            if count < 0:
+                # Negative counts are followed by the block size in bytes
+                count = -count
+                _, offset = _decode_long(view, offset)
+            for _ in range(count):
+                key_size, offset = _decode_long(view, offset)
+                key = bytes(view[offset:offset + key_size]).decode("utf-8")
+                offset += key_size
+                value_size, offset = _decode_long(view, offset)
+                metadata[key] = bytes(view[offset:offset + value_size])
+                offset += value_size
+        self.sync = bytes(view[offset:offset + SYNC_SIZE])
+        return metadata, offset + SYNC_SIZE
+
+    def blocks(self):
+        """Yield (record_count, decompressed block bytes) for each block in the file."""
+        view = self._view
+        offset = self._data_start
+        end = len(view)
+        while offset < end:
+            count, offset = _decode_long(view, offset)
+            size, offset = _decode_long(view, offset)
+            # Decompress straight from the mapping, only the decompressed block is held in memory
+            block = self._decompress(view[offset:offset + size])
+            offset += size
+            if view[offset:offset + SYNC_SIZE] != self.sync:
+                raise ValueError(f"Corrupt block in {self.path} at offset {offset}")
+            offset += SYNC_SIZE
+            yield count, block
+
+    def __iter__(self):
+        """Yield the decoded orders, decoding one block at a time."""
+        codec = get_codec(self.schema_str)
+        for count, data in self.blocks():
+            yield from codec.decode_many(data, count)
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_archive(path):
+    """Yield the orders stored in an Avro container file without loading it into memory."""
+    with ArchiveReader(path) as reader:
+        yield from reader
+
+
+def main():
+    """Print the block layout and record count of archive files."""
+    import sys
+    for path in sys.argv[1:]:
+        with ArchiveReader(path) as reader:
+            blocks = records = 0
+            for count, _ in reader.blocks():
+                blocks += 1
+                records += count
+            print(json.dumps({"path": path, "codec": reader.codec, "blocks": blocks, "records": records}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Shared Avro codec for e-commerce orders.
+Parses each schema once and caches the compiled reader/writer keyed by schema fingerprint,
+so publishers, subscribers and the Cloud Run service never re-parse a schema per message.
+The encoding backend is pluggable: fastavro (compiled, default) or the pure-Python avro package.
+"""
+
+import os
+import io
+import json
+import hashlib
+import threading
+
+# Backend used when a caller does not ask for one explicitly
+AVRO_BACKEND = os.getenv("AVRO_BACKEND", "fastavro")
+
+
+class FastavroBackend:
+    """Codec backend built on fastavro's compiled schemaless reader/writer."""
+
+    name = "fastavro"
+
+    def __init__(self):
+        import fastavro
+        self._fastavro = fastavro
+
+    def compile(self, schema_str):
+        return self._fastavro.parse_schema(json.loads(schema_str))
+
+    def decode(self, compiled, binary_data):
+        return self._fastavro.schemaless_reader(io.BytesIO(binary_data), compiled)
+
+    def decode_stream(self, compiled, stream):
+        return self._fastavro.schemaless_reader(stream, compiled)
+
+    def encode(self, compiled, record):
+        bytes_io = io.BytesIO()
+        self._fastavro.schemaless_writer(bytes_io, compiled, record)
+        return bytes_io.getvalue()
+
+
+class AvroBackend:
+    """Codec backend built on the pure-Python avro package."""
+
+    name = "avro"
+
+    def __init__(self):
+        import avro.schema
+        from avro.io import BinaryDecoder, BinaryEncoder, DatumReader, DatumWriter
+        self._parse = avro.schema.parse
+        self._decoder = BinaryDecoder
+        self._encoder = BinaryEncoder
+        self._reader = DatumReader
+        self._writer = DatumWriter
+
+    def compile(self, schema_str):
+        schema = self._parse(schema_str)
+        return self._reader(schema), self._writer(schema)
+
+    def decode(self, compiled, binary_data):
+        reader, _ = compiled
+        return reader.read(self._decoder(io.BytesIO(binary_data)))
+
+    def decode_stream(self, compiled, stream):
+        reader, _ = compiled
+        return reader.read(self._decoder(stream))
+
+    def encode(self, compiled, record):
+        _, writer = compiled
+        bytes_io = io.BytesIO()
+        writer.write(record, self._encoder(bytes_io))
+        return bytes_io.getvalue()
+
+
+class CodegenBackend:
+    """Codec backend running decode/encode functions generated for each schema (see avro_codegen)."""
+
+    name = "codegen"
+
+    def __init__(self):
+        import avro_codegen
+        self._compile_schema = avro_codegen.compile_schema
+
+    def compile(self, schema_str):
+        return self._compile_schema(schema_str)
+
+    def decode(self, compiled, binary_data):
+        return compiled.decode(binary_data)
+
+    def decode_stream(self, compiled, stream):
+        # Decode in place from the stream's buffer and move the stream past the datum
+        with stream.getbuffer() as buf:
+            value, pos = compiled.decode_at(buf, stream.tell())
+        stream.seek(pos)
+        return value
+
+    def decode_record(self, compiled, binary_data):
+        return compiled.decode_record(binary_data)
+
+    def encode(self, compiled, record):
+        return compiled.encode(record)
+
+
+# Registered backend factories, looked up by name
+BACKENDS = {
+    FastavroBackend.name: FastavroBackend,
+    AvroBackend.name: AvroBackend,
+    CodegenBackend.name: CodegenBackend,
+}
+
+
+class AvroCodec:
+    """A schema compiled once for a given backend."""
+
+    def __init__(self, schema_str, backend):
+        self.schema_str = schema_str
+        self.fingerprint = schema_fingerprint(schema_str)
+        self.backend = backend
+        self._compiled = backend.compile(schema_str)
+        self._record_type = None
+
+    def decode(self, binary_data):
+        """Deserialize Avro binary data into an order dict."""
+        return self.backend.decode(self._compiled, binary_data)
+
+    def decode_record(self, binary_data):
+        """Deserialize Avro binary data into a compact slotted record (see order_records)."""
+        if hasattr(self.backend, "decode_record"):
+            # The generated decoders build the records directly
+            return self.backend.decode_record(self._compiled, binary_data)
+        if self._record_type is None:
+            # Imported here, order_records itself depends on this module
+            from order_records import record_type
+            self._record_type = record_type(self.schema_str)
+        return self._record_type.from_dict(self.decode(binary_data))
+
+    def encode(self, record):
+        """Serialize an order dict to Avro binary data."""
+        return self.backend.encode(self._compiled, record)
+
+    def decode_many(self, binary_data, count):
+        """Deserialize count records written back to back (e.g. an Avro container file block)."""
+        stream = io.BytesIO(binary_data)
+        return [self.backend.decode_stream(self._compiled, stream) for _ in range(count)]
+
+
+_lock = threading.Lock()
+_backends = {}
+_codecs_by_fingerprint = {}
+_codecs_by_schema_str = {}
+
+
+def register_backend(name, factory):
+    """Register a custom codec backend factory under the given name."""
+    with _lock:
+        BACKENDS[name] = factory
+        _backends.pop(name, None)
+
+
+def schema_fingerprint(schema_str):
+    """Return a stable fingerprint of a schema definition, independent of whitespace and key order."""
+    canonical = json.dumps(json.loads(schema_str), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_backend(name=None):
+    """Return the (shared) backend instance for the given name."""
+    name = name or AVRO_BACKEND
+    backend = _backends.get(name)
+    if backend is not None:
+        return backend
+
+    with _lock:
+        if name not in _backends:
+            if name not in BACKENDS:
+                raise ValueError(f"Unknown Avro backend: {name}")
+            try:
+                _backends[name] = BACKENDS[name]()
+            except ImportError as e:
+                if name == AvroBackend.name:
+                    raise
+                # Fall back to the pure-Python package if the compiled backend is not installed
+                print(f"Avro backend {name} unavailable ({e}), falling back to {AvroBackend.name}")
+                _backends[name] = _backends.get(AvroBackend.name) or AvroBackend()
+        return _backends[name]
+
+
+def get_codec(schema_str, backend=None):
+    """Return the compiled codec for a schema, parsing it only the first time it is seen."""
+    backend = get_backend(backend)
+    key = (backend.name, schema_str)
+
+    # Fast path: exact schema string already compiled
+    codec = _codecs_by_schema_str.get(key)
+    if codec is not None:
+        return codec
+
+    fingerprint_key = (backend.name, schema_fingerprint(schema_str))
+    with _lock:
+        codec = _codecs_by_fingerprint.get(fingerprint_key)
+        if codec is None:
+            codec = AvroCodec(schema_str, backend)
+            _codecs_by_fingerprint[fingerprint_key] = codec
+        _codecs_by_schema_str[key] = codec
+    return codec
+
+
+def deserialize(binary_data, schema_str, backend=None):
+    """Deserialize Avro binary data using the cached codec for the schema."""
+    return get_codec(schema_str, backend).decode(binary_data)
+
+
+def serialize(record, schema_str, backend=None):
+    """Serialize a record to Avro binary data using the cached codec for the schema."""
+    return get_codec(schema_str, backend).encode(record)
@@ -6,14 +6,17 @@ This script simulates one or multiple publishers sending messages concurrently.
 """
 
 import os
-import io
 import time
-import avro
-from avro.io import BinaryEncoder, DatumWriter
 import threading
-from google.cloud import pubsub_v1
-from google.pubsub_v1.types import Schema
-from mock_data_generator import generate_random_order
+from itertools import islice
+from avro_codec import get_codec
+from schema_registry import get_schema_cache, SCHEMA_REVISION_ATTRIBUTE
+from batch_publishing import (
+    create_publisher, create_batch_publisher, PublishTracker, ORDERING_KEYS, ordering_key, publish_ordered,
+    publish_envelopes
+)
+from envelope import ENVELOPE_ORDERS, ENVELOPE_TOPIC, EnvelopePacker
+from mock_data_generator import generate_random_order, read_corpus
 
 # # Project configuration
 SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "/Users/royaldsouza/Downloads/my_gcp_project.json") # for local dev
@@ -28,41 +31,21 @@ if not PROJECT_ID:
 TOPIC_NAME = "orders-topic"
 SCHEMA_NAME = "orders-schema"
 
+# "demo" publishes one message at a time, "throughput" batches without blocking on each publish
+PUBLISH_MODE = os.getenv("PUBLISH_MODE", "demo")
+THROUGHPUT_MESSAGES = int(os.getenv("THROUGHPUT_MESSAGES", "100000"))
+# Optional pre-encoded Avro corpus (mock_data_generator.py --format avro) published as-is in throughput mode
+THROUGHPUT_CORPUS = os.getenv("THROUGHPUT_CORPUS")
+
 def get_schema():
-    """Fetch the Avro schema from the schema registry."""
-    schema_client = pubsub_v1.SchemaServiceClient()
-    schema_path = schema_client.schema_path(PROJECT_ID, SCHEMA_NAME)
-
-    # Get the schema definition
-    schema = schema_client.get_schema(name=schema_path)
-    # Check if the schema is of type AVRO and has a definition
-    # If not, raise an error
-    if not schema:
-        raise ValueError(f"Schema {SCHEMA_NAME} not found.")
-    if schema.type_ != Schema.Type.AVRO:
-        raise ValueError(f"Schema {SCHEMA_NAME} is not of type AVRO.")
-    if not schema.definition:
-        raise ValueError(f"Schema {SCHEMA_NAME} has no definition.")
-
-    print("Schema fetched from registry")
-    return schema.definition
+    """Fetch the Avro schema from the schema registry (served from the shared schema cache)."""
+    return get_schema_cache(PROJECT_ID, SCHEMA_NAME).get_schema()
 
 def serialize_to_avro(order_data, schema_str):
     """Serialize the order data to Avro binary format."""
     try:
-        schema = avro.schema.parse(schema_str)
-        
-        # Create a BytesIO object to hold the binary data
-        bytes_io = io.BytesIO()
-
-        encoder = BinaryEncoder(bytes_io)
-        writer = DatumWriter(schema)
-
-        # Serialize the order data into Avro binary format using the provided schema
-        writer.write(order_data, encoder)
-        
-        avro_binary = bytes_io.getvalue()
-        bytes_io.close()
+        # Serialize the order data with the writer compiled for this schema
+        avro_binary = get_codec(schema_str).encode(order_data)
         print(f"Serialized Avro data")
         
         return avro_binary
@@ -75,20 +58,72 @@ def publish_avro_message(publisher, topic_path, order_data, schema_str):
     # Serialize the order to Avro binary format
     avro_binary = serialize_to_avro(order_data, schema_str)
     
-    # publish the message to the topic
-    future = publisher.publish(
-        topic_path, 
-        data=avro_binary
-    )
+    # publish the message to the topic, under the order's ordering key when ORDERING_KEYS is set
+    future = publish_ordered(publisher, topic_path, avro_binary, ordering_key(order_data))
     
     # Wait for the publish future to resolve
     message_id = future.result()
     
     return message_id
 
+def publish_avro_message_async(publisher, topic_path, order_data, schema_str):
+    """Publish an Avro-encoded message without waiting for it, returning the publish future."""
+    avro_binary = get_codec(schema_str).encode(order_data)
+    return publish_ordered(publisher, topic_path, avro_binary, ordering_key(order_data))
+
+def avro_envelope_packer():
+    """Envelope packer for Avro orders, tagged with the revision of the latest schema they are encoded with."""
+    # The envelope topic has no schema, so Pub/Sub does not add the revision attribute itself
+    revision_id = get_schema_cache(PROJECT_ID, SCHEMA_NAME).latest().revision_id
+    return EnvelopePacker("avro", **({SCHEMA_REVISION_ATTRIBUTE: revision_id} if revision_id else {}))
+
+def throughput_publisher_process(publisher_id, schema_str, num_messages, num_publishers=1):
+    """Publish Avro messages as fast as batching and flow control allow, then print a summary.
+    With THROUGHPUT_CORPUS, publisher N of num_publishers sends every num_publishers-th payload from the N-th on."""
+    publisher = create_batch_publisher()
+    topic_path = publisher.topic_path(PROJECT_ID, TOPIC_NAME)
+    tracker = PublishTracker()
+    # With ENVELOPE_ORDERS set, orders are packed into multi-order envelopes on the envelope topic
+    packer = avro_envelope_packer() if ENVELOPE_ORDERS else None
+    if packer is not None:
+        topic_path = publisher.topic_path(PROJECT_ID, ENVELOPE_TOPIC)
+
+    if THROUGHPUT_CORPUS:
+        # Payloads are already encoded, so the publisher spends no CPU on generating orders; with
+        # ORDERING_KEYS set each one is still decoded for its ordering key.
+        # The publishers split the corpus between them, so each payload is published once
+        codec = get_codec(schema_str)
+        for avro_binary in islice(read_corpus(THROUGHPUT_CORPUS, fmt="avro"), publisher_id - 1, None, num_publishers):
+            try:
+                key = ordering_key(codec.decode(avro_binary)) if ORDERING_KEYS else ""
+                if packer is not None:
+                    publish_envelopes(tracker, publisher, topic_path, packer.add(avro_binary, key))
+                else:
+                    tracker.track(publish_ordered, publisher, topic_path, avro_binary, key)
+            except Exception as e:
+                print(f"Avro Publisher {publisher_id} - Error publishing message: {e}")
+    else:
+        for _ in range(num_messages):
+            try:
+                if packer is not None:
+                    order = generate_random_order()
+                    publish_envelopes(tracker, publisher, topic_path,
+                                      packer.add(get_codec(schema_str).encode(order), ordering_key(order)))
+                else:
+                    tracker.track(publish_avro_message_async, publisher, topic_path, generate_random_order(), schema_str)
+            except Exception as e:
+                print(f"Avro Publisher {publisher_id} - Error publishing message: {e}")
+    if packer is not None:
+        publish_envelopes(tracker, publisher, topic_path, packer.flush())
+
+    # Wait for the outstanding batches to be sent
+    tracker.wait()
+    tracker.print_summary(f"Avro Publisher {publisher_id}")
+    return tracker.summary()
+
 def publisher_process(publisher_id, schema_str, num_messages, interval):
     """Simulate a publisher process sending Avro messages at regular intervals."""
-    publisher = pubsub_v1.PublisherClient()
+    publisher = create_publisher()
     topic_path = publisher.topic_path(PROJECT_ID, TOPIC_NAME)
     
     for i in range(num_messages):
@@ -117,10 +152,16 @@ def main():
     # Start multiple publisher threads
     threads = []
     for i in range(num_publishers):
-        publisher_thread = threading.Thread(
-            target=publisher_process,
-            args=(i+1, schema_str, messages_per_publisher, interval_seconds)
-        )
+        if PUBLISH_MODE == "throughput":
+            publisher_thread = threading.Thread(
+                target=throughput_publisher_process,
+                args=(i+1, schema_str, THROUGHPUT_MESSAGES, num_publishers)
+            )
+        else:
+            publisher_thread = threading.Thread(
+                target=publisher_process,
+                args=(i+1, schema_str, messages_per_publisher, interval_seconds)
+            )
         threads.append(publisher_thread)
         publisher_thread.start()
     
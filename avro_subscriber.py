@@ -7,14 +7,24 @@ using the Google Cloud Pub/Sub client library and the fastavro library for Avro
 """
 
 import os
-import io
-import avro
-from avro.io import BinaryDecoder, DatumReader
 import threading
 from concurrent.futures import ThreadPoolExecutor
-import avro.schema
 from google.cloud import pubsub_v1
-from google.pubsub_v1.types import Schema
+from avro_codec import get_codec
+from schema_registry import get_schema_cache, SCHEMA_REVISION_ATTRIBUTE
+from metrics import (
+    MESSAGES, ERRORS, NACKS, REDELIVERIES, SCHEMA_LOOKUP_SECONDS, DECODE_SECONDS, VALIDATE_SECONDS,
+    start_metrics_server
+)
+from structured_logging import get_logger
+from avro_archive import ArchiveWriter
+from columnar_sink import ColumnarSink
+from windowed_aggregation import WindowedAggregator
+from subscriber_pool import SUBSCRIBER_PROCESSES, run_subscriber_processes, wait_for_stop
+from flow_control import get_flow_control, get_scheduler
+from order_validation import check_order
+from failure_handling import get_failure_handler, DelayedNacker
+from envelope import unpack
 
 # Project configuration
 SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "/Users/royaldsouza/Downloads/my_gcp_project.json") # for local dev
@@ -29,125 +39,213 @@ if not PROJECT_ID:
 SUBSCRIPTION_NAME = "orders-sub-avro"
 SCHEMA_NAME = "orders-schema"
 
+# Archive mode: when set, orders are appended to Avro container files under this directory
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR")
+# Analytics mode: when set, orders are also written as partitioned Parquet files under this directory
+SINK_DIR = os.getenv("SINK_DIR")
+# Windowed revenue/order/unit aggregates by state, product and status, emitted every AGG_EMIT_SECONDS
+AGGREGATE = os.getenv("AGGREGATE", "false").lower() == "true"
+
+logger = get_logger("avro-subscriber")
+
 def get_schema():
-    """Fetch the Avro schema from the schema registry."""
-    schema_client = pubsub_v1.SchemaServiceClient()
-    schema_path = schema_client.schema_path(PROJECT_ID, SCHEMA_NAME)
-
-    # Get the schema definition
-    schema = schema_client.get_schema(name=schema_path)
-    # Check if the schema is of type AVRO and has a definition
-    # If not, raise an error
-    if not schema:
-        raise ValueError(f"Schema {SCHEMA_NAME} not found.")
-    if schema.type_ != Schema.Type.AVRO:
-        raise ValueError(f"Schema {SCHEMA_NAME} is not of type AVRO.")
-    if not schema.definition:
-        raise ValueError(f"Schema {SCHEMA_NAME} has no definition.")
-
-    print("Schema fetched from registry")
-    return schema.definition
+    """Fetch the Avro schema from the schema registry (served from the shared schema cache)."""
+    return get_schema_cache(PROJECT_ID, SCHEMA_NAME).get_schema()
 
 def deserialize_from_avro(binary_data, schema_str):
     """Deserialize Avro binary data using the provided schema."""
     try:
-        schema = avro.schema.parse(schema_str)
-        
-        # Create a BytesIO object from the binary data
-        bytes_io = io.BytesIO(binary_data)
-        
-        # Deserialize the binary data
-        decoder = BinaryDecoder(bytes_io)
-        reader = DatumReader(schema)
-
-        order = reader.read(decoder)
-        bytes_io.close()
-        print(f"Deserialized Avro data")
-        
-        return order
+        # Reuse the reader compiled for this schema
+        return get_codec(schema_str).decode(binary_data)
     except Exception as e:
-        print(f"Error deserializing Avro data: {e}")
+        logger.error("Error deserializing Avro data", error=str(e))
         raise
 
-def process_avro_message(message, schema_str):
-    """Process a received Pub/Sub message in Avro format."""
+def ack_flushed(messages, error=None):
+    """Acknowledge messages once the archive block or sink batch holding them is on disk, or fail them when it could not be written."""
+    for message in messages:
+        if error is None:
+            message.ack()
+        elif get_failure_handler("avro", PROJECT_ID).handle_message(message, error, "sink") == "retry":
+            NACKS.inc(path="avro")
+
+def process_avro_message(message, schema_str, archive=None, sink=None, aggregator=None, nacker=None):
+    """Process a received Pub/Sub message in Avro format. Returns False when the message failed."""
+    MESSAGES.inc(path="avro")
+    if (message.delivery_attempt or 1) > 1:
+        REDELIVERIES.inc(path="avro")
+    stage = "decode"
+    message_schema_str = schema_str
     try:
+        # Use the schema revision the message was published with, when it names one
+        revision_id = message.attributes.get(SCHEMA_REVISION_ATTRIBUTE) if message.attributes else None
+        if revision_id:
+            stage = "schema_lookup"
+            with SCHEMA_LOOKUP_SECONDS.time():
+                message_schema_str = get_schema_cache(PROJECT_ID, SCHEMA_NAME).get_schema(revision_id)
+            stage = "decode"
+
+        # Multi-order envelopes are unpacked into their encoded orders, a plain message holds one
+        stage = "unpack"
+        records = unpack(message.data, message.attributes, "avro")
+
         # Deserialize the Avro binary data
-        order = deserialize_from_avro(message.data, schema_str)
-
-        # Validate required keys
-        required_keys = ['order_id', 'customer_id', 'status', 'total_amount', 'items', 'shipping_address']
-        if not all(key in order for key in required_keys):
-            raise KeyError(f"Missing required keys in order: {set(required_keys) - set(order.keys())}")
-        
-        # Print message details
-        print(f"\nReceived Avro Order - ID: {order['order_id']}")
-        print(f"Customer: {order['customer_id']}")
-        print(f"Status: {order['status']}")
-        print(f"Total Amount: ${order['total_amount']}")
-        print(f"Items: {len(order['items'])}")
-        
-        # Print order items
-        for idx, item in enumerate(order['items'], start=1):
-            print(f"  Item {idx}: {item['quantity']} x {item['product_name']} @ ${item['unit_price']} each")
-        
-        # Print shipping address
-        addr = order['shipping_address']
-        print(f"Shipping to: {addr['street']}, {addr['city']}, {addr['state']} {addr['zip']}, {addr['country']}")
-        
-        # Print message attributes
-        if message.attributes:
-            print("Message attributes:")
-            for key, value in message.attributes.items():
-                print(f"  {key}: {value}")
-        
+        stage = "decode"
+        with DECODE_SECONDS.time():
+            orders = [deserialize_from_avro(record, message_schema_str) for record in records]
+
+        # Check the orders against the shared business rules, an envelope is rejected as a whole
+        stage = "validate"
+        with VALIDATE_SECONDS.time():
+            for order in orders:
+                check_order(order)
+
+        # The message is settled with its last order, the sink and archive flush orders in sequence
+        last = len(orders) - 1
+        for index, order in enumerate(orders):
+            token = message if index == last else None
+
+            # Log a sample of the received orders
+            logger.info(
+                "Received Avro order",
+                message_id=message.message_id,
+                order_id=order['order_id'],
+                customer_id=order['customer_id'],
+                status=order['status'],
+                total_amount=order['total_amount'],
+                items=len(order['items']),
+                shipping_state=order['shipping_address']['state'],
+                attributes=dict(message.attributes) if message.attributes else {}
+            )
+
+            if aggregator is not None:
+                # Counted once per delivery, so a message nacked further down may be counted again on redelivery
+                stage = "aggregate"
+                aggregator.add(order)
+
+            if sink is not None:
+                stage = "sink"
+                # The archive owns the ack when both are enabled, the columnar files can be rebuilt from it
+                sink.add(order, token=None if archive is not None else token)
+
+            if archive is not None:
+                stage = "archive"
+                # Raw bytes written with the archive's schema go in as-is, other revisions are re-encoded.
+                # The message is acked by ack_flushed once its block has been fsynced.
+                if message_schema_str == schema_str:
+                    archive.append_encoded(records[index], token=token)
+                else:
+                    archive.append(order, token=token)
+
+        if archive is not None or sink is not None:
+            # Acked by ack_flushed once the archive block or micro-batch is written
+            return True
+
         # Acknowledge the message
         message.ack()
-        print(f"Avro message acknowledged: {message.message_id}")
+        return True
     
     except Exception as e:
-        print(f"Error processing Avro message: {e}")
-        # Negative acknowledgement in case of error
-        message.nack()
+        ERRORS.inc(path="avro", stage=stage)
+        logger.error("Error processing Avro message", message_id=message.message_id, stage=stage, error=str(e))
+        # Payloads that can never succeed are dead-lettered, other failures are nacked after a backoff
+        if get_failure_handler("avro", PROJECT_ID).handle_message(message, e, stage, nacker) == "retry":
+            NACKS.inc(path="avro")
+        return False
 
-def subscriber_process(subscriber_id, schema_str):
+def subscriber_process(subscriber_id, schema_str, sink=None, aggregator=None, stop_flag=None, stats_queue=None):
     """Run a subscriber process to consume Avro messages."""
     subscriber = pubsub_v1.SubscriberClient()
     subscription_path = subscriber.subscription_path(PROJECT_ID, SUBSCRIPTION_NAME)
     
     print(f"Avro Subscriber {subscriber_id} started. Listening for messages...")
     
-    # Counter for received messages
+    # Failed messages of this subscriber wait here for their delayed retry
+    nacker = DelayedNacker(name=f"avro-sub{subscriber_id}-delayed-nacks")
+
+    # Counters for received and nacked messages
     received_messages = 0
+    failed_messages = 0
+
+    # Archive the stream to rolling Avro container files when enabled
+    archive = None
+    if ARCHIVE_DIR:
+        archive = ArchiveWriter(ARCHIVE_DIR, schema_str, prefix=f"orders-sub{subscriber_id}", on_flush=ack_flushed)
+        print(f"Avro Subscriber {subscriber_id} archiving to {ARCHIVE_DIR} ({archive.codec})")
     
     # Callback function to process incoming messages
     def callback(message):
-        nonlocal received_messages
-        print(f"\nAvro Subscriber {subscriber_id} received message:")
-        process_avro_message(message, schema_str)
+        nonlocal received_messages, failed_messages
+        if not process_avro_message(message, schema_str, archive, sink, aggregator, nacker):
+            failed_messages += 1
         received_messages += 1
     
     # Create a streaming pull subscription
     streaming_pull_future = subscriber.subscribe(
         subscription=subscription_path,
-        callback=callback
+        callback=callback,
+        # Bounded outstanding messages and a callback pool sized by latency and nack rate
+        flow_control=get_flow_control(),
+        scheduler=get_scheduler(error_count=lambda: failed_messages, name=f"avro-sub{subscriber_id}"),
+        await_callbacks_on_shutdown=True
     )
     
     # Wait for the future to complete
     try:
+        if stop_flag is not None:
+            # Process mode: report stats until the supervisor stops this worker
+            wait_for_stop(streaming_pull_future, stop_flag, stats_queue, subscriber_id)
         streaming_pull_future.result()
     except Exception as e:
         print(f"Avro Subscriber {subscriber_id} error: {e}")
     finally:
+        # Write what is buffered while the client can still send its acks
+        if archive is not None:
+            archive.close()
+        if sink is not None:
+            sink.flush()
+        # This subscriber's messages waiting for a delayed retry are nacked now, while its client can still
+        # send them; the other subscribers of the process keep theirs
+        nacker.close()
         subscriber.close()
         print(f"Avro Subscriber {subscriber_id} finished. Processed {received_messages} messages.")
 
+def subscriber_worker(subscriber_id, schema_str, stop_flag, stats_queue):
+    """Entry point of one subscriber process in process mode (SUBSCRIBER_PROCESSES > 0)."""
+    sink = ColumnarSink(SINK_DIR, on_flush=ack_flushed) if SINK_DIR else None
+    aggregator = WindowedAggregator().start() if AGGREGATE else None
+    try:
+        subscriber_process(subscriber_id, schema_str, sink, aggregator, stop_flag, stats_queue)
+    finally:
+        if sink is not None:
+            sink.close()
+        if aggregator is not None:
+            aggregator.close()
+        # Sink failures wait in the process-wide handler, closed once its only subscriber has stopped
+        get_failure_handler("avro", PROJECT_ID).close()
+
 def main():
     """Main function to demonstrate multiple Avro subscribers."""
+    if AGGREGATE and SUBSCRIBER_PROCESSES > 1:
+        # Every process would aggregate its share of the stream and emit partial windows under the same keys
+        raise EnvironmentError("AGGREGATE needs a single subscriber process, unset SUBSCRIBER_PROCESSES or set it to 1")
+
     # Fetch the schema from the registry
     schema_str = get_schema()
     print(f"Successfully fetched schema from registry")
+
+    # Expose /metrics when METRICS_PORT is set
+    start_metrics_server()
+
+    if SUBSCRIBER_PROCESSES > 0:
+        # One subscriber per process, so decoding is not serialized by the GIL
+        run_subscriber_processes(subscriber_worker, (schema_str,), SUBSCRIBER_PROCESSES, "avro")
+        return
     
+    # One columnar sink shared by all subscribers, so micro-batches fill up across them
+    sink = ColumnarSink(SINK_DIR, on_flush=ack_flushed) if SINK_DIR else None
+    aggregator = WindowedAggregator().start() if AGGREGATE else None
+
     # Define the number of parallel subscribers
     num_subscribers = 2
     
@@ -157,8 +255,17 @@ def main():
             executor.submit(
                 subscriber_process, 
                 i+1, # Subscriber ID
-                schema_str # Pass the schema string to the subscriber process
+                schema_str, # Pass the schema string to the subscriber process
+                sink,
+                aggregator
             )
 
+    if sink is not None:
+        sink.close()
+    if aggregator is not None:
+        aggregator.close()
+    # Sink failures of every subscriber wait in the process-wide handler, closed once all of them have stopped
+    get_failure_handler("avro", PROJECT_ID).close()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
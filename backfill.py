@@ -0,0 +1,298 @@
+"""
+Bulk backfill and replay of orders through the order processing logic.
+Streams orders from NDJSON files (one order per line) or Avro container files (avro_archive.py),
+runs them through the same validation, enrichment and process_order as the push service across a
+process pool, and writes them with grouped Firestore batch commits. Inputs are read lazily, one
+batch at a time, with at most two batches per worker in flight.
+
+Progress is checkpointed per input file as the number of leading records that are committed, so an
+interrupted run resumes where it stopped. Rejected orders are reported and counted; a batch in which
+process_order fails for a valid order is not written or checkpointed and stops the run like a
+failed write, so a rerun processes it again; orders after the checkpoint may be written again, which
+is harmless since documents are keyed by order_id. --rate caps the orders per second so a backfill
+leaves Firestore capacity for live traffic.
+
+    python backfill.py archive/*.avro --checkpoint backfill.ckpt --workers 8 --rate 2000
+"""
+
+import os
+import json
+import time
+import signal
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+from firestore_writer import FIRESTORE_COLLECTION
+
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "500"))
+BACKFILL_PROGRESS_SECONDS = float(os.getenv("BACKFILL_PROGRESS_SECONDS", "10"))
+
+# Rejected orders reported per batch
+MAX_REJECTION_SAMPLES = 5
+
+
+class TokenBucket:
+    """Blocks callers so that on average no more than rate tokens are taken per second."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def acquire(self, tokens):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Requests larger than the bucket go through once it is full
+            if self.tokens >= min(tokens, self.capacity):
+                self.tokens -= tokens
+                return
+            time.sleep((min(tokens, self.capacity) - self.tokens) / self.rate)
+
+
+class Checkpoint:
+    """Per-file count of leading records that are committed, saved atomically as JSON."""
+
+    def __init__(self, path=None, restart=False):
+        self.path = path
+        self.files = {}
+        if path and os.path.exists(path) and not restart:
+            with open(path) as checkpoint:
+                self.files = json.load(checkpoint)["files"]
+        # Batches committed ahead of the first unfinished one, by file and start record
+        self._ahead = {}
+        self._totals = {}
+
+    def committed(self, name):
+        return self.files.get(name, {}).get("records", 0)
+
+    def is_done(self, name):
+        return self.files.get(name, {}).get("done", False)
+
+    def batch_done(self, name, start, end):
+        """Record a committed batch, advancing the file's checkpoint over every contiguous batch."""
+        ahead = self._ahead.setdefault(name, {})
+        ahead[start] = end
+        state = self.files.setdefault(name, {"records": 0, "done": False})
+        while state["records"] in ahead:
+            state["records"] = ahead.pop(state["records"])
+        self._mark_done(name)
+
+    def file_read(self, name, total):
+        """Record that every record of a file has been submitted."""
+        self.files.setdefault(name, {"records": 0, "done": False})
+        self._totals[name] = total
+        self._mark_done(name)
+
+    def _mark_done(self, name):
+        if self._totals.get(name) == self.files[name]["records"]:
+            self.files[name]["done"] = True
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as checkpoint:
+            json.dump({"files": self.files, "saved_at": time.time()}, checkpoint, indent=1)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(temp_path, self.path)
+
+
+def input_format(path, fmt="auto"):
+    if fmt != "auto":
+        return fmt
+    return "avro" if path.endswith(".avro") else "ndjson"
+
+
+def iter_records(path, fmt, skip=0):
+    """Yield the records of an input file after the first skip: raw lines for NDJSON, decoded orders for Avro."""
+    if fmt == "ndjson":
+        with open(path, "rb") as lines:
+            for line in islice(lines, skip, None):
+                line = line.strip()
+                # Blank lines still count as records, so checkpoint positions stay line numbers
+                yield line or None
+        return
+
+    from avro_archive import ArchiveReader
+    from avro_codec import get_codec
+    with ArchiveReader(path) as reader:
+        codec = get_codec(reader.schema_str)
+        for count, data in reader.blocks():
+            # Blocks before the checkpoint are skipped without decoding them
+            if skip >= count:
+                skip -= count
+                continue
+            orders = codec.decode_many(data, count)
+            yield from orders[skip:] if skip else orders
+            skip = 0
+
+
+def iter_batches(paths, fmt, checkpoint, batch_size):
+    """Yield (path, start, records) batches of the inputs, resuming after each file's checkpoint."""
+    for path in paths:
+        if checkpoint.is_done(path):
+            print(f"Skipping {path}, already backfilled")
+            continue
+        start = checkpoint.committed(path)
+        if start:
+            print(f"Resuming {path} after record {start}")
+        records = iter_records(path, input_format(path, fmt), skip=start)
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            yield path, start, batch
+            start += len(batch)
+        checkpoint.file_read(path, start)
+
+
+# Worker side: one Firestore client, schema codec and enricher per process
+
+_worker_options = {}
+
+
+def init_worker(collection, dry_run):
+    # Ctrl+C reaches the whole process group; the parent collects the batches in flight and stops
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_options.update(collection=collection, dry_run=dry_run)
+
+
+def process_records(records):
+    """Decode, validate, enrich, process and persist one batch. Returns counts and sample rejections."""
+    from app import process_order
+    from json_codec import decode_order
+    from order_validation import validate_orders
+    from enrichment import get_enricher
+    from firestore_writer import get_firestore_client, commit_in_batches
+
+    result = {"written": 0, "rejected": 0, "samples": []}
+    orders = []
+    for record in records:
+        if record is None:
+            continue
+        if isinstance(record, bytes):
+            try:
+                record = decode_order(record)
+            except ValueError as e:
+                result["rejected"] += 1
+                if len(result["samples"]) < MAX_REJECTION_SAMPLES:
+                    result["samples"].append(f"undecodable record: {e}")
+                continue
+        orders.append(record)
+
+    rejected = validate_orders(orders)
+    for index, rejections in rejected.items():
+        result["rejected"] += 1
+        if len(result["samples"]) < MAX_REJECTION_SAMPLES:
+            reasons = "; ".join(f"{r.field}: {r.reason}" for r in rejections)
+            result["samples"].append(f"{orders[index].get('order_id')}: {reasons}")
+    valid = [order for index, order in enumerate(orders) if index not in rejected]
+
+    get_enricher().prefetch(valid)
+    processed = [process_order(order, prefetched=True) for order in valid]
+    # Fails the whole batch so it stays out of the checkpoint and is processed again on the next run
+    failed = [order.get('order_id') for order, processed_order in zip(valid, processed) if processed_order is None]
+    if failed:
+        raise RuntimeError(f"{len(failed)} orders failed processing, e.g. {', '.join(map(str, failed[:MAX_REJECTION_SAMPLES]))}")
+
+    # Raises once the commit retries are used up, leaving the batch out of the checkpoint
+    if not _worker_options.get("dry_run"):
+        commit_in_batches(processed, client=get_firestore_client(), collection=_worker_options["collection"])
+    result["written"] = len(processed)
+    return result
+
+
+def run_backfill(paths, fmt="auto", workers=None, batch_size=BACKFILL_BATCH_SIZE, rate=0, checkpoint_path=None,
+                 restart=False, collection=FIRESTORE_COLLECTION, dry_run=False):
+    """Backfill the input files, returning the totals. Stops at the first batch that cannot be written."""
+    # A dry run reads the checkpoint but does not move it
+    checkpoint = Checkpoint(checkpoint_path, restart=restart)
+    if dry_run:
+        checkpoint.path = None
+    workers = workers or os.cpu_count() or 1
+    bucket = TokenBucket(rate, burst=max(rate, batch_size)) if rate else None
+    totals = {"read": 0, "written": 0, "rejected": 0}
+    started = last_progress = time.monotonic()
+    in_flight = {}
+    error = None
+
+    def collect(futures):
+        nonlocal error
+        for future in futures:
+            path, start, count = in_flight.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                error = error or e
+                print(f"Batch {path}[{start}:{start + count}] failed: {e}")
+                continue
+            for key in ("written", "rejected"):
+                totals[key] += result[key]
+            for sample in result["samples"]:
+                print(f"Rejected in {path}: {sample}")
+            checkpoint.batch_done(path, start, start + count)
+        if futures:
+            checkpoint.save()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(collection, dry_run)) as pool:
+        try:
+            for path, start, records in iter_batches(paths, fmt, checkpoint, batch_size):
+                if bucket is not None:
+                    bucket.acquire(len(records))
+                # Two batches per worker keep the pool busy without reading ahead of it
+                while len(in_flight) >= workers * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                collect([future for future in in_flight if future.done()])
+                if error is not None:
+                    break
+                in_flight[pool.submit(process_records, records)] = (path, start, len(records))
+                totals["read"] += len(records)
+
+                if time.monotonic() - last_progress >= BACKFILL_PROGRESS_SECONDS:
+                    last_progress = time.monotonic()
+                    elapsed = last_progress - started
+                    print(f"Backfill progress: {totals['written']} written, {totals['rejected']} rejected "
+                          f"({totals['written'] / elapsed:.0f} orders/s)")
+        finally:
+            # Interrupted or not, what is in flight is collected so the checkpoint covers it
+            collect(list(in_flight))
+
+    if error is not None:
+        raise error
+    totals["elapsed_seconds"] = round(time.monotonic() - started, 1)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill orders from NDJSON or Avro container files.")
+    parser.add_argument("inputs", nargs="+", help="NDJSON or Avro container (.avro) files")
+    parser.add_argument("--format", choices=["auto", "ndjson", "avro"], default="auto")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+    parser.add_argument("--rate", type=float, default=0, help="maximum orders per second, 0 for no limit")
+    parser.add_argument("--checkpoint", help="checkpoint file to resume from and record progress in")
+    parser.add_argument("--restart", action="store_true", help="ignore the existing checkpoint")
+    parser.add_argument("--collection", default=FIRESTORE_COLLECTION)
+    parser.add_argument("--dry-run", action="store_true", help="process the orders without writing them")
+    args = parser.parse_args()
+
+    try:
+        totals = run_backfill(args.inputs, fmt=args.format, workers=args.workers, batch_size=args.batch_size,
+                              rate=args.rate, checkpoint_path=args.checkpoint, restart=args.restart,
+                              collection=args.collection, dry_run=args.dry_run)
+    except KeyboardInterrupt:
+        print("Backfill interrupted, rerun with the same --checkpoint to resume")
+        raise SystemExit(130)
+    except Exception as e:
+        print(f"Backfill stopped: {e}. Rerun with the same --checkpoint to resume")
+        raise SystemExit(1)
+    print(json.dumps(totals))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+High-throughput publishing helpers shared by the JSON and Avro publishers.
+Builds a PublisherClient with BatchSettings and PublishFlowControl, and tracks in-flight
+publish futures with completion callbacks instead of blocking on each one, keeping a
+bounded latency sample for the final summary.
+With ORDERING_KEYS set, messages carry the order's ORDERING_KEY_FIELD as their ordering key.
+Multi-order envelopes (envelope.py) are published through the same tracker.
+"""
+
+import os
+import time
+import random
+import threading
+from google.cloud import pubsub_v1
+
+# Client-side batching
+PUBLISH_BATCH_MAX_MESSAGES = int(os.getenv("PUBLISH_BATCH_MAX_MESSAGES", "1000"))
+PUBLISH_BATCH_MAX_BYTES = int(os.getenv("PUBLISH_BATCH_MAX_BYTES", str(1024 * 1024)))
+PUBLISH_BATCH_MAX_LATENCY = float(os.getenv("PUBLISH_BATCH_MAX_LATENCY", "0.01"))
+
+# Publisher flow control, blocks publish() instead of buffering without bound
+PUBLISH_MAX_OUTSTANDING_MESSAGES = int(os.getenv("PUBLISH_MAX_OUTSTANDING_MESSAGES", "10000"))
+PUBLISH_MAX_OUTSTANDING_BYTES = int(os.getenv("PUBLISH_MAX_OUTSTANDING_BYTES", str(64 * 1024 * 1024)))
+
+# Ordering keys: Pub/Sub delivers the messages of a key in publish order on subscriptions with
+# message ordering enabled. Off by default, the client batches and sends each key separately.
+ORDERING_KEYS = os.getenv("ORDERING_KEYS", "false").lower() == "true"
+ORDERING_KEY_FIELD = os.getenv("ORDERING_KEY_FIELD", "customer_id")
+
+# Number of latency samples kept for percentiles
+LATENCY_SAMPLE_SIZE = 10000
+
+
+def create_publisher():
+    """Create a PublisherClient with default batching, ordering messages by key when ORDERING_KEYS is set."""
+    return pubsub_v1.PublisherClient(
+        publisher_options=pubsub_v1.types.PublisherOptions(enable_message_ordering=ORDERING_KEYS)
+    )
+
+
+def create_batch_publisher(publisher_options=None):
+    """Create a PublisherClient tuned for throughput."""
+    batch_settings = pubsub_v1.types.BatchSettings(
+        max_messages=PUBLISH_BATCH_MAX_MESSAGES,
+        max_bytes=PUBLISH_BATCH_MAX_BYTES,
+        max_latency=PUBLISH_BATCH_MAX_LATENCY,
+    )
+    flow_control = pubsub_v1.types.PublishFlowControl(
+        message_limit=PUBLISH_MAX_OUTSTANDING_MESSAGES,
+        byte_limit=PUBLISH_MAX_OUTSTANDING_BYTES,
+        limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK,
+    )
+    options = publisher_options or pubsub_v1.types.PublisherOptions(enable_message_ordering=ORDERING_KEYS)
+    options = options._replace(flow_control=flow_control)
+    return pubsub_v1.PublisherClient(batch_settings=batch_settings, publisher_options=options)
+
+
+def ordering_key(order):
+    """Ordering key of an order, an empty string (no key) unless ORDERING_KEYS is set."""
+    return str(order.get(ORDERING_KEY_FIELD) or "") if ORDERING_KEYS else ""
+
+
+def publish_ordered(publisher, topic_path, data, key="", **attributes):
+    """
+    Publish a message under an ordering key, returning the publish future.
+    A failed publish pauses its key in the client, so the key is resumed once the failure is seen;
+    the messages published under it meanwhile fail too and must be republished by the caller.
+    """
+    future = publisher.publish(topic_path, data=data, ordering_key=key, **attributes)
+    if key:
+        def resume_on_failure(f):
+            if f.exception() is not None:
+                publisher.resume_publish(topic_path, key)
+        future.add_done_callback(resume_on_failure)
+    return future
+
+
+def publish_envelopes(tracker, publisher, topic_path, envelopes):
+    """Publish the (key, data, attributes) envelopes of an EnvelopePacker, tracking each publish."""
+    for key, data, attributes in envelopes:
+        tracker.track(publish_ordered, publisher, topic_path, data, key, **attributes)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class PublishTracker:
+    """Tracks in-flight publish futures through callbacks with bounded memory."""
+
+    def __init__(self, max_in_flight=PUBLISH_MAX_OUTSTANDING_MESSAGES, sample_size=LATENCY_SAMPLE_SIZE):
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._sample_size = sample_size
+        self._latencies = []
+        self._completed = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    def track(self, publish, *args, **kwargs):
+        """Call publish(*args, **kwargs) once an in-flight slot is free and track its future."""
+        self._slots.acquire()
+        with self._lock:
+            self._in_flight += 1
+        started = time.monotonic()
+        try:
+            future = publish(*args, **kwargs)
+        except Exception:
+            self._done(started, ok=False)
+            raise
+        future.add_done_callback(lambda f: self._done(started, ok=f.exception() is None))
+        return future
+
+    def _done(self, started, ok):
+        latency = time.monotonic() - started
+        with self._lock:
+            if ok:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            # Reservoir sampling keeps the latency sample bounded however many messages are sent
+            self._completed += 1
+            if len(self._latencies) < self._sample_size:
+                self._latencies.append(latency)
+            else:
+                slot = random.randrange(self._completed)
+                if slot < self._sample_size:
+                    self._latencies[slot] = latency
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self.finished_at = time.monotonic()
+                self._idle.notify_all()
+        self._slots.release()
+
+    def wait(self, timeout=None):
+        """Block until every tracked publish has completed."""
+        with self._lock:
+            return self._idle.wait_for(lambda: self._in_flight == 0, timeout=timeout)
+
+    def summary(self):
+        """Return counts, throughput and latency percentiles (in milliseconds)."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            elapsed = (self.finished_at or time.monotonic()) - self.started_at
+            total = self.succeeded + self.failed
+            return {
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "in_flight": self._in_flight,
+                "elapsed_seconds": round(elapsed, 3),
+                "messages_per_second": round(total / elapsed, 1) if elapsed > 0 else None,
+                "latency_ms": {
+                    f"p{pct}": round(percentile(latencies, pct) * 1000, 2) if latencies else None
+                    for pct in (50, 95, 99)
+                },
+            }
+
+    def print_summary(self, label="Publisher"):
+        summary = self.summary()
+        latency = summary["latency_ms"]
+        print(
+            f"{label} summary: {summary['succeeded']} succeeded, {summary['failed']} failed "
+            f"in {summary['elapsed_seconds']}s ({summary['messages_per_second']} msg/s), "
+            f"latency p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms"
+        )
@@ -0,0 +1,426 @@
+"""
+Throughput and latency benchmarks for the JSON and Avro order paths.
+Drives json_publisher/json_subscriber, avro_publisher/avro_subscriber and the app.py push handler
+against local stand-ins (an in-memory fake by default, or the Pub/Sub and Firestore emulators),
+and reports messages per second, per-stage p50/p95/p99 latency, bytes per message and peak RSS.
+Results are saved as JSON so runs can be compared across commits.
+
+Usage:
+    python benchmark.py --messages 5000
+    PUBSUB_EMULATOR_HOST=localhost:8085 FIRESTORE_EMULATOR_HOST=localhost:8086 python benchmark.py --transport emulator
+    python benchmark.py --compare bench_results/<before>.json bench_results/<after>.json
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import resource
+import itertools
+import subprocess
+import contextlib
+from concurrent.futures import Future
+from datetime import datetime
+
+import app
+import startup
+import json_publisher
+import json_subscriber
+import avro_publisher
+import avro_subscriber
+from avro_codec import get_codec, BACKENDS
+from json_codec import decode_order, encode_order
+from batch_publishing import percentile
+from mock_data_generator import generate_orders_batch, load_schema
+from schema_registry import SchemaEntry
+
+RESULTS_DIR = os.getenv("BENCH_RESULTS_DIR", "bench_results")
+BENCH_TOPIC = "bench-orders-topic"
+BENCH_SUBSCRIPTION = "bench-orders-sub"
+
+
+class StageTimer:
+    """Collects per-stage latency samples."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def record(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage, fn):
+        """Return fn wrapped so every call is timed under the given stage."""
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - started)
+        return timed
+
+    def summary(self):
+        result = {}
+        for stage, values in self.samples.items():
+            values = sorted(values)
+            result[stage] = {
+                "count": len(values),
+                **{f"p{pct}_ms": round(percentile(values, pct) * 1000, 4) for pct in (50, 95, 99)},
+            }
+        return result
+
+
+class FakeMessage:
+    """Stand-in for a received Pub/Sub message."""
+
+    def __init__(self, message_id, data, attributes):
+        self.message_id = message_id
+        self.data = data
+        self.attributes = attributes
+        self.delivery_attempt = None
+        self.acked = None
+
+    def ack(self):
+        self.acked = True
+
+    def nack(self):
+        self.acked = False
+
+
+class InMemoryTransport:
+    """In-memory Pub/Sub topic: publish appends, receive drains."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self._messages = []
+
+    def topic_path(self, project, topic):
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic_path, data, **attributes):
+        message_id = str(next(self._ids))
+        self._messages.append(FakeMessage(message_id, data, attributes))
+        future = Future()
+        future.set_result(message_id)
+        return future
+
+    def receive(self):
+        messages, self._messages = self._messages, []
+        return messages
+
+
+class EmulatorTransport:
+    """Pub/Sub emulator transport: real publisher client, synchronous pull on a benchmark subscription."""
+
+    def __init__(self, project_id):
+        from google.cloud import pubsub_v1
+        self.publisher = pubsub_v1.PublisherClient()
+        self.subscriber = pubsub_v1.SubscriberClient()
+        self.topic = self.publisher.topic_path(project_id, BENCH_TOPIC)
+        self.subscription = self.subscriber.subscription_path(project_id, BENCH_SUBSCRIPTION)
+        with contextlib.suppress(Exception):
+            self.publisher.create_topic(name=self.topic)
+        with contextlib.suppress(Exception):
+            self.subscriber.create_subscription(name=self.subscription, topic=self.topic)
+
+    def topic_path(self, project, topic):
+        return self.topic
+
+    def publish(self, topic_path, data, **attributes):
+        return self.publisher.publish(self.topic, data=data, **attributes)
+
+    def receive(self):
+        messages = []
+        while True:
+            response = self.subscriber.pull(
+                request={"subscription": self.subscription, "max_messages": 1000}, timeout=5
+            )
+            if not response.received_messages:
+                return messages
+            ack_ids = [received.ack_id for received in response.received_messages]
+            self.subscriber.acknowledge(request={"subscription": self.subscription, "ack_ids": ack_ids})
+            messages.extend(
+                FakeMessage(received.message.message_id, received.message.data, dict(received.message.attributes))
+                for received in response.received_messages
+            )
+
+
+class InMemoryOrderWriter:
+    """Stand-in for firestore_writer.OrderWriter that keeps documents in a dict."""
+
+    def __init__(self):
+        self.documents = {}
+
+    def submit(self, order):
+        future = Future()
+        future.set_result(self.save(order))
+        return future
+
+    def save(self, order, timeout=None):
+        self.documents[order['order_id']] = dict(order)
+        return order['order_id']
+
+
+class LocalSchemaCache:
+    """Stand-in for schema_registry.SchemaCache serving orders.avsc."""
+
+    def __init__(self, schema_str):
+        self.entry = SchemaEntry("orders-schema", "local", schema_str)
+
+    def entry_for_attributes(self, attributes=None):
+        return self.entry
+
+    def latest(self):
+        return self.entry
+
+    def revision(self, revision_id):
+        return self.entry
+
+    def get_schema(self, revision_id=None):
+        return self.entry.definition
+
+
+@contextlib.contextmanager
+def patched(*patches):
+    """Temporarily replace module attributes given as (module, name, value) tuples."""
+    originals = [(module, name, getattr(module, name)) for module, name, _ in patches]
+    try:
+        for module, name, value in patches:
+            setattr(module, name, value)
+        yield
+    finally:
+        for module, name, value in originals:
+            setattr(module, name, value)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is KB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def order_writer(transport_name):
+    if transport_name == "emulator" and os.getenv("FIRESTORE_EMULATOR_HOST"):
+        from firestore_writer import get_order_writer
+        return get_order_writer()
+    return InMemoryOrderWriter()
+
+
+def run_json_path(orders, transport, writer):
+    """JSON publisher -> transport -> JSON subscriber -> process_order -> persist."""
+    timer = StageTimer()
+    topic_path = transport.topic_path(json_publisher.PROJECT_ID, json_publisher.TOPIC_NAME)
+    publisher = type("TimedPublisher", (), {"publish": staticmethod(timer.wrap("publish", transport.publish))})()
+
+    started = time.perf_counter()
+    for order in orders:
+        encode_started = time.perf_counter()
+        json_publisher.publish_message(publisher, topic_path, order)
+        # The publish stage is timed inside, the remainder is the script's own encode
+        timer.record("encode", time.perf_counter() - encode_started - timer.samples["publish"][-1])
+
+    messages = transport.receive()
+    payload_bytes = sum(len(message.data) for message in messages)
+    for message in messages:
+        timer.wrap("decode", decode_order)(message.data)
+        timer.wrap("subscriber_callback", json_subscriber.process_message)(message)
+        processed = timer.wrap("process_order", app.process_order)(decode_order(message.data))
+        timer.wrap("persist", writer.save)(processed)
+    elapsed = time.perf_counter() - started
+    return timer, elapsed, payload_bytes, len(messages)
+
+
+def run_avro_path(orders, transport, writer, schema_str):
+    """Avro publisher -> transport -> Avro subscriber -> process_order -> persist."""
+    timer = StageTimer()
+    topic_path = transport.topic_path(avro_publisher.PROJECT_ID, avro_publisher.TOPIC_NAME)
+    publisher = type("TimedPublisher", (), {"publish": staticmethod(timer.wrap("publish", transport.publish))})()
+    decode = timer.wrap("decode", avro_subscriber.deserialize_from_avro)
+
+    started = time.perf_counter()
+    with patched((avro_publisher, "serialize_to_avro", timer.wrap("encode", avro_publisher.serialize_to_avro)),
+                 (avro_subscriber, "deserialize_from_avro", decode)):
+        for order in orders:
+            avro_publisher.publish_avro_message(publisher, topic_path, order, schema_str)
+
+        messages = transport.receive()
+        payload_bytes = sum(len(message.data) for message in messages)
+        codec = get_codec(schema_str)
+        for message in messages:
+            timer.wrap("subscriber_callback", avro_subscriber.process_avro_message)(message, schema_str)
+            processed = timer.wrap("process_order", app.process_order)(codec.decode(message.data))
+            timer.wrap("persist", writer.save)(processed)
+    elapsed = time.perf_counter() - started
+    return timer, elapsed, payload_bytes, len(messages)
+
+
+def run_push_path(orders, writer, schema_str):
+    """Pub/Sub push envelopes -> app.py handler (decode, process_order, persist)."""
+    timer = StageTimer()
+    codec = get_codec(schema_str)
+    envelopes = []
+    for i, order in enumerate(orders):
+        data = timer.wrap("encode", codec.encode)(order)
+        envelopes.append({
+            "message": {"data": base64.b64encode(data).decode("ascii"), "messageId": str(i), "attributes": {}},
+            "subscription": "projects/bench/subscriptions/bench",
+        })
+    payload_bytes = sum(len(json.dumps(envelope)) for envelope in envelopes)
+
+    # The benchmark runs offline, without the background warm-up of the registry and Firestore clients
+    with patched((startup, "STARTUP_WARMUP", False)):
+        client = app.app.test_client()
+    schema_cache = LocalSchemaCache(schema_str)
+    started = time.perf_counter()
+    with patched((app, "get_schema_cache", lambda project_id, schema_name: schema_cache),
+                 (app, "get_order_writer", lambda: writer),
+                 (app, "deserialize_from_avro", timer.wrap("decode", app.deserialize_from_avro)),
+                 (app, "process_order", timer.wrap("process_order", app.process_order)),
+                 (app, "save_to_firestore", timer.wrap("persist", app.save_to_firestore))):
+        for envelope in envelopes:
+            response = timer.wrap("request", client.post)("/", json=envelope)
+            if response.status_code != 200:
+                raise RuntimeError(f"Push handler returned {response.status_code}: {response.get_data(as_text=True)}")
+    elapsed = time.perf_counter() - started
+    return timer, elapsed, payload_bytes, len(envelopes)
+
+
+def microbenchmark(fn, arg, iterations):
+    """Mean microseconds per call of fn(arg)."""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn(arg)
+    return round((time.perf_counter() - started) / iterations * 1e6, 3)
+
+
+def run_microbenchmarks(orders, schema_str, iterations):
+    """Codec micro-benchmarks on a single representative order."""
+    order = orders[0]
+    results = {}
+    for backend in BACKENDS:
+        try:
+            codec = get_codec(schema_str, backend)
+        except ImportError:
+            continue
+        encoded = codec.encode(order)
+        results[f"avro_{backend}_encode_us"] = microbenchmark(codec.encode, order, iterations)
+        results[f"avro_{backend}_decode_us"] = microbenchmark(codec.decode, encoded, iterations)
+    encoded = json.dumps(order).encode("utf-8")
+    results["json_encode_us"] = microbenchmark(lambda o: json.dumps(o).encode("utf-8"), order, iterations)
+    results["json_decode_us"] = microbenchmark(json.loads, encoded, iterations)
+    # Backend codec plus single-pass validation, as used by the JSON publisher and subscriber
+    results["json_codec_encode_us"] = microbenchmark(encode_order, order, iterations)
+    results["json_codec_decode_us"] = microbenchmark(decode_order, encoded, iterations)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    schema_str = load_schema()
+    orders = generate_orders_batch(args.messages, seed=args.seed)
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "messages": args.messages,
+        "transport": args.transport,
+        "paths": {},
+    }
+
+    for path in args.paths:
+        transport = EmulatorTransport(app.PROJECT_ID) if args.transport == "emulator" else InMemoryTransport()
+        writer = order_writer(args.transport)
+        # The scripts print per message, keep that cost but not the output
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            if path == "json":
+                timer, elapsed, payload_bytes, count = run_json_path(orders, transport, writer)
+            elif path == "avro":
+                timer, elapsed, payload_bytes, count = run_avro_path(orders, transport, writer, schema_str)
+            else:
+                timer, elapsed, payload_bytes, count = run_push_path(orders, writer, schema_str)
+        results["paths"][path] = {
+            "messages_per_second": round(count / elapsed, 1),
+            "bytes_per_message": round(payload_bytes / count, 1) if count else None,
+            "stages": timer.summary(),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+    results["microbenchmarks"] = run_microbenchmarks(orders, schema_str, args.iterations)
+    return results
+
+
+def print_results(results):
+    print(f"Benchmark @ {results['commit']} ({results['messages']} messages, {results['transport']} transport)")
+    for path, result in results["paths"].items():
+        print(f"\n[{path}] {result['messages_per_second']} msg/s, {result['bytes_per_message']} bytes/msg, "
+              f"peak RSS {result['peak_rss_mb']} MB")
+        for stage, stats in result["stages"].items():
+            print(f"  {stage:<20} p50={stats['p50_ms']:.4f}ms p95={stats['p95_ms']:.4f}ms p99={stats['p99_ms']:.4f}ms")
+    print("\n[microbenchmarks]")
+    for name, value in results["microbenchmarks"].items():
+        print(f"  {name:<28} {value} us")
+
+
+def compare(before_path, after_path):
+    """Print the relative change of throughput, p99 latencies and microbenchmarks between two runs."""
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    def delta(old, new):
+        return f"{old} -> {new} ({(new - old) / old * 100:+.1f}%)" if old else f"{old} -> {new}"
+
+    print(f"Comparing {before['commit']} -> {after['commit']}")
+    for path, result in after["paths"].items():
+        if path not in before["paths"]:
+            continue
+        old = before["paths"][path]
+        print(f"\n[{path}] msg/s {delta(old['messages_per_second'], result['messages_per_second'])}")
+        for stage, stats in result["stages"].items():
+            if stage in old["stages"]:
+                print(f"  {stage:<20} p99_ms {delta(old['stages'][stage]['p99_ms'], stats['p99_ms'])}")
+    print("\n[microbenchmarks]")
+    for name, value in after["microbenchmarks"].items():
+        if name in before["microbenchmarks"]:
+            print(f"  {name:<28} {delta(before['microbenchmarks'][name], value)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the JSON and Avro order paths.")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--paths", nargs="+", choices=["json", "avro", "push"], default=["json", "avro", "push"])
+    parser.add_argument("--transport", choices=["memory", "emulator"], default="memory")
+    parser.add_argument("--iterations", type=int, default=5000, help="iterations per microbenchmark")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="results file (default: bench_results/<timestamp>-<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.transport == "emulator" and not os.getenv("PUBSUB_EMULATOR_HOST"):
+        parser.error("--transport emulator requires PUBSUB_EMULATOR_HOST")
+
+    results = run(args)
+    print_results(results)
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{results['commit'] or 'nocommit'}.json")
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
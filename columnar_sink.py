@@ -0,0 +1,288 @@
+"""
+Columnar micro-batch sink for order analytics.
+Buffers orders into micro-batches, flattens the nested items and shipping_address records of
+orders.avsc into column arrays and writes Parquet (or Arrow IPC) files partitioned by order date
+and shipping state. A batch is flushed when it reaches SINK_MAX_ROWS rows, SINK_MAX_BYTES
+(estimated) bytes or SINK_FLUSH_SECONDS age; full batches are sealed and written by the sink's
+own thread, so adding orders never waits on (or fails with) a file write. A batch whose write
+fails keeps the files it has not written yet and is retried on the next tick; after
+SINK_MAX_FLUSH_ATTEMPTS attempts it is dropped and its tokens are failed through on_flush. Two
+tables are written:
+
+    <directory>/orders/dt=YYYY-MM-DD/state=XX/part-*.parquet       one row per order
+    <directory>/order_items/dt=YYYY-MM-DD/state=XX/part-*.parquet  one row per order item
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from datetime import datetime
+
+SINK_FORMAT = os.getenv("SINK_FORMAT", "parquet")
+SINK_COMPRESSION = os.getenv("SINK_COMPRESSION", "zstd")
+SINK_MAX_ROWS = int(os.getenv("SINK_MAX_ROWS", "50000"))
+SINK_MAX_BYTES = int(os.getenv("SINK_MAX_BYTES", str(32 * 1024 * 1024)))
+SINK_FLUSH_SECONDS = float(os.getenv("SINK_FLUSH_SECONDS", "60"))
+SINK_MAX_FLUSH_ATTEMPTS = int(os.getenv("SINK_MAX_FLUSH_ATTEMPTS", "3"))
+
+FILE_EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+# Flattened column layout of each table, as (column name, arrow type name)
+ORDER_COLUMNS = [
+    ("order_id", "string"),
+    ("customer_id", "string"),
+    ("order_date", "string"),
+    ("status", "string"),
+    ("total_amount", "float64"),
+    ("item_count", "int32"),
+    ("units", "int32"),
+    ("shipping_street", "string"),
+    ("shipping_city", "string"),
+    ("shipping_state", "string"),
+    ("shipping_zip", "string"),
+    ("shipping_country", "string"),
+]
+ITEM_COLUMNS = [
+    ("order_id", "string"),
+    ("order_date", "string"),
+    ("shipping_state", "string"),
+    ("product_id", "string"),
+    ("product_name", "string"),
+    ("quantity", "int32"),
+    ("unit_price", "float64"),
+    ("line_amount", "float64"),
+]
+
+
+def partition_of(order):
+    """Return the (date, state) partition of an order."""
+    # order_date is an ISO timestamp, its first 10 characters are the date
+    date = order['order_date'][:10] or "unknown"
+    state = order['shipping_address'].get('state') or "unknown"
+    return date, state.replace("/", "_")
+
+
+class ColumnBatch:
+    """Column arrays of one partition, appended to row by row."""
+
+    def __init__(self):
+        self.orders = {name: [] for name, _ in ORDER_COLUMNS}
+        self.items = {name: [] for name, _ in ITEM_COLUMNS}
+        self.rows = 0
+
+    def add(self, order):
+        """Flatten one order into the order and item columns, returning its estimated size in bytes."""
+        address = order['shipping_address']
+        items = order['items']
+        units = 0
+        size = 0
+        for item in items:
+            quantity = item['quantity']
+            units += quantity
+            self.items["order_id"].append(order['order_id'])
+            self.items["order_date"].append(order['order_date'])
+            self.items["shipping_state"].append(address['state'])
+            self.items["product_id"].append(item['product_id'])
+            self.items["product_name"].append(item['product_name'])
+            self.items["quantity"].append(quantity)
+            self.items["unit_price"].append(item['unit_price'])
+            self.items["line_amount"].append(quantity * item['unit_price'])
+            size += 20 + len(item['product_id']) + len(item['product_name'])
+
+        columns = self.orders
+        columns["order_id"].append(order['order_id'])
+        columns["customer_id"].append(order['customer_id'])
+        columns["order_date"].append(order['order_date'])
+        columns["status"].append(order['status'])
+        columns["total_amount"].append(order['total_amount'])
+        columns["item_count"].append(len(items))
+        columns["units"].append(units)
+        columns["shipping_street"].append(address['street'])
+        columns["shipping_city"].append(address['city'])
+        columns["shipping_state"].append(address['state'])
+        columns["shipping_zip"].append(address['zip'])
+        columns["shipping_country"].append(address['country'])
+        self.rows += 1
+
+        # Rough in-memory size of the row, used for the byte bound (strings plus fixed-width numbers)
+        size += 16 + sum(len(order[key]) for key in ('order_id', 'customer_id', 'order_date', 'status'))
+        size += sum(len(value) for value in address.values())
+        return size
+
+
+class SealedBatch:
+    """A micro-batch waiting to be written: the table files still to write and the tokens of its orders."""
+
+    def __init__(self, batches, tokens, rows):
+        self.files = []
+        for partition, batch in batches.items():
+            self.files.append(("orders", partition, batch.orders))
+            if batch.items["order_id"]:
+                self.files.append(("order_items", partition, batch.items))
+        self.tokens = tokens
+        self.rows = rows
+        self.partitions = len(batches)
+        self.attempts = 0
+
+
+class ColumnarSink:
+    """Micro-batches orders and writes them as date/state partitioned columnar files."""
+
+    def __init__(self, directory, file_format=SINK_FORMAT, compression=SINK_COMPRESSION, max_rows=SINK_MAX_ROWS,
+                 max_bytes=SINK_MAX_BYTES, flush_seconds=SINK_FLUSH_SECONDS, max_attempts=SINK_MAX_FLUSH_ATTEMPTS,
+                 on_flush=None):
+        import pyarrow
+        if file_format not in FILE_EXTENSIONS:
+            raise ValueError(f"Unsupported sink format: {file_format}")
+        self._pa = pyarrow
+        self.directory = directory
+        self.file_format = file_format
+        self.compression = compression
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.flush_seconds = flush_seconds
+        self.max_attempts = max(1, max_attempts)
+        # Optional callback(tokens, error=None) invoked once the orders added with those tokens are written,
+        # or with the error once their batch is given up on
+        self.on_flush = on_flush
+
+        self._schemas = {
+            "orders": pyarrow.schema([(name, getattr(pyarrow, type_name)()) for name, type_name in ORDER_COLUMNS]),
+            "order_items": pyarrow.schema([(name, getattr(pyarrow, type_name)()) for name, type_name in ITEM_COLUMNS]),
+        }
+        # _lock guards the buffered micro-batch and the sealed queue, _write_lock the writing of sealed batches
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._batches = {}
+        self._tokens = []
+        self._rows = 0
+        self._bytes = 0
+        self._started_at = 0.0
+        self._sealed = deque()
+        self._sequence = 0
+        self._closed = False
+        self._wake = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+        self._ticker = threading.Thread(target=self._tick_loop, name="columnar-sink-ticker", daemon=True)
+        self._ticker.start()
+
+    def add(self, order, token=None):
+        """Buffer one order, sealing the micro-batch for the writer when it reaches the row or byte bound."""
+        partition = partition_of(order)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("ColumnarSink is closed")
+            if not self._rows:
+                self._started_at = time.monotonic()
+            batch = self._batches.get(partition)
+            if batch is None:
+                batch = self._batches[partition] = ColumnBatch()
+            self._bytes += batch.add(order)
+            self._rows += 1
+            if token is not None:
+                self._tokens.append(token)
+            if self._rows >= self.max_rows or self._bytes >= self.max_bytes:
+                self._seal()
+                self._wake.set()
+
+    def add_many(self, orders):
+        """Buffer a list of already decoded orders."""
+        for order in orders:
+            self.add(order)
+
+    def _write_table(self, table_name, partition, columns):
+        date, state = partition
+        directory = os.path.join(self.directory, table_name, f"dt={date}", f"state={state}")
+        os.makedirs(directory, exist_ok=True)
+        self._sequence += 1
+        name = f"part-{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}-{self._sequence:05d}{FILE_EXTENSIONS[self.file_format]}"
+        path = os.path.join(directory, name)
+
+        table = self._pa.Table.from_pydict(columns, schema=self._schemas[table_name])
+        # Write under a temporary name so readers never pick up a partial file
+        tmp_path = path + ".tmp"
+        if self.file_format == "parquet":
+            import pyarrow.parquet as pq
+            pq.write_table(table, tmp_path, compression=self.compression)
+        else:
+            import pyarrow.ipc
+            options = pyarrow.ipc.IpcWriteOptions(compression=self.compression if self.compression != "none" else None)
+            with pyarrow.ipc.new_file(tmp_path, table.schema, options=options) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+        return path
+
+    def _seal(self):
+        """Move the buffered micro-batch to the queue of batches to write. Called with _lock held."""
+        if not self._rows:
+            return
+        self._sealed.append(SealedBatch(self._batches, self._tokens, self._rows))
+        self._batches = {}
+        self._tokens = []
+        self._rows = 0
+        self._bytes = 0
+
+    def _write_sealed(self, final=False):
+        """Write the sealed batches in order, stopping at one that fails so it is retried on the next tick."""
+        with self._write_lock:
+            while True:
+                with self._lock:
+                    if not self._sealed:
+                        return
+                    sealed = self._sealed[0]
+                try:
+                    # Files are dropped from the batch as they are written, so a retry does not duplicate them
+                    while sealed.files:
+                        self._write_table(*sealed.files[0])
+                        sealed.files.pop(0)
+                except Exception as e:
+                    sealed.attempts += 1
+                    if not final and sealed.attempts < self.max_attempts:
+                        print(f"Error writing columnar sink batch (attempt {sealed.attempts}), retrying: {e}")
+                        return
+                    print(f"Giving up on a columnar sink batch of {sealed.rows} orders after {sealed.attempts} attempts: {e}")
+                    error = e
+                else:
+                    print(f"Columnar sink wrote {sealed.rows} orders ({sealed.partitions} partitions) to {self.directory}")
+                    error = None
+                with self._lock:
+                    self._sealed.popleft()
+                if sealed.tokens and self.on_flush is not None:
+                    try:
+                        self.on_flush(sealed.tokens, error)
+                    except Exception as e:
+                        print(f"Error settling columnar sink batch: {e}")
+
+    def _tick_loop(self):
+        # Time-based flushing, so a quiet stream still gets its micro-batches written
+        while not self._closed:
+            self._wake.wait(min(self.flush_seconds, 1.0))
+            self._wake.clear()
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"Error flushing columnar sink: {e}")
+
+    def tick(self):
+        """Seal the micro-batch once it is older than flush_seconds and write the sealed batches."""
+        with self._lock:
+            if self._rows and time.monotonic() - self._started_at >= self.flush_seconds:
+                self._seal()
+        self._write_sealed()
+
+    def flush(self):
+        """Write the buffered micro-batch and any batches waiting to be written."""
+        with self._lock:
+            self._seal()
+        self._write_sealed()
+
+    def close(self):
+        """Stop the writer thread and write what is left, failing the tokens of batches that cannot be written."""
+        with self._lock:
+            self._closed = True
+            self._seal()
+        self._wake.set()
+        self._ticker.join(timeout=5)
+        self._write_sealed(final=True)
@@ -0,0 +1,121 @@
+"""
+Idempotency layer that short-circuits Pub/Sub redeliveries ahead of decode and Firestore writes.
+Remembers processed message IDs and order keys in a bounded LRU with a TTL. An optional
+Bloom filter in front of it answers "definitely not seen" for new messages without
+touching the LRU; it never causes a message to be skipped on its own.
+"""
+
+import os
+import math
+import time
+import hashlib
+import threading
+from ttl_cache import LRUTTLCache
+from metrics import REGISTRY
+
+DEDUPE_MAX_ENTRIES = int(os.getenv("DEDUPE_MAX_ENTRIES", "100000"))
+DEDUPE_TTL_SECONDS = float(os.getenv("DEDUPE_TTL_SECONDS", "600"))
+DEDUPE_BLOOM = os.getenv("DEDUPE_BLOOM", "false").lower() == "true"
+DEDUPE_BLOOM_ERROR_RATE = float(os.getenv("DEDUPE_BLOOM_ERROR_RATE", "0.01"))
+
+DEDUPE_LOOKUPS = REGISTRY.counter("orders_dedupe_lookups_total", "Dedupe lookups by key type and result", ["key", "result"])
+
+
+class BloomFilter:
+    """Two-generation Bloom filter; each generation is rotated out after rotate_seconds."""
+
+    def __init__(self, capacity, error_rate, rotate_seconds):
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.rotate_seconds = rotate_seconds
+        self._current = bytearray((self.num_bits + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._rotated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def _maybe_rotate(self):
+        # Keys stay in the filter for at least rotate_seconds, which is the LRU TTL
+        if time.monotonic() - self._rotated_at >= self.rotate_seconds:
+            self._previous = self._current
+            self._current = bytearray(len(self._previous))
+            self._rotated_at = time.monotonic()
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            self._maybe_rotate()
+            for position in positions:
+                self._current[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        positions = self._positions(key)
+        current, previous = self._current, self._previous
+        return (
+            all(current[p >> 3] & (1 << (p & 7)) for p in positions)
+            or all(previous[p >> 3] & (1 << (p & 7)) for p in positions)
+        )
+
+
+class DedupeCache:
+    """Remembers processed message IDs and order keys so redeliveries can be skipped."""
+
+    def __init__(self, max_entries=DEDUPE_MAX_ENTRIES, ttl_seconds=DEDUPE_TTL_SECONDS, use_bloom=DEDUPE_BLOOM,
+                 bloom_error_rate=DEDUPE_BLOOM_ERROR_RATE):
+        self._messages = LRUTTLCache(max_entries, ttl_seconds)
+        self._orders = LRUTTLCache(max_entries, ttl_seconds)
+        self._bloom = BloomFilter(max_entries * 2, bloom_error_rate, ttl_seconds) if use_bloom else None
+
+    @staticmethod
+    def order_key(order):
+        """Key of an incoming order, taken before processing mutates it."""
+        # The status is part of the key so later lifecycle updates of the same order still go through
+        return f"{order['order_id']}:{order.get('status', '')}"
+
+    def _seen(self, cache, key, key_type):
+        if self._bloom is not None and f"{key_type}:{key}" not in self._bloom:
+            DEDUPE_LOOKUPS.inc(key=key_type, result="miss")
+            return False
+        seen = key in cache
+        DEDUPE_LOOKUPS.inc(key=key_type, result="hit" if seen else "miss")
+        return seen
+
+    def seen_message(self, message_id):
+        """True if the message ID was already processed successfully."""
+        return bool(message_id) and self._seen(self._messages, message_id, "message")
+
+    def seen_order(self, order_key):
+        """True if this version of the order (see order_key) was already processed successfully."""
+        return self._seen(self._orders, order_key, "order")
+
+    def mark_processed(self, message_id, order_key):
+        """Record a successfully persisted message and order key."""
+        if message_id:
+            self._messages.set(message_id, True)
+        self._orders.set(order_key, True)
+        if self._bloom is not None:
+            if message_id:
+                self._bloom.add(f"message:{message_id}")
+            self._bloom.add(f"order:{order_key}")
+
+    def stats(self):
+        return {"messages": self._messages.stats(), "orders": self._orders.stats()}
+
+
+_dedupe = None
+_dedupe_lock = threading.Lock()
+
+
+def get_dedupe_cache():
+    """Return the process-wide dedupe cache."""
+    global _dedupe
+    if _dedupe is None:
+        with _dedupe_lock:
+            if _dedupe is None:
+                _dedupe = DedupeCache()
+    return _dedupe
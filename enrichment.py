@@ -0,0 +1,223 @@
+"""
+Order enrichment from Firestore reference data.
+Warehouse routing, the product catalog and customer tiers are kept in Firestore reference
+collections. Warehouses are small and loaded whole into a precomputed state -> (warehouse,
+transit days) routing index that is reloaded every ENRICHMENT_ROUTING_TTL_SECONDS. Products and
+customers go through size-bounded LRU/TTL caches; the misses of a whole micro-batch are read
+with a single get_all call, and documents that do not exist are cached too. When the read
+fails, the documents it missed are cached as missing for ENRICHMENT_FAILURE_TTL_SECONDS, so
+orders go on with the defaults instead of each calling Firestore again while it is down.
+With ENRICHMENT unset, orders are routed to WH-<state> with the default transit time.
+
+Seed the reference collections (e.g. on the Firestore emulator) from the mock data:
+    python enrichment.py --seed
+"""
+
+import os
+import time
+import argparse
+import threading
+from ttl_cache import LRUTTLCache
+from metrics import REGISTRY
+
+ENRICHMENT = os.getenv("ENRICHMENT", "false").lower() == "true"
+ENRICHMENT_WAREHOUSES_COLLECTION = os.getenv("ENRICHMENT_WAREHOUSES_COLLECTION", "warehouses")
+ENRICHMENT_PRODUCTS_COLLECTION = os.getenv("ENRICHMENT_PRODUCTS_COLLECTION", "products")
+ENRICHMENT_CUSTOMERS_COLLECTION = os.getenv("ENRICHMENT_CUSTOMERS_COLLECTION", "customers")
+ENRICHMENT_CACHE_MAX_ENTRIES = int(os.getenv("ENRICHMENT_CACHE_MAX_ENTRIES", "50000"))
+ENRICHMENT_CACHE_TTL_SECONDS = float(os.getenv("ENRICHMENT_CACHE_TTL_SECONDS", "300"))
+ENRICHMENT_ROUTING_TTL_SECONDS = float(os.getenv("ENRICHMENT_ROUTING_TTL_SECONDS", "300"))
+ENRICHMENT_FAILURE_TTL_SECONDS = float(os.getenv("ENRICHMENT_FAILURE_TTL_SECONDS", "30"))
+ENRICHMENT_DEFAULT_TRANSIT_DAYS = int(os.getenv("ENRICHMENT_DEFAULT_TRANSIT_DAYS", "3"))
+ENRICHMENT_DEFAULT_TIER = os.getenv("ENRICHMENT_DEFAULT_TIER", "standard")
+
+# Firestore get_all requests are kept to this many documents
+MAX_DOCUMENTS_PER_GET_ALL = 300
+
+ENRICHMENT_LOOKUPS = REGISTRY.counter("orders_enrichment_lookups_total", "Reference data cache lookups", ["collection", "result"])
+ENRICHMENT_FETCH_SECONDS = REGISTRY.histogram("orders_enrichment_fetch_seconds", "Time to read missing reference documents")
+
+_MISSING = object()
+
+
+class Enricher:
+    """Adds warehouse routing, delivery estimates, product categories and customer tiers to orders."""
+
+    def __init__(self, client=None, max_entries=ENRICHMENT_CACHE_MAX_ENTRIES, ttl_seconds=ENRICHMENT_CACHE_TTL_SECONDS,
+                 routing_ttl_seconds=ENRICHMENT_ROUTING_TTL_SECONDS):
+        # Without a client only the default routing is applied
+        self.client = client
+        self.routing_ttl_seconds = routing_ttl_seconds
+        self.caches = {
+            ENRICHMENT_PRODUCTS_COLLECTION: LRUTTLCache(max_entries, ttl_seconds),
+            ENRICHMENT_CUSTOMERS_COLLECTION: LRUTTLCache(max_entries, ttl_seconds),
+        }
+        self._routing = {}
+        self._routing_loaded_at = None
+        self._routing_lock = threading.Lock()
+
+    # Warehouse routing
+
+    def load_routing(self):
+        """Rebuild the state -> (warehouse_id, transit_days) index from the warehouses collection."""
+        routing = {}
+        ranks = {}
+        for snapshot in self.client.collection(ENRICHMENT_WAREHOUSES_COLLECTION).stream():
+            warehouse = snapshot.to_dict()
+            transit_days = warehouse.get("transit_days", ENRICHMENT_DEFAULT_TRANSIT_DAYS)
+            # Several warehouses can serve a state: lowest priority first, then the fastest one
+            rank = (warehouse.get("priority", 0), transit_days)
+            for state in warehouse.get("states", []):
+                if state not in ranks or rank < ranks[state]:
+                    ranks[state] = rank
+                    routing[state] = (warehouse.get("warehouse_id", snapshot.id), transit_days)
+        self._routing = routing
+        self._routing_loaded_at = time.monotonic()
+        print(f"Loaded warehouse routing for {len(routing)} states")
+
+    def _refresh_routing(self):
+        # One thread reloads a stale index, the others keep routing with the previous one
+        if not self._routing_lock.acquire(blocking=self._routing_loaded_at is None):
+            return
+        try:
+            if self._routing_loaded_at is None or time.monotonic() - self._routing_loaded_at >= self.routing_ttl_seconds:
+                self.load_routing()
+        except Exception as e:
+            print(f"Error loading warehouse routing: {e}")
+            # Retry after another TTL rather than on every order
+            self._routing_loaded_at = time.monotonic()
+        finally:
+            self._routing_lock.release()
+
+    def route(self, state):
+        """Return (warehouse_id, transit_days) for a shipping state."""
+        if self.client is not None:
+            if self._routing_loaded_at is None or time.monotonic() - self._routing_loaded_at >= self.routing_ttl_seconds:
+                self._refresh_routing()
+            route = self._routing.get(state)
+            if route is not None:
+                return route
+        return f"WH-{state}", ENRICHMENT_DEFAULT_TRANSIT_DAYS
+
+    # Products and customers
+
+    def prefetch(self, orders):
+        """Read the product and customer documents the orders need and the caches miss, in one get_all."""
+        if self.client is None:
+            return
+        wanted = {
+            ENRICHMENT_PRODUCTS_COLLECTION: {item['product_id'] for order in orders for item in order['items']},
+            ENRICHMENT_CUSTOMERS_COLLECTION: {order['customer_id'] for order in orders},
+        }
+        references = []
+        for collection, keys in wanted.items():
+            cache = self.caches[collection]
+            found = cache.get_many(keys)
+            ENRICHMENT_LOOKUPS.inc(len(found), collection=collection, result="hit")
+            ENRICHMENT_LOOKUPS.inc(len(keys) - len(found), collection=collection, result="miss")
+            references += [self.client.collection(collection).document(key) for key in keys if key not in found]
+        if not references:
+            return
+
+        fetched = set()
+        try:
+            with ENRICHMENT_FETCH_SECONDS.time():
+                for start in range(0, len(references), MAX_DOCUMENTS_PER_GET_ALL):
+                    for snapshot in self.client.get_all(references[start:start + MAX_DOCUMENTS_PER_GET_ALL]):
+                        # Documents that do not exist are cached as None, so they are not read again for every order
+                        collection = snapshot.reference.parent.id
+                        self.caches[collection].set(snapshot.id, snapshot.to_dict() if snapshot.exists else None)
+                        fetched.add((collection, snapshot.id))
+        except Exception as e:
+            # Enrichment is best effort, orders go on with the defaults
+            print(f"Error reading reference data: {e}")
+            for reference in references:
+                collection = reference.parent.id
+                if (collection, reference.id) not in fetched:
+                    self.caches[collection].set(reference.id, None, ttl_seconds=ENRICHMENT_FAILURE_TTL_SECONDS)
+
+    def _cached(self, collection, key):
+        # The prefetch already counted this lookup, so peek keeps the hit rate at one lookup per key
+        value = self.caches[collection].peek(key, _MISSING)
+        return None if value is _MISSING else value
+
+    def enrich(self, order, prefetched=False):
+        """
+        Add the customer tier and product categories to an order and return its (warehouse_id, transit_days).
+        Reference data the caches miss is read first, unless the caller prefetched it with the rest of its batch.
+        """
+        if self.client is not None:
+            if not prefetched:
+                self.prefetch([order])
+            customer = self._cached(ENRICHMENT_CUSTOMERS_COLLECTION, order['customer_id'])
+            order['customer_tier'] = (customer or {}).get("tier", ENRICHMENT_DEFAULT_TIER)
+            for item in order['items']:
+                product = self._cached(ENRICHMENT_PRODUCTS_COLLECTION, item['product_id'])
+                if product is not None and "category" in product:
+                    item['category'] = product["category"]
+        return self.route(order['shipping_address']['state'])
+
+    def stats(self):
+        return {collection: cache.stats() for collection, cache in self.caches.items()}
+
+
+_enricher = None
+_enricher_lock = threading.Lock()
+
+
+def get_enricher():
+    """Return the process-wide enricher, reading reference data from Firestore when ENRICHMENT is set."""
+    global _enricher
+    if _enricher is None:
+        with _enricher_lock:
+            if _enricher is None:
+                client = None
+                if ENRICHMENT:
+                    from firestore_writer import get_firestore_client
+                    client = get_firestore_client()
+                _enricher = Enricher(client)
+    return _enricher
+
+
+def seed_reference_data(client):
+    """
+    Write warehouses and products matching the mock order generator.
+    Mock customer IDs are random, so no customers are written and orders get ENRICHMENT_DEFAULT_TIER.
+    """
+    from mock_data_generator import PRODUCTS, STATES
+
+    batch = client.batch()
+    for state in STATES:
+        batch.set(client.collection(ENRICHMENT_WAREHOUSES_COLLECTION).document(f"WH-{state}"), {
+            "warehouse_id": f"WH-{state}",
+            "states": [state],
+            "transit_days": ENRICHMENT_DEFAULT_TRANSIT_DAYS,
+            "priority": 0,
+        })
+    for product in PRODUCTS:
+        batch.set(client.collection(ENRICHMENT_PRODUCTS_COLLECTION).document(product["id"]), {
+            "name": product["name"],
+            "price": product["price"],
+            "category": "audio" if product["name"] in ("Headphones", "Bluetooth Speaker", "Wireless Earbuds") else "electronics",
+        })
+    batch.commit()
+    print(f"Seeded {len(STATES)} warehouses and {len(PRODUCTS)} products")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Order enrichment reference data.")
+    parser.add_argument("--seed", action="store_true", help="write warehouses and products matching the mock data")
+    args = parser.parse_args()
+
+    from firestore_writer import get_firestore_client
+    client = get_firestore_client()
+    if args.seed:
+        seed_reference_data(client)
+    enricher = Enricher(client)
+    enricher.load_routing()
+    for state, (warehouse_id, transit_days) in sorted(enricher._routing.items()):
+        print(f"{state}: {warehouse_id} ({transit_days} days)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Multi-order envelopes for Pub/Sub messages.
+An envelope packs several encoded orders (each exactly as its single-order message would carry
+it, Avro or JSON) into one message as a stream of 4-byte big-endian length prefixed records,
+compressed as a whole with zstd or deflate. The envelope_* attributes say how to unpack it, so
+consumers tell envelopes from plain single-order messages by their attributes alone and handle
+both on the same subscription. Pub/Sub's per-message costs (request overhead, ack bookkeeping,
+the 1 KB billing minimum) are paid once per envelope, and similar orders compress well together.
+
+Pub/Sub validates every message on a schema-enabled topic as one record, so envelopes are
+published to ENVELOPE_TOPIC, a topic without a schema. Avro envelopes carry the schema revision
+attribute themselves, so consumers decode them with the revision they were written with.
+"""
+
+import os
+import zlib
+import struct
+from metrics import REGISTRY
+
+# Orders per envelope in the throughput publishers, 0 publishes one order per message
+ENVELOPE_ORDERS = int(os.getenv("ENVELOPE_ORDERS", "0"))
+# Uncompressed size at which an envelope is sent before it is full
+ENVELOPE_MAX_BYTES = int(os.getenv("ENVELOPE_MAX_BYTES", str(512 * 1024)))
+# "zstd" (default, falls back to deflate if zstandard is not installed), "deflate" or "none"
+ENVELOPE_COMPRESSION = os.getenv("ENVELOPE_COMPRESSION", "zstd")
+ENVELOPE_TOPIC = os.getenv("ENVELOPE_TOPIC", "orders-envelopes")
+# Guards consumers against envelopes that decompress to more than this
+ENVELOPE_MAX_UNPACKED_BYTES = int(os.getenv("ENVELOPE_MAX_UNPACKED_BYTES", str(64 * 1024 * 1024)))
+# With ordering keys, envelopes are packed per key and every buffer is sent once this many keys are pending
+ENVELOPE_MAX_KEYS = int(os.getenv("ENVELOPE_MAX_KEYS", "1000"))
+
+# Message attributes of an envelope
+ENVELOPE_ATTRIBUTE = "envelope"
+FORMAT_ATTRIBUTE = "envelope_format"
+COUNT_ATTRIBUTE = "envelope_count"
+COMPRESSION_ATTRIBUTE = "envelope_compression"
+ENVELOPE_VERSION = "1"
+
+FORMATS = ("avro", "json")
+FRAME = struct.Struct(">I")
+
+ENVELOPES = REGISTRY.counter("orders_envelopes_total", "Multi-order envelopes unpacked", ["format"])
+ENVELOPE_RECORDS = REGISTRY.counter("orders_envelope_records_total", "Orders unpacked from envelopes", ["format"])
+
+
+class EnvelopeError(ValueError):
+    """An envelope that cannot be unpacked: unknown version, format or compression, or corrupt framing."""
+
+
+def _load_compression(name):
+    """Return (name, compress) for the requested compression."""
+    if name == "zstd":
+        try:
+            import zstandard
+        except ImportError as e:
+            print(f"Envelope compression zstd unavailable ({e}), falling back to deflate")
+        else:
+            return "zstd", zstandard.ZstdCompressor(level=3).compress
+    elif name == "none":
+        return "none", bytes
+    elif name != "deflate":
+        raise ValueError(f"Unknown envelope compression: {name}")
+    return "deflate", lambda data: zlib.compress(data, 6)
+
+
+COMPRESSION_NAME, compress = _load_compression(ENVELOPE_COMPRESSION)
+
+
+def decompress(data, compression, limit=ENVELOPE_MAX_UNPACKED_BYTES):
+    """Decompress an envelope body, refusing bodies that would unpack to more than limit bytes."""
+    if compression == "none":
+        return bytes(data)
+    if compression == "deflate":
+        decompressor = zlib.decompressobj()
+        try:
+            body = decompressor.decompress(data, limit)
+        except zlib.error as e:
+            raise EnvelopeError(f"Corrupt deflate envelope: {e}") from None
+        if decompressor.unconsumed_tail:
+            raise EnvelopeError(f"Envelope unpacks to more than {limit} bytes")
+        return body
+    if compression == "zstd":
+        # Consumers only need zstandard for zstd envelopes; a missing module is an ImportError and is retried
+        import zstandard
+        try:
+            size = zstandard.frame_content_size(data)
+            if size > limit:
+                raise EnvelopeError(f"Envelope unpacks to more than {limit} bytes")
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=limit)
+        except zstandard.ZstdError as e:
+            raise EnvelopeError(f"Corrupt zstd envelope: {e}") from None
+    raise EnvelopeError(f"Unknown envelope compression: {compression}")
+
+
+def is_envelope(attributes):
+    return bool(attributes) and ENVELOPE_ATTRIBUTE in attributes
+
+
+def pack(payloads, fmt, compression=None, **attributes):
+    """Pack encoded orders into one envelope, returning its data and message attributes."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown envelope format: {fmt}")
+    body = b"".join(FRAME.pack(len(payload)) + payload for payload in payloads)
+    if compression is None or compression == COMPRESSION_NAME:
+        compression, data = COMPRESSION_NAME, compress(body)
+    else:
+        compression, compress_with = _load_compression(compression)
+        data = compress_with(body)
+    attributes.update({
+        ENVELOPE_ATTRIBUTE: ENVELOPE_VERSION,
+        FORMAT_ATTRIBUTE: fmt,
+        COUNT_ATTRIBUTE: str(len(payloads)),
+        COMPRESSION_ATTRIBUTE: compression,
+    })
+    return data, attributes
+
+
+def unpack(data, attributes, fmt=None):
+    """
+    Return the encoded orders of a message: every record of an envelope, or [data] for a plain message.
+    fmt, when given, is the format the consumer decodes; envelopes in another format are rejected.
+    """
+    if not is_envelope(attributes):
+        return [data]
+    version = attributes[ENVELOPE_ATTRIBUTE]
+    if version != ENVELOPE_VERSION:
+        raise EnvelopeError(f"Unsupported envelope version: {version}")
+    envelope_format = attributes.get(FORMAT_ATTRIBUTE)
+    if envelope_format not in FORMATS or (fmt is not None and envelope_format != fmt):
+        raise EnvelopeError(f"Unexpected envelope format: {envelope_format}")
+
+    body = memoryview(decompress(data, attributes.get(COMPRESSION_ATTRIBUTE, "none")))
+    records = []
+    offset = 0
+    while offset < len(body):
+        if offset + FRAME.size > len(body):
+            raise EnvelopeError("Truncated envelope record header")
+        (size,) = FRAME.unpack_from(body, offset)
+        offset += FRAME.size
+        if offset + size > len(body):
+            raise EnvelopeError("Truncated envelope record")
+        records.append(bytes(body[offset:offset + size]))
+        offset += size
+
+    # Consumers ack an envelope with its last order, so an empty one would never be settled
+    if not records:
+        raise EnvelopeError("Empty envelope")
+    count = attributes.get(COUNT_ATTRIBUTE)
+    if count is not None and count != str(len(records)):
+        raise EnvelopeError(f"Envelope holds {len(records)} records, its attributes say {count}")
+    ENVELOPES.inc(format=envelope_format)
+    ENVELOPE_RECORDS.inc(len(records), format=envelope_format)
+    return records
+
+
+class EnvelopePacker:
+    """
+    Buffers encoded orders and packs them into envelopes of up to max_orders orders or max_bytes bytes.
+    Orders are buffered per ordering key, so an envelope only holds the orders of one key and
+    publishing it under that key keeps their order.
+    """
+
+    def __init__(self, fmt, max_orders=ENVELOPE_ORDERS, max_bytes=ENVELOPE_MAX_BYTES, max_keys=ENVELOPE_MAX_KEYS,
+                 **attributes):
+        self.fmt = fmt
+        self.max_orders = max(1, max_orders)
+        self.max_bytes = max_bytes
+        self.max_keys = max_keys
+        self.attributes = attributes
+        # key -> (payloads, buffered bytes)
+        self._buffers = {}
+
+    def add(self, payload, key=""):
+        """Buffer one encoded order, returning the (key, data, attributes) envelopes that are ready."""
+        payloads, size = self._buffers.get(key) or ([], 0)
+        if payloads and size + FRAME.size + len(payload) > self.max_bytes:
+            ready = [self._pack(key, payloads)]
+            payloads, size = [], 0
+        else:
+            ready = []
+        payloads.append(payload)
+        size += FRAME.size + len(payload)
+        if len(payloads) >= self.max_orders:
+            ready.append(self._pack(key, payloads))
+            self._buffers.pop(key, None)
+        else:
+            self._buffers[key] = (payloads, size)
+            if len(self._buffers) > self.max_keys:
+                ready.extend(self.flush())
+        return ready
+
+    def flush(self):
+        """Pack every buffered order, returning the envelopes."""
+        buffers, self._buffers = self._buffers, {}
+        return [self._pack(key, payloads) for key, (payloads, _) in buffers.items()]
+
+    def _pack(self, key, payloads):
+        data, attributes = pack(payloads, self.fmt, **self.attributes)
+        return key, data, attributes
@@ -0,0 +1,259 @@
+"""
+Failure handling for the order consumers: classification, delayed retries and dead-lettering.
+A failed message is classified as permanent (it cannot be decoded or breaks the business rules,
+so redelivering it will never help) or transient (registry, Firestore or sink trouble).
+Permanent failures are routed with their error context to DEAD_LETTER_TOPIC, or to a local
+JSON lines spool under DEAD_LETTER_SPOOL_DIR, once they reach FAILURE_MAX_PERMANENT_ATTEMPTS,
+and the original is acked. Transient failures are retried after an exponential backoff with
+jitter instead of an immediate nack, and are dead-lettered too after FAILURE_MAX_ATTEMPTS.
+
+Streaming pull keeps extending the lease of a message it holds, so the subscribers delay the
+nack itself (DelayedNacker) rather than modifying the ack deadline; the held messages count
+against flow control, which slows intake while a dependency is failing. Synchronous pull has
+no lease manager and sets the ack deadline to the backoff delay instead.
+"""
+
+import os
+import json
+import time
+import heapq
+import base64
+import random
+import threading
+from datetime import datetime, timezone
+from ttl_cache import LRUTTLCache
+from metrics import REGISTRY
+
+# Where dead letters go: a Pub/Sub topic when set, the local spool otherwise
+DEAD_LETTER_TOPIC = os.getenv("DEAD_LETTER_TOPIC")
+DEAD_LETTER_SPOOL_DIR = os.getenv("DEAD_LETTER_SPOOL_DIR", "dead_letters")
+DEAD_LETTER_PUBLISH_TIMEOUT_SECONDS = float(os.getenv("DEAD_LETTER_PUBLISH_TIMEOUT_SECONDS", "30"))
+
+FAILURE_MAX_PERMANENT_ATTEMPTS = int(os.getenv("FAILURE_MAX_PERMANENT_ATTEMPTS", "1"))
+FAILURE_MAX_ATTEMPTS = int(os.getenv("FAILURE_MAX_ATTEMPTS", "10"))
+FAILURE_BACKOFF_BASE_SECONDS = float(os.getenv("FAILURE_BACKOFF_BASE_SECONDS", "1"))
+# Keep below FLOW_MAX_LEASE_SECONDS, a held message is redelivered once its lease runs out
+FAILURE_BACKOFF_MAX_SECONDS = float(os.getenv("FAILURE_BACKOFF_MAX_SECONDS", "300"))
+
+PERMANENT = "permanent"
+TRANSIENT = "transient"
+
+# Stages whose failures depend only on the payload ("parse" is a push body that is not a Pub/Sub push)
+PERMANENT_STAGES = {"parse", "decode", "validate"}
+
+# Attempts are counted locally for subscriptions without a dead-letter policy (no delivery_attempt)
+ATTEMPT_CACHE_ENTRIES = 100000
+ATTEMPT_CACHE_TTL_SECONDS = 3600
+
+DEAD_LETTERS = REGISTRY.counter("orders_dead_letters_total", "Messages routed to the dead-letter topic or spool", ["path", "failure"])
+DELAYED_RETRIES = REGISTRY.counter("orders_delayed_retries_total", "Failed messages scheduled for a delayed retry", ["path"])
+
+
+def classify(error, stage=None):
+    """Return PERMANENT for payload errors (decode, validation, corrupt envelopes), TRANSIENT for everything else."""
+    # Imported here so this module stays usable without the codec and rule modules loaded
+    from json_codec import JsonValidationError
+    from order_validation import OrderRejected
+    from envelope import EnvelopeError
+
+    if isinstance(error, (JsonValidationError, OrderRejected, EnvelopeError)) or stage in PERMANENT_STAGES:
+        return PERMANENT
+    return TRANSIENT
+
+
+def backoff_delay(attempt, base=FAILURE_BACKOFF_BASE_SECONDS, maximum=FAILURE_BACKOFF_MAX_SECONDS):
+    """Exponential backoff for the given attempt (1-based) with jitter over the upper half of the delay."""
+    delay = min(maximum, base * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class DeadLetterRouter:
+    """Publishes dead letters to DEAD_LETTER_TOPIC, or appends them to a daily spool file."""
+
+    def __init__(self, project_id=None, topic=DEAD_LETTER_TOPIC, spool_dir=DEAD_LETTER_SPOOL_DIR):
+        self.project_id = project_id
+        self.topic = topic
+        self.spool_dir = spool_dir
+        self._publisher = None
+        self._topic_path = None
+        self._lock = threading.Lock()
+
+    def route(self, data, attributes, context):
+        """Send one dead letter; returns True once it is durable, False if it could not be written."""
+        try:
+            if self.topic:
+                self._publish(data, attributes, context)
+            else:
+                self._spool(data, attributes, context)
+            return True
+        except Exception as e:
+            print(f"Error writing dead letter for message {context.get('message_id')}: {e}")
+            return False
+
+    def _publish(self, data, attributes, context):
+        if self._publisher is None:
+            with self._lock:
+                if self._publisher is None:
+                    from google.cloud import pubsub_v1
+                    self._publisher = pubsub_v1.PublisherClient()
+                    self._topic_path = self._publisher.topic_path(self.project_id, self.topic)
+        # The original payload and attributes, with the failure context as dlq_* attributes
+        dead_letter_attributes = dict(attributes or {})
+        dead_letter_attributes.update({f"dlq_{key}": str(value) for key, value in context.items()})
+        self._publisher.publish(self._topic_path, data=data, **dead_letter_attributes).result(
+            timeout=DEAD_LETTER_PUBLISH_TIMEOUT_SECONDS)
+
+    def _spool(self, data, attributes, context):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        path = os.path.join(self.spool_dir, f"dead-letters-{datetime.now(timezone.utc):%Y%m%d}.jsonl")
+        line = json.dumps({
+            **context,
+            "attributes": dict(attributes or {}),
+            "data": base64.b64encode(data).decode("ascii"),
+        }) + "\n"
+        with self._lock:
+            with open(path, "a") as spool:
+                spool.write(line)
+                spool.flush()
+                os.fsync(spool.fileno())
+
+
+class DelayedNacker:
+    """Holds failed streaming-pull messages and nacks each one once its backoff delay has passed."""
+
+    def __init__(self, name="delayed-nacks"):
+        self._heap = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def nack_later(self, message, delay):
+        with self._condition:
+            if self._closed:
+                message.nack()
+                return
+            self._sequence += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._sequence, message))
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                if self._closed:
+                    return
+                _, _, message = heapq.heappop(self._heap)
+            message.nack()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def close(self):
+        """Nack every held message now, so they are redelivered without waiting for their delay."""
+        with self._condition:
+            self._closed = True
+            held, self._heap = self._heap, []
+            self._condition.notify()
+        for _, _, message in held:
+            message.nack()
+
+
+class FailureHandler:
+    """Decides between a delayed retry and dead-lettering for the failed messages of one consumer."""
+
+    def __init__(self, path, project_id=None, router=None, max_permanent_attempts=FAILURE_MAX_PERMANENT_ATTEMPTS,
+                 max_attempts=FAILURE_MAX_ATTEMPTS):
+        self.path = path
+        self.router = router or DeadLetterRouter(project_id)
+        self.max_permanent_attempts = max_permanent_attempts
+        self.max_attempts = max_attempts
+        self._attempts = LRUTTLCache(ATTEMPT_CACHE_ENTRIES, ATTEMPT_CACHE_TTL_SECONDS)
+        self._nacker = None
+        self._nacker_lock = threading.Lock()
+
+    def attempt(self, message_id, delivery_attempt=None):
+        """Delivery attempt of a failed message: Pub/Sub's count when the subscription has one, a local count otherwise."""
+        if delivery_attempt:
+            return delivery_attempt
+        if not message_id:
+            return 1
+        attempt = self._attempts.get(message_id, 0) + 1
+        self._attempts.set(message_id, attempt)
+        return attempt
+
+    def should_dead_letter(self, failure, attempt):
+        return attempt >= (self.max_permanent_attempts if failure == PERMANENT else self.max_attempts)
+
+    def dead_letter(self, message_id, data, attributes, error, stage, failure, attempt):
+        """Route a message to the dead letters with its error context; True once it is durable."""
+        context = {
+            "message_id": message_id,
+            "path": self.path,
+            "stage": stage,
+            "failure": failure,
+            "error": str(error)[:1000],
+            "attempts": attempt,
+            "failed_at": datetime.now(timezone.utc).isoformat(),
+        }
+        if not self.router.route(data, attributes, context):
+            return False
+        DEAD_LETTERS.inc(path=self.path, failure=failure)
+        self._attempts.pop(message_id)
+        return True
+
+    def handle_failure(self, message_id, data, attributes, delivery_attempt, error, stage):
+        """
+        Dead-letter a failed message when it can never succeed or has used up its attempts.
+        Returns (dead_lettered, attempt); the caller acks a dead-lettered message and retries the others.
+        """
+        failure = classify(error, stage)
+        attempt = self.attempt(message_id, delivery_attempt)
+        if data is not None and self.should_dead_letter(failure, attempt):
+            return self.dead_letter(message_id, data, attributes, error, stage, failure, attempt), attempt
+        return False, attempt
+
+    def handle_message(self, message, error, stage, nacker=None):
+        """
+        Settle a failed streaming-pull message: dead-letter and ack it, or nack it after a backoff.
+        Retries are held by nacker when given (e.g. one per subscriber client), else by the handler's own.
+        Returns "dead_lettered" or "retry".
+        """
+        dead_lettered, attempt = self.handle_failure(
+            message.message_id, message.data, message.attributes, message.delivery_attempt, error, stage)
+        if dead_lettered:
+            message.ack()
+            return "dead_lettered"
+        DELAYED_RETRIES.inc(path=self.path)
+        (nacker if nacker is not None else self.nacker()).nack_later(message, backoff_delay(attempt))
+        return "retry"
+
+    def nacker(self):
+        if self._nacker is None:
+            with self._nacker_lock:
+                if self._nacker is None:
+                    self._nacker = DelayedNacker(name=f"{self.path}-delayed-nacks")
+        return self._nacker
+
+    def close(self):
+        """Nack the messages still waiting for a delayed retry; call before closing the subscriber client."""
+        if self._nacker is not None:
+            self._nacker.close()
+            self._nacker = None
+
+
+_handlers = {}
+_handlers_lock = threading.Lock()
+
+
+def get_failure_handler(path, project_id=None):
+    """Return the process-wide failure handler of a consumer path (push, avro, json, pull)."""
+    handler = _handlers.get(path)
+    if handler is None:
+        with _handlers_lock:
+            handler = _handlers.get(path)
+            if handler is None:
+                handler = _handlers[path] = FailureHandler(path, project_id)
+    return handler
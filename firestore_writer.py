@@ -0,0 +1,224 @@
+"""
+Pooled Firestore client and batched order persistence.
+Provides one process-wide Firestore client (one gRPC channel and auth handshake per process),
+an OrderWriter that groups single-order writes through Firestore's BulkWriter with
+flush-by-count / flush-by-time thresholds and per-document results, and grouped
+WriteBatch commits for callers that already hold a batch of orders.
+
+Set FIRESTORE_EMULATOR_HOST (e.g. localhost:8086) to run everything against the Firestore emulator.
+"""
+
+import os
+import time
+import random
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from functools import lru_cache
+from order_records import as_dict
+
+FIRESTORE_COLLECTION = os.getenv("FIRESTORE_COLLECTION", "processed_orders")
+FIRESTORE_FLUSH_COUNT = int(os.getenv("FIRESTORE_FLUSH_COUNT", "20"))
+FIRESTORE_FLUSH_INTERVAL_MS = float(os.getenv("FIRESTORE_FLUSH_INTERVAL_MS", "10"))
+FIRESTORE_MAX_ATTEMPTS = int(os.getenv("FIRESTORE_MAX_ATTEMPTS", "5"))
+FIRESTORE_WRITE_TIMEOUT_SECONDS = float(os.getenv("FIRESTORE_WRITE_TIMEOUT_SECONDS", "30"))
+
+# Firestore commits at most 500 writes per batch
+FIRESTORE_MAX_BATCH_WRITES = 500
+
+# gRPC status codes worth retrying: DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, ABORTED (contention), INTERNAL, UNAVAILABLE
+RETRYABLE_CODES = {4, 8, 10, 13, 14}
+
+
+@lru_cache(maxsize=None)
+def retryable_exceptions():
+    """The google.api_core exceptions for RETRYABLE_CODES, imported on first use."""
+    from google.api_core import exceptions as api_exceptions
+    return (
+        api_exceptions.DeadlineExceeded,
+        api_exceptions.ResourceExhausted,
+        api_exceptions.Aborted,
+        api_exceptions.InternalServerError,
+        api_exceptions.ServiceUnavailable,
+    )
+
+
+class WriteFailedError(Exception):
+    """Raised when a document write is abandoned after its final attempt."""
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_firestore_client():
+    """Return the process-wide Firestore client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # Imported here, the Firestore library is a large part of a cold start
+                from google.cloud import firestore
+                _client = firestore.Client()
+    return _client
+
+
+class OrderWriter:
+    """Groups order writes through a BulkWriter and reports a durable result per document."""
+
+    def __init__(self, client=None, collection=FIRESTORE_COLLECTION, flush_count=FIRESTORE_FLUSH_COUNT,
+                 flush_interval_ms=FIRESTORE_FLUSH_INTERVAL_MS, max_attempts=FIRESTORE_MAX_ATTEMPTS,
+                 on_result=None):
+        self.client = client or get_firestore_client()
+        self.collection = self.client.collection(collection)
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_attempts = max_attempts
+        # Optional callback(order_id, error) invoked once per document, error is None on success
+        self.on_result = on_result
+
+        self._lock = threading.Lock()
+        self._bulk_writer = self._new_bulk_writer()
+        # (document path, future) of every write queued on the current BulkWriter
+        self._generation = []
+        self._futures = defaultdict(deque)
+        self._wake = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_loop, name="firestore-flusher", daemon=True)
+        self._flusher.start()
+
+    def _new_bulk_writer(self):
+        bulk_writer = self.client.bulk_writer()
+        bulk_writer.on_write_result(self._on_write_result)
+        bulk_writer.on_write_error(self._on_write_error)
+        return bulk_writer
+
+    def _resolve(self, document_path, error=None):
+        with self._lock:
+            futures = self._futures.get(document_path)
+            future = futures.popleft() if futures else None
+            if futures is not None and not futures:
+                del self._futures[document_path]
+        if future is None:
+            return
+
+        if error is None:
+            future.set_result(document_path)
+        else:
+            future.set_exception(error)
+        if self.on_result is not None:
+            self.on_result(document_path.rsplit("/", 1)[-1], error)
+
+    def _on_write_result(self, reference, write_result, bulk_writer):
+        self._resolve(reference.path)
+
+    def _on_write_error(self, failure, bulk_writer):
+        # Retry contention and transient errors, give up on anything else
+        if failure.code in RETRYABLE_CODES and failure.attempts + 1 < self.max_attempts:
+            return True
+        self._resolve(
+            failure.operation.reference.path,
+            WriteFailedError(f"Write failed after {failure.attempts + 1} attempts: {failure.message}")
+        )
+        return False
+
+    def submit(self, order):
+        """Queue an order write and return a Future resolved once it is durable."""
+        future = Future()
+        doc_ref = self.collection.document(order['order_id'])
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("OrderWriter is closed")
+            # Registered after set(), which can raise; its callbacks wait for _lock, so they still find the future
+            self._bulk_writer.set(doc_ref, as_dict(order))
+            self._futures[doc_ref.path].append(future)
+            self._generation.append((doc_ref.path, future))
+            pending = len(self._generation)
+        if pending >= self.flush_count:
+            self._wake.set()
+        return future
+
+    def save(self, order, timeout=FIRESTORE_WRITE_TIMEOUT_SECONDS):
+        """Write an order and block until Firestore confirms it."""
+        return self.submit(order).result(timeout=timeout)
+
+    def flush(self):
+        """Send everything queued so far and wait for it to complete."""
+        with self._lock:
+            if not self._generation:
+                return
+            # Each flush generation gets its own BulkWriter, so new writes go on while this one drains
+            bulk_writer, generation = self._bulk_writer, self._generation
+            self._bulk_writer, self._generation = self._new_bulk_writer(), []
+        try:
+            bulk_writer.close()
+        except Exception as e:
+            # Writes the BulkWriter never reported on fail now instead of leaving their callers to time out
+            self._fail(generation, e)
+            raise
+
+    def _fail(self, generation, error):
+        failed = []
+        with self._lock:
+            for document_path, future in generation:
+                futures = self._futures.get(document_path)
+                if futures is not None and future in futures:
+                    futures.remove(future)
+                    if not futures:
+                        del self._futures[document_path]
+                    failed.append((document_path, future))
+        for document_path, future in failed:
+            future.set_exception(WriteFailedError(f"Flush failed: {error}"))
+            if self.on_result is not None:
+                self.on_result(document_path.rsplit("/", 1)[-1], error)
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing Firestore writes: {e}")
+
+    def close(self):
+        """Flush outstanding writes and stop the background flusher."""
+        self._closed = True
+        self._wake.set()
+        self._flusher.join(timeout=5)
+        self.flush()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_order_writer():
+    """Return the process-wide OrderWriter."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = OrderWriter()
+    return _writer
+
+
+def commit_in_batches(orders, client=None, collection=FIRESTORE_COLLECTION, max_attempts=FIRESTORE_MAX_ATTEMPTS):
+    """Write a list of orders with grouped WriteBatch commits, retrying contention with backoff."""
+    client = client or get_firestore_client()
+    collection_ref = client.collection(collection)
+    for start in range(0, len(orders), FIRESTORE_MAX_BATCH_WRITES):
+        chunk = orders[start:start + FIRESTORE_MAX_BATCH_WRITES]
+        for attempt in range(max_attempts):
+            batch = client.batch()
+            for order in chunk:
+                batch.set(collection_ref.document(order['order_id']), as_dict(order))
+            try:
+                batch.commit()
+                break
+            except retryable_exceptions() as e:
+                if attempt + 1 == max_attempts:
+                    raise
+                delay = min(0.1 * 2 ** attempt, 5) * random.uniform(0.5, 1.5)
+                print(f"Retrying Firestore batch commit in {delay:.2f}s: {e}")
+                time.sleep(delay)
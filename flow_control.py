@@ -0,0 +1,192 @@
+"""
+Flow control and adaptive callback concurrency for the streaming pull subscribers.
+get_flow_control builds the subscriber's FlowControl (outstanding messages/bytes and lease
+extension limits) from the environment, so a slow downstream causes backpressure instead of
+messages piling up past their ack deadline. AdaptiveScheduler replaces the library's fixed
+10-thread callback pool with one whose concurrency limit follows observed callback latency
+and error rate: additive increase while healthy and backlogged, multiplicative decrease on
+slow or failing callbacks (AIMD). With KEY_SHARDS set, the key-sharded scheduler
+(key_sharding.py) is used instead.
+"""
+
+import os
+import time
+import queue
+import threading
+from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.subscriber.scheduler import Scheduler
+from metrics import REGISTRY
+from key_sharding import KEY_SHARDS, KeyShardedScheduler
+
+# Outstanding (received but not yet acked/nacked) limits per subscriber client
+FLOW_MAX_MESSAGES = int(os.getenv("FLOW_MAX_MESSAGES", "500"))
+FLOW_MAX_BYTES = int(os.getenv("FLOW_MAX_BYTES", str(50 * 1024 * 1024)))
+# Leases of slow messages keep being extended up to this total, then they are redelivered
+FLOW_MAX_LEASE_SECONDS = int(os.getenv("FLOW_MAX_LEASE_SECONDS", "3600"))
+FLOW_MIN_LEASE_EXTENSION_SECONDS = int(os.getenv("FLOW_MIN_LEASE_EXTENSION_SECONDS", "60"))
+FLOW_MAX_LEASE_EXTENSION_SECONDS = int(os.getenv("FLOW_MAX_LEASE_EXTENSION_SECONDS", "600"))
+
+# Adaptive scheduler settings
+ADAPTIVE_SCHEDULER = os.getenv("ADAPTIVE_SCHEDULER", "true").lower() == "true"
+ADAPTIVE_MIN_WORKERS = int(os.getenv("ADAPTIVE_MIN_WORKERS", "2"))
+ADAPTIVE_MAX_WORKERS = int(os.getenv("ADAPTIVE_MAX_WORKERS", "64"))
+ADAPTIVE_TARGET_LATENCY_SECONDS = float(os.getenv("ADAPTIVE_TARGET_LATENCY_SECONDS", "0.5"))
+ADAPTIVE_MAX_ERROR_RATE = float(os.getenv("ADAPTIVE_MAX_ERROR_RATE", "0.05"))
+ADAPTIVE_INTERVAL_SECONDS = float(os.getenv("ADAPTIVE_INTERVAL_SECONDS", "5"))
+ADAPTIVE_DECREASE_FACTOR = 0.5
+
+CONCURRENCY_LIMIT = REGISTRY.gauge("orders_callback_concurrency_limit", "Current adaptive callback concurrency limit")
+
+
+def get_flow_control(max_messages=FLOW_MAX_MESSAGES, max_bytes=FLOW_MAX_BYTES):
+    """Return the FlowControl settings for a streaming pull subscription."""
+    return pubsub_v1.types.FlowControl(
+        max_messages=max_messages,
+        max_bytes=max_bytes,
+        max_lease_duration=FLOW_MAX_LEASE_SECONDS,
+        min_duration_per_lease_extension=FLOW_MIN_LEASE_EXTENSION_SECONDS,
+        max_duration_per_lease_extension=FLOW_MAX_LEASE_EXTENSION_SECONDS
+    )
+
+
+class AdaptiveScheduler(Scheduler):
+    """
+    Callback scheduler whose number of worker threads adapts to callback latency and errors.
+    error_count is an optional callable returning the cumulative number of failed callbacks
+    (e.g. a nack counter), since the subscriber callbacks handle their own exceptions.
+    Like the library's ThreadScheduler it must not be shared across SubscriberClients.
+    """
+
+    def __init__(self, min_workers=ADAPTIVE_MIN_WORKERS, max_workers=ADAPTIVE_MAX_WORKERS,
+                 target_latency=ADAPTIVE_TARGET_LATENCY_SECONDS, max_error_rate=ADAPTIVE_MAX_ERROR_RATE,
+                 interval=ADAPTIVE_INTERVAL_SECONDS, error_count=None, name="callbacks"):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.interval = interval
+        self.error_count = error_count
+        self.name = name
+        self.limit = min_workers
+
+        # Queue the streaming pull manager uses to talk back to its dispatcher
+        self._queue = queue.Queue()
+        self._work = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = set()
+        self._shutdown = False
+        self._completed = 0
+        self._failed = 0
+        self._latency_total = 0.0
+        self._last_errors = error_count() if error_count else 0
+        CONCURRENCY_LIMIT.set(self.limit)
+
+        self._start_workers()
+        self._controller = threading.Thread(target=self._control_loop, name=f"{name}-concurrency", daemon=True)
+        self._controller.start()
+
+    @property
+    def queue(self):
+        return self._queue
+
+    def schedule(self, callback, *args, **kwargs):
+        if self._shutdown:
+            return
+        self._work.put((callback, args, kwargs))
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._workers) < self.limit:
+                worker = threading.Thread(target=self._worker_loop, name=f"{self.name}-{len(self._workers)}", daemon=True)
+                self._workers.add(worker)
+                worker.start()
+
+    def _worker_loop(self):
+        current = threading.current_thread()
+        while not self._shutdown:
+            # Workers above the current limit exit once they are idle
+            with self._lock:
+                if len(self._workers) > self.limit:
+                    self._workers.discard(current)
+                    return
+            try:
+                callback, args, kwargs = self._work.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            started = time.perf_counter()
+            failed = False
+            try:
+                callback(*args, **kwargs)
+            except Exception as e:
+                failed = True
+                print(f"Unhandled error in subscriber callback: {e}")
+            with self._lock:
+                self._completed += 1
+                self._failed += failed
+                self._latency_total += time.perf_counter() - started
+        with self._lock:
+            self._workers.discard(current)
+
+    def _control_loop(self):
+        while not self._shutdown:
+            time.sleep(self.interval)
+            self.adjust()
+
+    def adjust(self):
+        """Apply one AIMD step from the callbacks completed since the previous step."""
+        with self._lock:
+            completed, failed, latency_total = self._completed, self._failed, self._latency_total
+            self._completed = self._failed = 0
+            self._latency_total = 0.0
+        if self.error_count is not None:
+            errors = self.error_count()
+            failed += errors - self._last_errors
+            self._last_errors = errors
+        if not completed:
+            return self.limit
+
+        mean_latency = latency_total / completed
+        error_rate = failed / completed
+        previous = self.limit
+        if error_rate > self.max_error_rate or mean_latency > self.target_latency:
+            # Downstream is slow or failing: back off quickly
+            self.limit = max(self.min_workers, int(self.limit * ADAPTIVE_DECREASE_FACTOR))
+        elif self._work.qsize() > 0:
+            # Healthy with a backlog: probe one more worker
+            self.limit = min(self.max_workers, self.limit + 1)
+
+        if self.limit != previous:
+            print(f"Callback concurrency {previous} -> {self.limit} "
+                  f"(mean latency {mean_latency * 1000:.1f}ms, error rate {error_rate:.1%}, backlog {self._work.qsize()})")
+            CONCURRENCY_LIMIT.set(self.limit)
+            self._start_workers()
+        return self.limit
+
+    def shutdown(self, await_msg_callbacks=False):
+        """Stop the workers, returning the messages whose callbacks never started."""
+        self._shutdown = True
+        dropped_messages = []
+        try:
+            while True:
+                _, args, _ = self._work.get(block=False)
+                if args:
+                    dropped_messages.append(args[0])
+        except queue.Empty:
+            pass
+        if await_msg_callbacks:
+            with self._lock:
+                workers = list(self._workers)
+            for worker in workers:
+                if worker is not threading.current_thread():
+                    worker.join()
+        return dropped_messages
+
+
+def get_scheduler(error_count=None, name="callbacks"):
+    """Return a new callback scheduler for one SubscriberClient, or None for the library default."""
+    if KEY_SHARDS > 0:
+        # In order per key across a fixed set of workers, instead of the adaptive pool
+        return KeyShardedScheduler(name=name)
+    if not ADAPTIVE_SCHEDULER:
+        return None
+    return AdaptiveScheduler(error_count=error_count, name=name)
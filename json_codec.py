@@ -0,0 +1,360 @@
+"""
+Fast JSON codec for the legacy JSON order path.
+Decodes message bytes directly (orjson when installed, the stdlib json module otherwise) and
+validates the result in the same pass against a spec derived from orders.avsc: required fields,
+field types, nested items and shipping address, with defaults filled in and integers accepted
+for double fields. The validator is generated per schema, like avro_codegen, so a valid order
+costs one call per record instead of building key lists and set differences per message.
+encode() is the publisher-side counterpart: compact UTF-8 JSON, records written as plain dicts.
+"""
+
+import os
+import re
+import copy
+import json
+import threading
+from avro_codec import schema_fingerprint
+from order_records import ORDERS_SCHEMA_STR
+
+# "orjson" (default, falls back to the stdlib if not installed) or "json"
+JSON_BACKEND = os.getenv("JSON_BACKEND", "orjson")
+
+PRIMITIVES = ("null", "boolean", "int", "long", "float", "double", "bytes", "string")
+INT_MIN, INT_MAX = -(1 << 31), (1 << 31) - 1
+
+
+class JsonValidationError(ValueError):
+    """An order that does not match the schema; path points at the offending field (e.g. items[2].quantity)."""
+
+    def __init__(self, reason, path=""):
+        super().__init__(f"{path}: {reason}" if path else reason)
+        self.reason = reason
+        self.path = path
+
+    def at(self, segment):
+        """Return the error with its path prefixed by the enclosing field or index."""
+        if not segment:
+            return self
+        if not self.path:
+            return JsonValidationError(self.reason, segment)
+        separator = "" if self.path.startswith("[") else "."
+        return JsonValidationError(self.reason, f"{segment}{separator}{self.path}")
+
+
+def _kind(value):
+    """JSON name of a decoded value's type, for error messages."""
+    if value is None:
+        return "null"
+    return {bool: "boolean", int: "integer", float: "number", str: "string", list: "array", dict: "object"}.get(type(value), type(value).__name__)
+
+
+def _error(reason, value, path):
+    return JsonValidationError(f"{reason}, got {_kind(value)}", path)
+
+
+def _to_plain(value):
+    """Fallback for encoders: slotted records (see order_records) are written as their dicts."""
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _stdlib_loads(data):
+    # json.loads detects the encoding of bytes itself, but does not take memoryviews
+    return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+
+def _stdlib_dumps(value):
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False, default=_to_plain).encode("utf-8")
+
+
+def _load_backend(name):
+    """Return (name, loads, dumps) for the requested backend."""
+    if name == "orjson":
+        try:
+            import orjson
+        except ImportError as e:
+            print(f"JSON backend orjson unavailable ({e}), falling back to json")
+        else:
+            return "orjson", orjson.loads, lambda value: orjson.dumps(value, default=_to_plain)
+    elif name != "json":
+        raise ValueError(f"Unknown JSON backend: {name}")
+    return "json", _stdlib_loads, _stdlib_dumps
+
+
+BACKEND_NAME, loads, dumps = _load_backend(JSON_BACKEND)
+
+
+class _Generator:
+    """Generates the validation functions of one schema, one per named record."""
+
+    def __init__(self, schema, records=None):
+        self.schema = schema
+        # Optional {record name: class} to build instead of returning the validated dicts
+        self.records = records
+        self.named = {}
+        self.functions = []
+        self.namespace = {
+            "JsonValidationError": JsonValidationError,
+            "_error": _error,
+            "INT_MIN": INT_MIN,
+            "INT_MAX": INT_MAX,
+        }
+        self._counter = 0
+
+    def var(self, prefix):
+        self._counter += 1
+        return f"{prefix}{self._counter}"
+
+    def full_name(self, schema, namespace):
+        name = schema["name"]
+        namespace = schema.get("namespace") or namespace
+        if "." not in name and namespace:
+            name = f"{namespace}.{name}"
+        return name, name.rsplit(".", 1)[0] if "." in name else None
+
+    def resolve(self, schema, namespace):
+        """Return (schema, namespace) with named references replaced by their definitions."""
+        if isinstance(schema, str) and schema not in PRIMITIVES:
+            key = schema if schema in self.named else f"{namespace}.{schema}"
+            return self.named[key if key in self.named else schema][0], namespace
+        if isinstance(schema, dict) and schema.get("type") in PRIMITIVES and len(schema) == 1:
+            return schema["type"], namespace
+        return schema, namespace
+
+    def emit(self, schema, value, path, indent, namespace, store):
+        """
+        Lines checking the local `value`. path is a source expression naming it in errors, and
+        store(expr) returns the lines writing a converted value back (coerced numbers, records).
+        """
+        schema, namespace = self.resolve(schema, namespace)
+        pad = " " * indent
+        kind = schema if isinstance(schema, str) else ("union" if isinstance(schema, list) else schema["type"])
+
+        if kind == "null":
+            return [f"{pad}if {value} is not None:", f"{pad}    raise _error('expected null', {value}, {path})"]
+        if kind == "boolean":
+            return [f"{pad}if type({value}) is not bool:", f"{pad}    raise _error('expected boolean', {value}, {path})"]
+        if kind in ("string", "bytes"):
+            return [f"{pad}if type({value}) is not str:", f"{pad}    raise _error('expected string', {value}, {path})"]
+        if kind in ("int", "long"):
+            lines = [f"{pad}if type({value}) is not int:", f"{pad}    raise _error('expected integer', {value}, {path})"]
+            if kind == "int":
+                lines += [f"{pad}if not INT_MIN <= {value} <= INT_MAX:", f"{pad}    raise _error('integer out of int range', {value}, {path})"]
+            return lines
+        if kind in ("float", "double"):
+            # Legacy producers write whole amounts as integers
+            return (
+                [f"{pad}if type({value}) is not float:", f"{pad}    if type({value}) is not int:",
+                 f"{pad}        raise _error('expected number', {value}, {path})", f"{pad}    {value} = float({value})"]
+                + [f"{pad}    {line}" for line in store(value)]
+            )
+        if kind == "enum":
+            ident = self.define(schema, namespace)[0]
+            return [f"{pad}if type({value}) is not str or {value} not in _symbols_{ident}:",
+                    f"{pad}    raise JsonValidationError(f'expected one of {{sorted(_symbols_{ident})}}, got {{{value}!r}}', {path})"]
+        if kind == "fixed":
+            return [f"{pad}if type({value}) is not str:", f"{pad}    raise _error('expected string', {value}, {path})"]
+        if kind == "record":
+            ident, _ = self.define(schema, namespace)
+            return [
+                f"{pad}try:",
+                f"{pad}    {value} = _check_{ident}({value})",
+                f"{pad}except JsonValidationError as e:",
+                f"{pad}    raise e.at({path}) from None",
+            ] + ([f"{pad}{line}" for line in store(value)] if self.records else [])
+        if kind == "array":
+            index, item = self.var("i"), self.var("x")
+            container = self.var("a")
+            body = self.emit(schema["items"], item, f"f'[{{{index}}}]'", indent + 4, namespace,
+                             lambda expr: [f"{container}[{index}] = {expr}"])
+            lines = [f"{pad}if type({value}) is not list:", f"{pad}    raise _error('expected array', {value}, {path})"]
+            if body:
+                lines += [
+                    f"{pad}{container} = {value}",
+                    f"{pad}try:",
+                    f"{pad}    for {index}, {item} in enumerate({container}):",
+                ] + [f"    {line}" for line in body] + [
+                    f"{pad}except JsonValidationError as e:",
+                    f"{pad}    raise e.at({path}) from None",
+                ]
+            return lines
+        if kind == "map":
+            key, item = self.var("k"), self.var("x")
+            container = self.var("m")
+            body = self.emit(schema["values"], item, f"f'[{{{key}!r}}]'", indent + 4, namespace,
+                             lambda expr: [f"{container}[{key}] = {expr}"])
+            lines = [f"{pad}if type({value}) is not dict:", f"{pad}    raise _error('expected object', {value}, {path})"]
+            if body:
+                lines += [
+                    f"{pad}{container} = {value}",
+                    f"{pad}try:",
+                    f"{pad}    for {key}, {item} in list({container}.items()):",
+                ] + [f"    {line}" for line in body] + [
+                    f"{pad}except JsonValidationError as e:",
+                    f"{pad}    raise e.at({path}) from None",
+                ]
+            return lines
+        if kind == "union":
+            branches = [self.resolve(branch, namespace)[0] for branch in schema]
+            others = [branch for branch in schema if self.resolve(branch, namespace)[0] != "null"]
+            if len(others) == 1:
+                # Nullable field: the common case gets no extra function call
+                body = self.emit(others[0], value, path, indent + 4, namespace, store)
+                if "null" not in branches:
+                    return body
+                return [f"{pad}if {value} is not None:"] + (body or [f"{pad}    pass"])
+            checks = ", ".join(self.branch_function(branch, namespace) for branch in schema)
+            name = self.var("_union")
+            self.functions.append("\n".join([
+                f"def {name}(value):",
+                f"    for check in ({checks},):",
+                "        try:",
+                "            return check(value)",
+                "        except JsonValidationError:",
+                "            pass",
+                "    raise JsonValidationError(f'{value!r} does not match any branch of the union')",
+            ]))
+            return [
+                f"{pad}try:",
+                f"{pad}    {value} = {name}({value})",
+                f"{pad}except JsonValidationError as e:",
+                f"{pad}    raise e.at({path}) from None",
+            ] + [f"{pad}{line}" for line in store(value)]
+        raise ValueError(f"Unsupported Avro type: {schema}")
+
+    def branch_function(self, schema, namespace):
+        """Name of a generated function checking and returning one value of a union branch."""
+        name = self.var("_branch")
+        body = self.emit(schema, "value", "''", 4, namespace, lambda expr: [])
+        self.functions.append("\n".join([f"def {name}(value):"] + body + ["    return value"]))
+        return name
+
+    def define(self, schema, namespace):
+        """Generate the check function (or symbol table) of a named type once, returning (identifier, namespace)."""
+        full_name, namespace = self.full_name(schema, namespace)
+        if full_name in self.named:
+            return self.named[full_name][1], namespace
+        # Registered before the fields are generated, so recursive references resolve
+        ident = re.sub(r"\W", "_", full_name)
+        self.named[full_name] = (schema, ident)
+        self.named.setdefault(full_name.rsplit(".", 1)[-1], (schema, ident))
+
+        if schema["type"] == "enum":
+            self.namespace[f"_symbols_{ident}"] = frozenset(schema["symbols"])
+            return ident, namespace
+        if schema["type"] == "fixed":
+            return ident, namespace
+
+        fields = schema["fields"]
+        record_class = self.records.get(full_name.rsplit(".", 1)[-1]) if self.records else None
+        lines = [
+            f"def _check_{ident}(d):",
+            "    if type(d) is not dict:",
+            "        raise _error('expected object', d, '')",
+        ]
+        targets = []
+        for index, field in enumerate(fields):
+            name = field["name"]
+            target = self.var("f")
+            targets.append(target)
+            if "default" in field:
+                default = field["default"]
+                self.namespace[f"_default_{ident}_{index}"] = default
+                fill = f"copy.deepcopy(_default_{ident}_{index})" if isinstance(default, (list, dict)) else f"_default_{ident}_{index}"
+                lines += [f"    {target} = d.get({name!r}, d)", f"    if {target} is d:", f"        {target} = d[{name!r}] = {fill}"]
+            else:
+                lines += [
+                    "    try:",
+                    f"        {target} = d[{name!r}]",
+                    "    except KeyError:",
+                    f"        raise JsonValidationError('missing required field', {name!r}) from None",
+                ]
+            lines += self.emit(field["type"], target, repr(name), 4, namespace,
+                               lambda expr, name=name: [] if record_class is not None else [f"d[{name!r}] = {expr}"])
+        if record_class is not None:
+            self.namespace[f"_class_{ident}"] = record_class
+            self.namespace[f"_fields_{ident}"] = frozenset(field["name"] for field in fields)
+            lines += [
+                f"    record = _class_{ident}({', '.join(targets)})",
+                f"    if len(d) > {len(fields)}:",
+                f"        record._extra = {{k: v for k, v in d.items() if k not in _fields_{ident}}} or None",
+                "    return record",
+            ]
+        else:
+            lines.append("    return d")
+        self.functions.append("\n".join(lines))
+        return ident, namespace
+
+    def generate(self):
+        """Return the module source with a top-level check(value) function."""
+        body = self.emit(self.schema, "value", "''", 4, None, lambda expr: [])
+        return "\n\n\n".join(self.functions + ["\n".join(["def check(value):"] + body + ["    return value"])]) + "\n"
+
+
+class JsonCodec:
+    """JSON decode/encode with the validator generated for one schema."""
+
+    def __init__(self, schema_str):
+        self.schema_str = schema_str
+        self.fingerprint = schema_fingerprint(schema_str)
+        self.source, self._check = self._compile(None)
+        self._check_record = None
+
+    def _compile(self, records):
+        generator = _Generator(json.loads(self.schema_str), records)
+        source = generator.generate()
+        namespace = generator.namespace
+        namespace["copy"] = copy
+        exec(compile(source, f"<json validator {self.fingerprint[:12]}>", "exec"), namespace)
+        return source, namespace["check"]
+
+    def validate(self, value):
+        """Validate an already decoded value in place, returning it; raises JsonValidationError."""
+        return self._check(value)
+
+    def decode(self, data):
+        """Decode JSON bytes (or str) and validate them, returning plain dicts."""
+        return self._check(loads(data))
+
+    def decode_record(self, data):
+        """Decode and validate JSON straight into the slotted record classes of order_records."""
+        if self._check_record is None:
+            from order_records import record_types
+            _, self._check_record = self._compile(record_types(self.schema_str))
+        return self._check_record(loads(data))
+
+    def encode(self, value):
+        """Encode a dict or record as compact UTF-8 JSON bytes."""
+        return dumps(value)
+
+
+_lock = threading.Lock()
+_codecs_by_fingerprint = {}
+_codecs_by_schema_str = {}
+
+
+def get_json_codec(schema_str=ORDERS_SCHEMA_STR):
+    """Return the JSON codec for a schema (orders.avsc by default), generated once per schema fingerprint."""
+    # Fast path: exact schema string already compiled
+    codec = _codecs_by_schema_str.get(schema_str)
+    if codec is not None:
+        return codec
+
+    fingerprint = schema_fingerprint(schema_str)
+    with _lock:
+        codec = _codecs_by_fingerprint.get(fingerprint)
+        if codec is None:
+            codec = _codecs_by_fingerprint[fingerprint] = JsonCodec(schema_str)
+        _codecs_by_schema_str[schema_str] = codec
+    return codec
+
+
+def decode_order(data):
+    """Decode and validate one JSON order message."""
+    return get_json_codec().decode(data)
+
+
+def encode_order(order):
+    """Encode one order as a JSON message payload."""
+    return dumps(order)
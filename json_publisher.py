@@ -5,11 +5,16 @@ This script simulates one or multiple publishers sending messages at regular int
 """
 
 import os
-import json
 import time
 import threading
-from google.cloud import pubsub_v1
-from mock_data_generator import generate_random_order
+from itertools import islice
+from mock_data_generator import generate_random_order, read_corpus
+from batch_publishing import (
+    create_publisher, create_batch_publisher, PublishTracker, ORDERING_KEYS, ordering_key, publish_ordered,
+    publish_envelopes
+)
+from json_codec import encode_order, decode_order
+from envelope import ENVELOPE_ORDERS, ENVELOPE_TOPIC, EnvelopePacker
 
 # Project configuration
 SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "/Users/royaldsouza/Downloads/my_gcp_project.json") # for local dev
@@ -23,15 +28,23 @@ if not PROJECT_ID:
 # Pub/Sub topic
 TOPIC_NAME = "orders-topic"
 
+# "demo" publishes one message at a time, "throughput" batches without blocking on each publish
+PUBLISH_MODE = os.getenv("PUBLISH_MODE", "demo")
+THROUGHPUT_MESSAGES = int(os.getenv("THROUGHPUT_MESSAGES", "100000"))
+# Optional pre-encoded JSON corpus (mock_data_generator.py --format json) published as-is in throughput mode
+THROUGHPUT_CORPUS = os.getenv("THROUGHPUT_CORPUS")
+
 def publish_message(publisher, topic_path, order_data):
     """Publish a message to the Pub/Sub topic."""
-    # Convert the order to JSON string
-    message_data = json.dumps(order_data).encode("utf-8")
+    # Encode the order as compact UTF-8 JSON
+    message_data = encode_order(order_data)
     
-    # Include the order_id as a message attribute
-    future = publisher.publish(
-        topic_path, 
-        data=message_data,
+    # Include the order_id as a message attribute, and the ordering key when ORDERING_KEYS is set
+    future = publish_ordered(
+        publisher,
+        topic_path,
+        message_data,
+        ordering_key(order_data),
         message_format="JSON",
         order_id=order_data["order_id"]
     )
@@ -41,9 +54,64 @@ def publish_message(publisher, topic_path, order_data):
     
     return message_id
 
+def publish_message_async(publisher, topic_path, order_data):
+    """Publish a message without waiting for it, returning the publish future."""
+    message_data = encode_order(order_data)
+    return publish_ordered(
+        publisher,
+        topic_path,
+        message_data,
+        ordering_key(order_data),
+        message_format="JSON",
+        order_id=order_data["order_id"]
+    )
+
+def throughput_publisher_process(publisher_id, num_messages, num_publishers=1):
+    """Publish messages as fast as batching and flow control allow, then print a summary.
+    With THROUGHPUT_CORPUS, publisher N of num_publishers sends every num_publishers-th payload from the N-th on."""
+    publisher = create_batch_publisher()
+    topic_path = publisher.topic_path(PROJECT_ID, TOPIC_NAME)
+    tracker = PublishTracker()
+    # With ENVELOPE_ORDERS set, orders are packed into multi-order envelopes on the envelope topic
+    packer = EnvelopePacker("json", message_format="JSON") if ENVELOPE_ORDERS else None
+    if packer is not None:
+        topic_path = publisher.topic_path(PROJECT_ID, ENVELOPE_TOPIC)
+
+    if THROUGHPUT_CORPUS:
+        # Payloads are already encoded, so the publisher spends no CPU on generating orders; each one is
+        # still decoded for the order_id attribute and ordering key that the generated path sets.
+        # The publishers split the corpus between them, so each payload is published once
+        for message_data in islice(read_corpus(THROUGHPUT_CORPUS, fmt="json"), publisher_id - 1, None, num_publishers):
+            try:
+                order = decode_order(message_data)
+                if packer is not None:
+                    publish_envelopes(tracker, publisher, topic_path, packer.add(message_data, ordering_key(order)))
+                else:
+                    tracker.track(publish_ordered, publisher, topic_path, message_data, ordering_key(order),
+                                  message_format="JSON", order_id=order["order_id"])
+            except Exception as e:
+                print(f"Publisher {publisher_id} - Error publishing message: {e}")
+    else:
+        for _ in range(num_messages):
+            try:
+                if packer is not None:
+                    order = generate_random_order()
+                    publish_envelopes(tracker, publisher, topic_path, packer.add(encode_order(order), ordering_key(order)))
+                else:
+                    tracker.track(publish_message_async, publisher, topic_path, generate_random_order())
+            except Exception as e:
+                print(f"Publisher {publisher_id} - Error publishing message: {e}")
+    if packer is not None:
+        publish_envelopes(tracker, publisher, topic_path, packer.flush())
+
+    # Wait for the outstanding batches to be sent
+    tracker.wait()
+    tracker.print_summary(f"Publisher {publisher_id}")
+    return tracker.summary()
+
 def publisher_process(publisher_id, num_messages, interval):
     """Simulate a publisher process sending messages at regular intervals."""
-    publisher = pubsub_v1.PublisherClient()
+    publisher = create_publisher()
     topic_path = publisher.topic_path(PROJECT_ID, TOPIC_NAME)
     
     for i in range(num_messages):
@@ -68,10 +136,16 @@ def main():
     # Start multiple publisher threads
     threads = []
     for i in range(num_publishers):
-        publisher_thread = threading.Thread(
-            target=publisher_process,
-            args=(i+1, messages_per_publisher, interval_seconds)
-        )
+        if PUBLISH_MODE == "throughput":
+            publisher_thread = threading.Thread(
+                target=throughput_publisher_process,
+                args=(i+1, THROUGHPUT_MESSAGES, num_publishers)
+            )
+        else:
+            publisher_thread = threading.Thread(
+                target=publisher_process,
+                args=(i+1, messages_per_publisher, interval_seconds)
+            )
         threads.append(publisher_thread)
         publisher_thread.start()
     
@@ -5,10 +5,20 @@ This script simulates one or multiple subscribers processing messages concurrent
 """
 
 import os
-import json
 import threading
 from concurrent.futures import ThreadPoolExecutor
 from google.cloud import pubsub_v1
+from metrics import MESSAGES, ERRORS, NACKS, REDELIVERIES, DECODE_SECONDS, VALIDATE_SECONDS, start_metrics_server
+from structured_logging import get_logger
+from columnar_sink import ColumnarSink
+from windowed_aggregation import WindowedAggregator
+from subscriber_pool import SUBSCRIBER_PROCESSES, run_subscriber_processes, wait_for_stop
+from flow_control import get_flow_control, get_scheduler
+from json_codec import get_json_codec
+from order_records import ORDER_RECORDS
+from order_validation import check_order
+from failure_handling import get_failure_handler, DelayedNacker
+from envelope import unpack
 
 # Project configuration
 SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "/Users/royaldsouza/Downloads/my_gcp_project.json") # for local dev
@@ -23,82 +33,167 @@ if not PROJECT_ID:
 SUBSCRIPTION_NAME = "orders-sub-json"
 SUBSCRIPTION_PATH = f"projects/{PROJECT_ID}/subscriptions/{SUBSCRIPTION_NAME}"
 
-def process_message(message):
-    """Process a received Pub/Sub message."""
+# Analytics mode: when set, orders are written as partitioned Parquet files under this directory
+SINK_DIR = os.getenv("SINK_DIR")
+# Windowed revenue/order/unit aggregates by state, product and status, emitted every AGG_EMIT_SECONDS
+AGGREGATE = os.getenv("AGGREGATE", "false").lower() == "true"
+
+logger = get_logger("json-subscriber")
+
+def ack_flushed(messages, error=None):
+    """Acknowledge messages once the sink batch holding them is on disk, or fail them when it could not be written."""
+    for message in messages:
+        if error is None:
+            message.ack()
+        elif get_failure_handler("json", PROJECT_ID).handle_message(message, error, "sink") == "retry":
+            NACKS.inc(path="json")
+
+def process_message(message, sink=None, aggregator=None, nacker=None):
+    """Process a received Pub/Sub message. Returns False when the message failed."""
+    MESSAGES.inc(path="json")
+    if (message.delivery_attempt or 1) > 1:
+        REDELIVERIES.inc(path="json")
+    stage = "decode"
     try:
-        # Extract message data
-        message_data = message.data.decode("utf-8")
-        order = json.loads(message_data)
-
-        # Validate required keys
-        required_keys = ['order_id', 'customer_id', 'status', 'total_amount', 'items', 'shipping_address']
-        if not all(key in order for key in required_keys):
-            raise KeyError(f"Missing required keys in order: {set(required_keys) - set(order.keys())}")
-        
-        # Print message details
-        print(f"\nReceived Order - ID: {order['order_id']}")
-        print(f"Customer: {order['customer_id']}")
-        print(f"Status: {order['status']}")
-        print(f"Total Amount: ${order['total_amount']}")
-        print(f"Items: {len(order['items'])}")
-        
-        # Print order items
-        for idx, item in enumerate(order['items'], start=1):
-            print(f"  Item {idx}: {item['quantity']} x {item['product_name']} @ ${item['unit_price']} each")
-        
-        # Print shipping address
-        addr = order['shipping_address']
-        print(f"Shipping to: {addr['street']}, {addr['city']}, {addr['state']} {addr['zip']}, {addr['country']}")
-        
-        # Print message attributes
-        if message.attributes:
-            print("Message attributes:")
-            for key, value in message.attributes.items():
-                print(f"  {key}: {value}")
-        
+        # Multi-order envelopes are unpacked into their encoded orders, a plain message holds one
+        stage = "unpack"
+        records = unpack(message.data, message.attributes, "json")
+
+        # Decode straight from the message bytes, validating fields and types against orders.avsc in the same pass
+        stage = "decode"
+        with DECODE_SECONDS.time():
+            codec = get_json_codec()
+            decode = codec.decode_record if ORDER_RECORDS else codec.decode
+            orders = [decode(record) for record in records]
+
+        # Check the orders against the shared business rules, an envelope is rejected as a whole
+        stage = "validate"
+        with VALIDATE_SECONDS.time():
+            for order in orders:
+                check_order(order)
+
+        # The message is settled with its last order, the sink flushes orders in sequence
+        last = len(orders) - 1
+        for index, order in enumerate(orders):
+            # Log a sample of the received orders
+            logger.info(
+                "Received order",
+                message_id=message.message_id,
+                order_id=order['order_id'],
+                customer_id=order['customer_id'],
+                status=order['status'],
+                total_amount=order['total_amount'],
+                items=len(order['items']),
+                shipping_state=order['shipping_address']['state'],
+                attributes=dict(message.attributes) if message.attributes else {}
+            )
+
+            if aggregator is not None:
+                # Counted once per delivery, so a message nacked further down may be counted again on redelivery
+                stage = "aggregate"
+                aggregator.add(order)
+
+            if sink is not None:
+                stage = "sink"
+                sink.add(order, token=message if index == last else None)
+
+        if sink is not None:
+            # Acked by ack_flushed once the micro-batch is written
+            return True
+
         # Acknowledge the message
         message.ack()
-        print(f"Message acknowledged: {message.message_id}")
+        return True
     
     except Exception as e:
-        print(f"Error processing message: {e}")
-        # Negative acknowledgement in case of error
-        message.nack()
+        ERRORS.inc(path="json", stage=stage)
+        logger.error("Error processing message", message_id=message.message_id, stage=stage, error=str(e))
+        # Payloads that can never succeed are dead-lettered, other failures are nacked after a backoff
+        if get_failure_handler("json", PROJECT_ID).handle_message(message, e, stage, nacker) == "retry":
+            NACKS.inc(path="json")
+        return False
 
-def subscriber_process(subscriber_id):
+def subscriber_process(subscriber_id, sink=None, aggregator=None, stop_flag=None, stats_queue=None):
     """Run a subscriber process to consume messages."""
     subscriber = pubsub_v1.SubscriberClient()
     subscription_path = subscriber.subscription_path(PROJECT_ID, SUBSCRIPTION_NAME)
     
     print(f"Subscriber {subscriber_id} started. Listening for messages...")
     
-    # Counter for received messages
+    # Failed messages of this subscriber wait here for their delayed retry
+    nacker = DelayedNacker(name=f"json-sub{subscriber_id}-delayed-nacks")
+
+    # Counters for received and nacked messages
     received_messages = 0
+    failed_messages = 0
     
     # Callback function to process incoming messages
     def callback(message):
-        nonlocal received_messages
-        print(f"\nSubscriber {subscriber_id} received message:")
-        process_message(message)
+        nonlocal received_messages, failed_messages
+        if not process_message(message, sink, aggregator, nacker):
+            failed_messages += 1
         received_messages += 1
     
     # Create a streaming pull subscription
     streaming_pull_future = subscriber.subscribe(
         subscription=subscription_path,
-        callback=callback
+        callback=callback,
+        # Bounded outstanding messages and a callback pool sized by latency and nack rate
+        flow_control=get_flow_control(),
+        scheduler=get_scheduler(error_count=lambda: failed_messages, name=f"json-sub{subscriber_id}"),
+        await_callbacks_on_shutdown=True
     )
     
     # Wait for the future to complete
     try:
+        if stop_flag is not None:
+            # Process mode: report stats until the supervisor stops this worker
+            wait_for_stop(streaming_pull_future, stop_flag, stats_queue, subscriber_id)
         streaming_pull_future.result()
     except Exception as e:
         print(f"Subscriber {subscriber_id} error: {e}")
     finally:
+        # Write what is buffered while the client can still send its acks
+        if sink is not None:
+            sink.flush()
+        # This subscriber's messages waiting for a delayed retry are nacked now, while its client can still
+        # send them; the other subscribers of the process keep theirs
+        nacker.close()
         subscriber.close()
         print(f"Subscriber {subscriber_id} finished. Processed {received_messages} messages.")
 
+def subscriber_worker(subscriber_id, stop_flag, stats_queue):
+    """Entry point of one subscriber process in process mode (SUBSCRIBER_PROCESSES > 0)."""
+    sink = ColumnarSink(SINK_DIR, on_flush=ack_flushed) if SINK_DIR else None
+    aggregator = WindowedAggregator().start() if AGGREGATE else None
+    try:
+        subscriber_process(subscriber_id, sink, aggregator, stop_flag, stats_queue)
+    finally:
+        if sink is not None:
+            sink.close()
+        if aggregator is not None:
+            aggregator.close()
+        # Sink failures wait in the process-wide handler, closed once its only subscriber has stopped
+        get_failure_handler("json", PROJECT_ID).close()
+
 def main():
     """Main function to demonstrate multiple subscribers."""
+    if AGGREGATE and SUBSCRIBER_PROCESSES > 1:
+        # Every process would aggregate its share of the stream and emit partial windows under the same keys
+        raise EnvironmentError("AGGREGATE needs a single subscriber process, unset SUBSCRIBER_PROCESSES or set it to 1")
+
+    # Expose /metrics when METRICS_PORT is set
+    start_metrics_server()
+
+    if SUBSCRIBER_PROCESSES > 0:
+        # One subscriber per process, so decoding is not serialized by the GIL
+        run_subscriber_processes(subscriber_worker, (), SUBSCRIBER_PROCESSES, "json")
+        return
+
+    # One columnar sink shared by all subscribers, so micro-batches fill up across them
+    sink = ColumnarSink(SINK_DIR, on_flush=ack_flushed) if SINK_DIR else None
+    aggregator = WindowedAggregator().start() if AGGREGATE else None
+
     # Define the number of parallel subscribers
     num_subscribers = 2
     
@@ -107,8 +202,17 @@ def main():
         for i in range(num_subscribers):
             executor.submit(
                 subscriber_process, 
-                i+1 # Subscriber ID
+                i+1, # Subscriber ID
+                sink,
+                aggregator
             )
 
+    if sink is not None:
+        sink.close()
+    if aggregator is not None:
+        aggregator.close()
+    # Sink failures of every subscriber wait in the process-wide handler, closed once all of them have stopped
+    get_failure_handler("json", PROJECT_ID).close()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""
+Key-sharded processing for the streaming pull subscribers.
+KeyShardedExecutor hashes each task's key (crc32) onto one of a fixed set of worker threads,
+each with its own queue, so the tasks of a key run one at a time in submission order while
+different keys run in parallel. Submitting to a full shard blocks, and keys taking more than
+HOT_KEY_SHARE of the recent tasks are reported as hot keys, since a hot key can only use one
+worker.
+
+KeyShardedScheduler plugs the executor into the subscriber client as its callback scheduler
+(KEY_SHARDS > 0). Its shard queues are unbounded, since a blocked schedule() would stall the
+client's dispatcher (and with it acks and lease renewals); the subscriber's flow control
+already bounds the messages that can be queued. Messages are keyed by their ordering key, then by the ORDERING_KEY_FIELD
+attribute, and unkeyed messages are spread by message ID. Per-key order holds from the point
+a message is received; with the ordering keys of the publishers (ORDERING_KEYS) on a
+subscription with message ordering enabled, Pub/Sub delivers each key in publish order too.
+"""
+
+import os
+import zlib
+import queue
+import threading
+from collections import Counter
+from google.cloud.pubsub_v1.subscriber.scheduler import Scheduler
+from batch_publishing import ORDERING_KEY_FIELD
+from metrics import REGISTRY
+
+# Number of shards (worker threads); 0 keeps the adaptive or default callback scheduler
+KEY_SHARDS = int(os.getenv("KEY_SHARDS", "0"))
+# Queued tasks per shard before KeyShardedExecutor.submit blocks, 0 for no bound
+KEY_SHARD_QUEUE_SIZE = int(os.getenv("KEY_SHARD_QUEUE_SIZE", "100"))
+# Hot keys are looked for over every HOT_KEY_WINDOW submitted tasks
+HOT_KEY_WINDOW = int(os.getenv("HOT_KEY_WINDOW", "10000"))
+HOT_KEY_SHARE = float(os.getenv("HOT_KEY_SHARE", "0.05"))
+
+HOT_KEYS = REGISTRY.counter("orders_hot_keys_total", "Keys found taking more than HOT_KEY_SHARE of a window")
+SHARD_BACKLOG = REGISTRY.gauge("orders_key_shard_backlog", "Deepest key shard queue at the end of the last window")
+
+_STOP = object()
+
+
+def shard_for(key, shards):
+    """Stable shard index of a key, the same in every process."""
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+
+class KeyShardedExecutor:
+    """Runs submitted tasks on fixed worker threads, in order per key and in parallel across keys."""
+
+    def __init__(self, shards=KEY_SHARDS or 8, queue_size=KEY_SHARD_QUEUE_SIZE, hot_key_window=HOT_KEY_WINDOW,
+                 hot_key_share=HOT_KEY_SHARE, name="key-shards"):
+        self.shards = shards
+        self.name = name
+        self.hot_key_window = hot_key_window
+        self.hot_key_share = hot_key_share
+        self.hot_keys = {}
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(shards)]
+        self._window = Counter()
+        self._window_size = 0
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._workers = [
+            threading.Thread(target=self._worker_loop, args=(shard_queue,), name=f"{name}-{index}", daemon=True)
+            for index, shard_queue in enumerate(self._queues)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) on the shard of key, blocking while that shard's queue is full."""
+        if self._shutdown:
+            raise RuntimeError("Cannot submit to a shut down executor")
+        self._track(key)
+        self._queues[shard_for(key, self.shards)].put((fn, args, kwargs))
+
+    def _track(self, key):
+        with self._lock:
+            self._window[key] += 1
+            self._window_size += 1
+            if self._window_size < self.hot_key_window:
+                return
+            window, self._window = self._window, Counter()
+            self._window_size = 0
+        self._check_window(window)
+
+    def _check_window(self, window):
+        threshold = self.hot_key_share * self.hot_key_window
+        backlog = max(shard_queue.qsize() for shard_queue in self._queues)
+        SHARD_BACKLOG.set(backlog)
+        hot = {key: count for key, count in window.most_common(10) if count > threshold}
+        for key, count in hot.items():
+            HOT_KEYS.inc()
+            print(f"Hot key {key!r} on {self.name} shard {shard_for(key, self.shards)}: "
+                  f"{count}/{self.hot_key_window} recent messages, deepest shard backlog {backlog}")
+        self.hot_keys = hot
+
+    def _worker_loop(self, shard_queue):
+        while True:
+            task = shard_queue.get()
+            if task is _STOP:
+                return
+            fn, args, kwargs = task
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                print(f"Unhandled error in {self.name} task: {e}")
+
+    def backlog(self):
+        """Queued tasks per shard."""
+        return [shard_queue.qsize() for shard_queue in self._queues]
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """Stop the workers once their queues are done, or drop the queued tasks and return them."""
+        self._shutdown = True
+        dropped = []
+        if cancel_pending:
+            for shard_queue in self._queues:
+                try:
+                    while True:
+                        dropped.append(shard_queue.get(block=False))
+                except queue.Empty:
+                    pass
+        for shard_queue in self._queues:
+            shard_queue.put(_STOP)
+        if wait:
+            for worker in self._workers:
+                if worker is not threading.current_thread():
+                    worker.join()
+        return dropped
+
+
+def message_key(message):
+    """Shard key of a Pub/Sub message: its ordering key, else the ORDERING_KEY_FIELD attribute, else its ID."""
+    if message.ordering_key:
+        return message.ordering_key
+    key = message.attributes.get(ORDERING_KEY_FIELD) if message.attributes else None
+    return key or message.message_id
+
+
+class KeyShardedScheduler(Scheduler):
+    """Subscriber callback scheduler running the messages of a key one at a time on the key's shard."""
+
+    def __init__(self, shards=KEY_SHARDS, name="callbacks"):
+        # Queue the streaming pull manager uses to talk back to its dispatcher
+        self._queue = queue.Queue()
+        # Unbounded shard queues: schedule() runs on the dispatcher thread and must never block
+        self.executor = KeyShardedExecutor(shards, queue_size=0, name=f"{name}-shards")
+
+    @property
+    def queue(self):
+        return self._queue
+
+    def schedule(self, callback, *args, **kwargs):
+        if self.executor._shutdown:
+            return
+        # The message is the callback's only argument
+        self.executor.submit(message_key(args[0]), callback, *args, **kwargs)
+
+    def shutdown(self, await_msg_callbacks=False):
+        """Stop the shards, returning the messages whose callbacks never started."""
+        dropped = self.executor.shutdown(wait=await_msg_callbacks, cancel_pending=True)
+        return [args[0] for _, args, _ in dropped if args]
@@ -0,0 +1,228 @@
+"""
+Low-overhead in-process metrics for the order pipeline.
+Counters and fixed-bucket histograms rendered in the Prometheus text exposition format,
+served on the /metrics route of the Cloud Run service or by a small HTTP server in the subscribers.
+"""
+
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Latency buckets in seconds, from 50us to 10s
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter, optionally split by label values."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, "") for name in self.labelnames), 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def aggregate(self, snapshots):
+        """Replace the values with the sum of snapshots taken in other processes."""
+        values = {}
+        for snapshot in snapshots:
+            for key, value in snapshot.items():
+                values[key] = values.get(key, 0) + value
+        with self._lock:
+            self._values = values
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """Value that can go up and down, e.g. a current concurrency limit."""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+    def aggregate(self, snapshots):
+        """Replace the value with the sum of snapshots taken in other processes."""
+        self._value = sum(snapshots)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {self._value}"]
+
+
+class Histogram:
+    """Fixed-bucket histogram of observed values (seconds)."""
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        """Observe the duration of the with-block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def count(self):
+        return sum(self._counts)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+    def aggregate(self, snapshots):
+        """Replace the observations with the sum of snapshots taken in other processes."""
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        for snapshot_counts, snapshot_sum in snapshots:
+            counts = [a + b for a, b in zip(counts, snapshot_counts)]
+            total += snapshot_sum
+        with self._lock:
+            self._counts = counts
+            self._sum = total
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._metrics.get(name) or self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation):
+        return self._metrics.get(name) or self.register(Gauge(name, documentation))
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self._metrics.get(name) or self.register(Histogram(name, documentation, buckets))
+
+    def snapshot(self):
+        """Picklable copy of every metric's values, e.g. to send to a supervisor process."""
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def aggregate(self, snapshots):
+        """Replace every metric's values with the sum of the given registry snapshots."""
+        snapshots = list(snapshots)
+        for name, metric in self._metrics.items():
+            metric.aggregate([snapshot[name] for snapshot in snapshots if name in snapshot])
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Pipeline metrics shared by the Cloud Run service and the subscribers
+MESSAGES = REGISTRY.counter("orders_messages_total", "Order messages received", ["path"])
+ERRORS = REGISTRY.counter("orders_errors_total", "Order messages that failed, by stage", ["path", "stage"])
+NACKS = REGISTRY.counter("orders_nacks_total", "Order messages nacked or answered with an error status", ["path"])
+REDELIVERIES = REGISTRY.counter("orders_redeliveries_total", "Order messages delivered more than once", ["path"])
+SCHEMA_LOOKUP_SECONDS = REGISTRY.histogram("orders_schema_lookup_seconds", "Time to resolve the Avro schema")
+DECODE_SECONDS = REGISTRY.histogram("orders_decode_seconds", "Time to decode a message payload")
+VALIDATE_SECONDS = REGISTRY.histogram("orders_validate_seconds", "Time to check a message's orders against the business rules")
+PROCESS_SECONDS = REGISTRY.histogram("orders_process_seconds", "Time to enrich and process a message's orders")
+FIRESTORE_WRITE_SECONDS = REGISTRY.histogram("orders_firestore_write_seconds", "Time to durably write an order")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line each
+        pass
+
+
+def start_metrics_server(port=None):
+    """Serve /metrics from a background thread when METRICS_PORT (or port) is set."""
+    port = port or int(os.getenv("METRICS_PORT", "0"))
+    if not port:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Serving metrics on :{port}/metrics")
+    return server
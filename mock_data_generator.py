@@ -1,23 +1,31 @@
 """
 This script generates random order data. Also provides a base64 enconded string of the Avro binary data. to be used in the message of JSON payload for testing purposes.
+It can also generate millions of seeded, reproducible orders with vectorized sampling and write them
+as pre-encoded Avro or JSON corpus files for load tests. Importing the module has no side effects.
 """
 
-import io
-import avro.schema
-from avro.io import DatumWriter, BinaryEncoder
+import os
+import json
+import struct
 import base64
 import random
+import argparse
 from datetime import datetime, timedelta
 import uuid
+from avro_codec import get_codec
 
-schema_str_path = "orders.avsc"
+schema_str_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "orders.avsc")
 
-# Read the Avro schema from a file
-with open(schema_str_path, "r") as schema_file:
-    schema_str = schema_file.read()
+# Corpus records are framed with a 4-byte big-endian length prefix
+CORPUS_FRAME = struct.Struct(">I")
 
-# Parse the schema
-schema = avro.schema.parse(schema_str)
+# Fixed start of the order_date range so seeded batches are reproducible
+BATCH_START_DATE = datetime(2025, 1, 1)
+
+def load_schema():
+    """Read the Avro order schema from orders.avsc."""
+    with open(schema_str_path, "r") as schema_file:
+        return schema_file.read()
 
 # Sample data for order generation (same as in json_publisher.py)
 PRODUCTS = [
@@ -38,7 +46,8 @@ ORDER_STATUSES = ["CREATED", "PROCESSED", "SHIPPED", "DELIVERED", "CANCELLED"]
 
 def generate_random_order():
     """Generate a random order for testing (same logic as in json_publisher.py)."""
-    order_id = f"ORD-{uuid.uuid4().hex[:8].upper()}"
+    # order_id is the Firestore document and dedupe key: 64 random bits, so load tests do not collide
+    order_id = f"ORD-{uuid.uuid4().hex[:16].upper()}"
     customer_id = f"CUST-{uuid.uuid4().hex[:8]}"
     order_date = datetime.now().isoformat()
     status = "CREATED"  # New orders always start with CREATED status
@@ -84,18 +93,137 @@ def generate_random_order():
     
     return order
 
-order_data = generate_random_order()
+def generate_orders_batch(count, seed=None, start_date=BATCH_START_DATE, span_seconds=86400):
+    """Generate a batch of random orders with vectorized sampling.
+
+    All random fields are drawn for the whole batch at once with NumPy, so the per-order
+    cost is only building the dicts. The same seed always produces the same orders.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    prices = np.array([product["price"] for product in PRODUCTS])
+
+    # Items: sample every line of every order in one go, then split them per order
+    num_items = rng.integers(1, 6, size=count)
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(num_items, out=offsets[1:])
+    product_idx = rng.integers(0, len(PRODUCTS), size=int(offsets[-1]))
+    quantities = rng.integers(1, 4, size=int(offsets[-1]))
+    totals = np.round(np.add.reduceat(quantities * prices[product_idx], offsets[:-1]), 2)
+
+    # Order-level fields
+    # order_id is the Firestore document and dedupe key; 32 bits collide ~100 times per million orders
+    order_ids = rng.integers(0, 2 ** 64, size=count, dtype=np.uint64)
+    customer_ids = rng.integers(0, 2 ** 32, size=count, dtype=np.uint64)
+    date_offsets = np.sort(rng.integers(0, span_seconds, size=count)).astype("timedelta64[s]")
+    order_dates = np.datetime_as_string(np.datetime64(start_date, "s") + date_offsets)
+    streets = rng.integers(100, 10000, size=count)
+    cities = rng.integers(1, 101, size=count)
+    states = rng.integers(0, len(STATES), size=count)
+    zips = rng.integers(10000, 100000, size=count)
+
+    # Pre-build the per-product item fields once, they are shared by every order
+    product_fields = [(product["id"], product["name"], product["price"]) for product in PRODUCTS]
+    product_idx = product_idx.tolist()
+    quantities = quantities.tolist()
+    offsets = offsets.tolist()
+
+    orders = []
+    for i, (order_id, customer_id, order_date, total, street, city, state, zip_code) in enumerate(zip(
+            order_ids.tolist(), customer_ids.tolist(), order_dates.tolist(), totals.tolist(),
+            streets.tolist(), cities.tolist(), states.tolist(), zips.tolist())):
+        items = []
+        for line in range(offsets[i], offsets[i + 1]):
+            product_id, product_name, unit_price = product_fields[product_idx[line]]
+            items.append({
+                "product_id": product_id,
+                "product_name": product_name,
+                "quantity": quantities[line],
+                "unit_price": unit_price
+            })
+        orders.append({
+            "order_id": f"ORD-{order_id:016X}",
+            "customer_id": f"CUST-{customer_id:08x}",
+            "order_date": order_date,
+            "status": "CREATED",
+            "total_amount": total,
+            "items": items,
+            "shipping_address": {
+                "street": f"{street} Main St",
+                "city": f"City-{city}",
+                "state": STATES[state],
+                "zip": str(zip_code),
+                "country": "USA"
+            }
+        })
+    return orders
+
+def iter_orders(count, seed=None, chunk_size=100000):
+    """Yield reproducible orders in vectorized chunks, so millions of orders never sit in memory at once."""
+    for chunk_index, start in enumerate(range(0, count, chunk_size)):
+        chunk_seed = None if seed is None else [seed, chunk_index]
+        chunk_start = BATCH_START_DATE + timedelta(days=chunk_index)
+        yield from generate_orders_batch(min(chunk_size, count - start), seed=chunk_seed, start_date=chunk_start)
+
+def write_corpus(path, count, fmt="avro", seed=None, chunk_size=100000):
+    """Write a corpus of pre-encoded messages ready to be published as-is.
+
+    "avro" writes length-prefixed Avro binary records, "json" writes one JSON order per line.
+    """
+    encode = get_codec(load_schema()).encode if fmt == "avro" else None
+    written = 0
+    with open(path, "wb") as corpus:
+        for order in iter_orders(count, seed=seed, chunk_size=chunk_size):
+            if fmt == "avro":
+                payload = encode(order)
+                corpus.write(CORPUS_FRAME.pack(len(payload)))
+                corpus.write(payload)
+            else:
+                corpus.write(json.dumps(order, separators=(",", ":")).encode("utf-8"))
+                corpus.write(b"\n")
+            written += 1
+    print(f"Wrote {written} {fmt} orders to {path}")
+    return written
+
+def read_corpus(path, fmt="avro"):
+    """Yield the encoded message payloads stored in a corpus file."""
+    with open(path, "rb") as corpus:
+        if fmt != "avro":
+            for line in corpus:
+                yield line.rstrip(b"\n")
+            return
+        while True:
+            header = corpus.read(CORPUS_FRAME.size)
+            if not header:
+                return
+            (size,) = CORPUS_FRAME.unpack(header)
+            yield corpus.read(size)
+
+def main():
+    """Print a sample order with its base64 Avro encoding, or write a corpus file."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, help="number of orders to write to a corpus file")
+    parser.add_argument("--format", choices=["avro", "json"], default="avro")
+    parser.add_argument("--output", default="orders.corpus")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.count:
+        write_corpus(args.output, args.count, fmt=args.format, seed=args.seed)
+        return
+
+    order_data = generate_random_order()
+
+    print(f"Generated Order: {order_data}")
 
-print(f"Generated Order: {order_data}")
+    # Serialize the data to Avro binary format
+    avro_binary = get_codec(load_schema()).encode(order_data)
 
-# Serialize the data to Avro binary format
-bytes_io = io.BytesIO()
-encoder = BinaryEncoder(bytes_io)
-writer = DatumWriter(schema)
-writer.write(order_data, encoder)
-avro_binary = bytes_io.getvalue()
+    # String representation of Base64 encoded Avro binary data this is to include in the message of JSON payload
+    base64_encoded_data = base64.b64encode(avro_binary).decode("utf-8")
 
-# String representation of Base64 encoded Avro binary data this is to include in the message of JSON payload
-base64_encoded_data = base64.b64encode(avro_binary).decode("utf-8")
+    print(f"Base64 Encoded Avro Data: {base64_encoded_data}")
 
-print(f"Base64 Encoded Avro Data: {base64_encoded_data}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
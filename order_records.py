@@ -0,0 +1,226 @@
+"""
+Compact, slotted record types generated from an Avro schema.
+Each Avro record (Order, OrderItem, Address in orders.avsc) becomes a class with __slots__,
+which costs a fraction of the memory of the equivalent dict when tens of thousands of orders
+are buffered. Records also behave like read/write mappings (order['status'], order.get(...)),
+so code written against the decoded dicts keeps working; keys that are not schema fields
+(e.g. the fulfillment data added by process_order) are kept in a small side dict.
+Convert back with to_dict() (or as_dict) only where Firestore or JSON needs plain dicts.
+"""
+
+import os
+import copy
+import json
+import threading
+from avro_codec import schema_fingerprint
+
+# Decode orders into slotted records instead of dicts where the pipeline buffers them
+ORDER_RECORDS = os.getenv("ORDER_RECORDS", "false").lower() == "true"
+
+class Record:
+    """
+    Base class of the generated record types.
+    Schema fields win over the mapping helpers of the same name, e.g. Order.items is the item list.
+    """
+
+    __slots__ = ("_extra",)
+    _fields = ()
+    _field_set = frozenset()
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            return getattr(self, key)
+        extra = self._extra
+        if extra is not None and key in extra:
+            return extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._field_set:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self._field_set or (self._extra is not None and key in self._extra)
+
+    def keys(self):
+        return list(self._fields) + (list(self._extra) if self._extra else [])
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._fields) + (len(self._extra) if self._extra else 0)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return isinstance(other, dict) and self.to_dict() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+def as_dict(value):
+    """Return plain dicts/lists for a record (or anything containing records), unchanged otherwise."""
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [as_dict(item) for item in value]
+    if isinstance(value, dict):
+        return {key: as_dict(item) for key, item in value.items()}
+    return value
+
+
+def _short_name(name):
+    return name.rsplit(".", 1)[-1]
+
+
+class _Generator:
+    """Builds the record classes of one schema from generated straight-line source."""
+
+    def __init__(self, module):
+        self.module = module
+        self.types = {}
+        self.namespace = {"as_dict": as_dict, "copy": copy}
+
+    def type_of(self, schema):
+        """Return the record class for a record schema, generating it (and its nested records) once."""
+        if isinstance(schema, str):
+            return self.types.get(_short_name(schema))
+        if isinstance(schema, dict) and schema.get("type") == "record":
+            return self.build(schema)
+        return None
+
+    def from_expr(self, schema, value):
+        """Source expression converting a decoded value of this schema from dicts to records."""
+        if isinstance(schema, dict) and schema.get("type") == "array":
+            item_type = self.type_of(schema["items"])
+            if item_type is not None:
+                return f"[{item_type.__name__}.from_dict(x) for x in {value}]"
+            return value
+        if isinstance(schema, dict) and schema.get("type") == "map":
+            value_type = self.type_of(schema["values"])
+            if value_type is not None:
+                return f"{{k: {value_type.__name__}.from_dict(v) for k, v in {value}.items()}}"
+            return value
+        if isinstance(schema, list):
+            # Unions: convert dicts when exactly one branch is a record
+            record_types = [self.type_of(branch) for branch in schema]
+            record_types = [record_type for record_type in record_types if record_type is not None]
+            if len(record_types) == 1:
+                name = record_types[0].__name__
+                return f"({name}.from_dict({value}) if isinstance({value}, dict) else {value})"
+            return value
+        record_type = self.type_of(schema)
+        if record_type is not None:
+            return f"{record_type.__name__}.from_dict({value})"
+        return value
+
+    def to_expr(self, schema, value):
+        """Source expression converting a record field value back to plain dicts."""
+        if isinstance(schema, (str, dict)) and self.type_of(schema) is not None:
+            return f"{value}.to_dict()"
+        if isinstance(schema, dict) and schema.get("type") == "array" and self.type_of(schema["items"]) is not None:
+            return f"[x.to_dict() for x in {value}]"
+        if isinstance(schema, list) or (isinstance(schema, dict) and schema.get("type") in ("array", "map")):
+            # Unions, maps and arrays of non-records may still hold records somewhere below
+            return f"as_dict({value})"
+        return value
+
+    def build(self, schema):
+        name = _short_name(schema["name"])
+        if name in self.types:
+            return self.types[name]
+        fields = [field["name"] for field in schema["fields"]]
+        cls = type(name, (Record,), {"__slots__": tuple(fields), "_fields": tuple(fields), "_field_set": frozenset(fields)})
+        cls.__module__ = self.module
+        self.types[name] = cls
+        self.namespace[name] = cls
+
+        args = ", ".join(fields)
+        assigns = "\n".join(f"    self.{field} = {field}" for field in fields) or "    pass"
+        from_args = []
+        for index, field in enumerate(schema["fields"]):
+            if "default" in field:
+                default = field["default"]
+                self.namespace[f"_default_{name}_{index}"] = default
+                if isinstance(default, (list, dict)):
+                    # Every record gets its own copy of a mutable default, records never share one
+                    raw = f"(d[{field['name']!r}] if {field['name']!r} in d else copy.deepcopy(_default_{name}_{index}))"
+                else:
+                    raw = f"d.get({field['name']!r}, _default_{name}_{index})"
+            else:
+                raw = f"d[{field['name']!r}]"
+            from_args.append(self.from_expr(field["type"], raw))
+        to_items = ", ".join(f"{field['name']!r}: {self.to_expr(field['type'], 'self.' + field['name'])}" for field in schema["fields"])
+
+        source = f"""
+def __init__(self, {args}):
+{assigns}
+    self._extra = None
+
+def from_dict(cls, d):
+    record = cls({", ".join(from_args)})
+    # Computed from the keys, not the length: a dict can leave out defaulted fields and still carry extras
+    if d.keys() - cls._field_set:
+        record._extra = {{k: v for k, v in d.items() if k not in cls._field_set}}
+    return record
+
+def to_dict(self):
+    d = {{{to_items}}}
+    if self._extra:
+        d.update(as_dict(self._extra))
+    return d
+"""
+        exec(compile(source, f"<record {name}>", "exec"), self.namespace)
+        cls.__init__ = self.namespace.pop("__init__")
+        cls.from_dict = classmethod(self.namespace.pop("from_dict"))
+        cls.to_dict = self.namespace.pop("to_dict")
+        return cls
+
+
+_lock = threading.Lock()
+_types_by_fingerprint = {}
+
+
+def record_types(schema_str, module=__name__):
+    """Return {record name: class} for every record in a schema, generated once per schema fingerprint."""
+    fingerprint = schema_fingerprint(schema_str)
+    types = _types_by_fingerprint.get(fingerprint)
+    if types is None:
+        with _lock:
+            types = _types_by_fingerprint.get(fingerprint)
+            if types is None:
+                generator = _Generator(module)
+                generator.build(json.loads(schema_str))
+                types = _types_by_fingerprint[fingerprint] = generator.types
+    return types
+
+
+def record_type(schema_str):
+    """Return the class of the schema's top-level record."""
+    return record_types(schema_str)[_short_name(json.loads(schema_str)["name"])]
+
+
+# Order, OrderItem and Address from orders.avsc, importable (and picklable) from this module
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "orders.avsc")) as schema_file:
+    ORDERS_SCHEMA_STR = schema_file.read()
+globals().update(record_types(ORDERS_SCHEMA_STR))
@@ -0,0 +1,285 @@
+"""
+Order validation and business rules shared by every consumer.
+ORDER_RULES declares the checks (required fields, types, finite numbers, ranges, lengths, patterns,
+the status enum and the total_amount = sum(quantity * unit_price) cross-field rule). They are compiled once,
+at import, into generated straight-line predicate code, so validating an order costs a few type
+and range checks instead of failing deep inside process_order on a missing field.
+validate_order returns structured rejections (rule, field, reason), empty for a valid order;
+validate_orders checks a whole micro-batch in one call.
+"""
+
+import os
+import re
+import math
+from collections import namedtuple
+from datetime import datetime
+from metrics import REGISTRY
+from order_records import Record
+
+# Allowed difference between total_amount and the sum of the item lines (rounding to cents)
+VALIDATION_TOTAL_TOLERANCE = float(os.getenv("VALIDATION_TOTAL_TOLERANCE", "0.01"))
+
+ORDER_STATUSES = ("CREATED", "PROCESSED", "SHIPPED", "DELIVERED", "CANCELLED")
+
+# Field rules need a type and are required unless "required" is False; "items[].quantity" applies to every item
+ORDER_RULES = [
+    {"field": "order_id", "type": "string", "min_length": 1},
+    {"field": "customer_id", "type": "string", "min_length": 1},
+    {"field": "order_date", "type": "string", "format": "datetime"},
+    {"field": "status", "type": "string", "enum": ORDER_STATUSES},
+    {"field": "total_amount", "type": "number", "min": 0},
+    {"field": "items", "type": "array", "min_length": 1},
+    {"field": "items[].product_id", "type": "string", "min_length": 1},
+    {"field": "items[].product_name", "type": "string"},
+    {"field": "items[].quantity", "type": "integer", "min": 1, "max": 10000},
+    {"field": "items[].unit_price", "type": "number", "min": 0},
+    {"field": "shipping_address", "type": "object"},
+    {"field": "shipping_address.street", "type": "string"},
+    {"field": "shipping_address.city", "type": "string"},
+    {"field": "shipping_address.state", "type": "string", "pattern": r"[A-Z]{2}"},
+    {"field": "shipping_address.zip", "type": "string"},
+    {"field": "shipping_address.country", "type": "string"},
+    {"rule": "total", "field": "total_amount", "items": "items", "quantity": "quantity", "price": "unit_price",
+     "tolerance": VALIDATION_TOTAL_TOLERANCE},
+]
+
+REJECTIONS = REGISTRY.counter("orders_rejections_total", "Order rule violations found by validation", ["rule"])
+
+Rejection = namedtuple("Rejection", ["rule", "field", "reason"])
+
+TYPE_CHECKS = {
+    "string": "type({v}) is str",
+    "integer": "type({v}) is int",
+    "number": "(type({v}) is float or type({v}) is int)",
+    "boolean": "type({v}) is bool",
+    "array": "type({v}) is list",
+    "object": "isinstance({v}, _MAPPING)",
+}
+
+
+class OrderRejected(ValueError):
+    """Raised by check_order for an order that breaks one or more rules."""
+
+    def __init__(self, rejections):
+        super().__init__("; ".join(f"{r.field}: {r.reason}" for r in rejections))
+        self.rejections = rejections
+
+
+def _is_finite(value):
+    # Integers beyond the float range overflow in the float arithmetic of the cross-field rules
+    try:
+        return math.isfinite(value)
+    except OverflowError:
+        return False
+
+
+def _is_datetime(value):
+    try:
+        datetime.fromisoformat(value)
+        return True
+    except ValueError:
+        return False
+
+
+class _Node:
+    """One field path of the rules, with the rules on it and the fields nested under it."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rule = {"type": "object"}
+        self.children = {}
+        self.items = None
+
+
+class _Compiler:
+    """Generates validate(order, rejections) and validate_batch(orders) from declarative rules."""
+
+    def __init__(self, rules):
+        self.root = _Node(None)
+        self.cross_rules = []
+        self.namespace = {
+            "Rejection": Rejection,
+            "_MAPPING": (dict, Record),
+            "_MISSING": object(),
+            "_is_datetime": _is_datetime,
+            "_is_finite": _is_finite,
+        }
+        self.reasons = {}
+        self._counter = 0
+        for rule in rules:
+            if "rule" in rule:
+                self.cross_rules.append(rule)
+            else:
+                self.add_field_rule(rule)
+
+    def var(self, prefix):
+        self._counter += 1
+        return f"{prefix}{self._counter}"
+
+    def add_field_rule(self, rule):
+        node = self.root
+        for part in rule["field"].split("."):
+            if node.rule.get("type") == "array":
+                # A field under an array applies to each of its items
+                if node.items is None:
+                    node.items = _Node("[]")
+                node = node.items
+            is_array = part.endswith("[]")
+            name = part[:-2] if is_array else part
+            if name not in node.children:
+                node.children[name] = _Node(name)
+            node = node.children[name]
+            if is_array:
+                node.rule = {**node.rule, "type": "array"}
+        node.rule = {**node.rule, **{key: value for key, value in rule.items() if key != "field"}}
+
+    def constant(self, prefix, value):
+        name = self.var(prefix)
+        self.namespace[name] = value
+        return name
+
+    def reason(self, text, value=None):
+        """Source expression of a rejection reason: text, prefixed by repr(value) when given."""
+        if text not in self.reasons:
+            self.reasons[text] = self.constant("_reason", text)
+        text = self.reasons[text]
+        return f"repr({value}) + {text}" if value else text
+
+    def reject(self, pad, rule, path, reason):
+        return [f"{pad}rejections.append(Rejection({rule!r}, f{path!r}, {reason}))"]
+
+    def emit_value(self, node, value, path, indent):
+        """Lines checking a present value against its node's rules, then its nested fields."""
+        rule = node.rule
+        pad = " " * indent
+        kind = rule["type"]
+        lines = [f"{pad}if not {TYPE_CHECKS[kind].format(v=value)}:"]
+        lines += self.reject(pad + "    ", "type", path, f"{self.reason(f'expected {kind}, got ')} + type({value}).__name__")
+        checks = []
+        if kind == "number":
+            # NaN compares False against every bound and inf passes a min, so numbers must be finite first
+            checks.append((f"not _is_finite({value})", "finite",
+                           self.reason(" is not a finite number", value)))
+        if "enum" in rule:
+            allowed = self.constant("_enum", frozenset(rule["enum"]))
+            checks.append((f"{value} not in {allowed}", "enum", self.reason(f" is not one of {sorted(rule['enum'])}", value)))
+        if "min" in rule:
+            checks.append((f"{value} < {rule['min']!r}", "range", self.reason(f" is below {rule['min']!r}", value)))
+        if "max" in rule:
+            checks.append((f"{value} > {rule['max']!r}", "range", self.reason(f" is above {rule['max']!r}", value)))
+        if "min_length" in rule:
+            checks.append((f"len({value}) < {rule['min_length']!r}", "length", self.reason(f"shorter than {rule['min_length']}")))
+        if "max_length" in rule:
+            checks.append((f"len({value}) > {rule['max_length']!r}", "length", self.reason(f"longer than {rule['max_length']}")))
+        if "pattern" in rule:
+            pattern = self.constant("_pattern", re.compile(rule["pattern"]).fullmatch)
+            checks.append((f"{pattern}({value}) is None", "pattern", self.reason(f" does not match {rule['pattern']}", value)))
+        if rule.get("format") == "datetime":
+            checks.append((f"not _is_datetime({value})", "format", self.reason(" is not an ISO 8601 datetime", value)))
+
+        nested = []
+        for child in node.children.values():
+            nested += self.emit_field(child, value, f"{path}.{child.name}" if path else child.name, indent + 4)
+        if node.items is not None:
+            index, item = self.var("i"), self.var("x")
+            body = self.emit_value(node.items, item, f"{path}[{{{index}}}]", indent + 8)
+            nested += [f"{pad}    for {index}, {item} in enumerate({value}):"] + body
+
+        if not checks and not nested:
+            return lines
+        lines.append(f"{pad}else:")
+        for condition, rule_name, reason in checks:
+            lines += [f"{pad}    if {condition}:"] + self.reject(pad + "        ", rule_name, path, reason)
+        return lines + nested
+
+    def emit_field(self, node, parent, path, indent):
+        pad = " " * indent
+        value = self.var("v")
+        lines = [f"{pad}{value} = {parent}.get({node.name!r}, _MISSING)"]
+        if node.rule.get("required", True):
+            lines += [f"{pad}if {value} is _MISSING:"] + self.reject(pad + "    ", "required", path, self.reason("missing required field"))
+            lines.append(f"{pad}else:")
+        else:
+            lines.append(f"{pad}if {value} is not _MISSING:")
+        return lines + (self.emit_value(node, value, path, indent + 4) or [f"{pad}    pass"])
+
+    def emit_cross_rules(self, indent):
+        """Cross-field rules, only evaluated once every field rule has passed."""
+        pad = " " * indent
+        lines = []
+        for rule in self.cross_rules:
+            if rule["rule"] != "total":
+                raise ValueError(f"Unknown validation rule: {rule['rule']}")
+            total = self.var("t")
+            field = f"order[{rule['field']!r}]"
+            lines += [
+                f"{pad}{total} = sum(x[{rule['quantity']!r}] * x[{rule['price']!r}] for x in order[{rule['items']!r}])",
+                f"{pad}if abs({field} - {total}) > {rule['tolerance']!r}:",
+            ] + self.reject(pad + "    ", "total", rule["field"],
+                            f"{self.reason(' does not match the item total ', field)} + format({total}, '.2f')")
+        if not lines:
+            return []
+        return [f"{' ' * (indent - 4)}if not rejections:"] + lines
+
+    def generate(self):
+        body = self.emit_value(self.root, "order", "", 4) + self.emit_cross_rules(8)
+        single = ["def validate(order):", "    rejections = []"] + body + ["    return rejections"]
+        batch = [
+            "def validate_batch(orders):",
+            "    results = {}",
+            "    for index, order in enumerate(orders):",
+            "        rejections = []",
+        ] + [f"    {line}" for line in body] + [
+            "        if rejections:",
+            "            results[index] = rejections",
+            "    return results",
+        ]
+        return "\n".join(single) + "\n\n\n" + "\n".join(batch) + "\n"
+
+
+class OrderValidator:
+    """Rules compiled once into a single-order and a batch predicate."""
+
+    def __init__(self, rules):
+        compiler = _Compiler(rules)
+        self.source = compiler.generate()
+        namespace = compiler.namespace
+        exec(compile(self.source, "<order rules>", "exec"), namespace)
+        self._validate = namespace["validate"]
+        self._validate_batch = namespace["validate_batch"]
+
+    def validate(self, order):
+        """Return the rejections of one order, an empty list when it is valid."""
+        rejections = self._validate(order)
+        for rejection in rejections:
+            REJECTIONS.inc(rule=rejection.rule)
+        return rejections
+
+    def validate_batch(self, orders):
+        """Validate a micro-batch, returning {index in orders: rejections} for the invalid ones only."""
+        results = self._validate_batch(orders)
+        for rejections in results.values():
+            for rejection in rejections:
+                REJECTIONS.inc(rule=rejection.rule)
+        return results
+
+
+ORDER_VALIDATOR = OrderValidator(ORDER_RULES)
+
+
+def validate_order(order):
+    """Return the rejections of one order against ORDER_RULES, an empty list when it is valid."""
+    return ORDER_VALIDATOR.validate(order)
+
+
+def validate_orders(orders):
+    """Validate a micro-batch of orders, returning {index: rejections} for the invalid ones."""
+    return ORDER_VALIDATOR.validate_batch(orders)
+
+
+def check_order(order):
+    """Raise OrderRejected if the order breaks any rule, otherwise return it."""
+    rejections = ORDER_VALIDATOR.validate(order)
+    if rejections:
+        raise OrderRejected(rejections)
+    return order
@@ -0,0 +1,247 @@
+"""
+Batched pull-mode worker for the order processor.
+Runs the same processing logic as the Cloud Run push service (app.py), but pulls up to
+N messages at a time with synchronous or streaming pull, decodes them as a batch,
+persists them with grouped Firestore writes and acknowledges them together.
+Failed messages are dead-lettered or retried after a backoff (failure_handling.py).
+"""
+
+import os
+import time
+import threading
+from google.cloud import pubsub_v1
+from app import PROJECT_ID, SCHEMA_NAME, FIRESTORE_COLLECTION, process_order
+from schema_registry import get_schema_cache
+from firestore_writer import get_firestore_client, commit_in_batches, retryable_exceptions
+from order_records import ORDER_RECORDS
+from order_validation import validate_orders
+from enrichment import get_enricher
+from failure_handling import get_failure_handler, backoff_delay, DELAYED_RETRIES
+from order_validation import OrderRejected
+from envelope import unpack
+
+# Pull settings
+SUBSCRIPTION_NAME = os.getenv("PULL_SUBSCRIPTION_NAME", "orders-sub-avro")
+PULL_MODE = os.getenv("PULL_MODE", "sync")  # sync | streaming
+PULL_BATCH_SIZE = int(os.getenv("PULL_BATCH_SIZE", "500"))
+PULL_MAX_WAIT_SECONDS = float(os.getenv("PULL_MAX_WAIT_SECONDS", "1.0"))
+PULL_TIMEOUT_SECONDS = float(os.getenv("PULL_TIMEOUT_SECONDS", "30"))
+
+# Longest ack deadline Pub/Sub accepts, used as the retry delay of synchronous pull
+MAX_ACK_DEADLINE_SECONDS = 600
+
+
+def decode_batch(messages):
+    """Decode a batch of (message_id, data, attributes) tuples.
+
+    The ID is the ack ID of the delivery, so redelivered copies of a message in one batch stay apart.
+    Returns the decoded orders with their IDs, every order of a multi-order envelope under the envelope's ID,
+    and the (ID, stage, error) of the messages that failed to unpack or decode.
+    """
+    schema_cache = get_schema_cache(PROJECT_ID, SCHEMA_NAME)
+    decoded = []
+    failed = []
+    for message_id, data, attributes in messages:
+        stage = "unpack"
+        try:
+            records = unpack(data, attributes, "avro")
+            stage = "decode"
+            codec = schema_cache.entry_for_attributes(attributes).codec
+            # Batches can hold many orders at once, slotted records keep them compact
+            decode = codec.decode_record if ORDER_RECORDS else codec.decode
+            orders = [decode(record) for record in records]
+        except Exception as e:
+            print(f"Error deserializing message {message_id}: {e}")
+            failed.append((message_id, stage, e))
+            continue
+        decoded.extend((message_id, order) for order in orders)
+    return decoded, failed
+
+
+def validate_batch(decoded):
+    """Check a decoded batch against the business rules in one call, splitting valid from rejected orders."""
+    rejected = validate_orders([order for _, order in decoded])
+    for index, rejections in rejected.items():
+        print(f"Rejected order in message {decoded[index][0]}: " + "; ".join(f"{r.field}: {r.reason}" for r in rejections))
+    # An envelope is rejected as a whole, with the rejections of every invalid order in it
+    rejected_by_id = {}
+    for index, rejections in rejected.items():
+        rejected_by_id.setdefault(decoded[index][0], []).extend(rejections)
+    valid = [entry for entry in decoded if entry[0] not in rejected_by_id]
+    return valid, [(message_id, "validate", OrderRejected(rejections)) for message_id, rejections in rejected_by_id.items()]
+
+
+def process_batch(decoded):
+    """Run process_order over a decoded batch, splitting successes from failures."""
+    # Reference data missing from the enrichment caches is read for the whole batch at once
+    get_enricher().prefetch([order for _, order in decoded])
+    processed = []
+    failed = []
+    for message_id, order in decoded:
+        processed_order = process_order(order, prefetched=True)
+        if processed_order is None:
+            failed.append((message_id, "process", "Failed to process order"))
+        else:
+            processed.append((message_id, processed_order))
+    return processed, failed
+
+
+def save_batch_to_firestore(firestore_client, processed):
+    """Persist processed orders with grouped Firestore batch commits."""
+    commit_in_batches([order for _, order in processed], client=firestore_client, collection=FIRESTORE_COLLECTION)
+    print(f"Stored {len(processed)} processed orders in Firestore")
+
+
+def settle_batch(processed, failures):
+    """
+    One outcome per message: the IDs to ack and the first (ID, stage, error) of each failed message.
+    A multi-order envelope is only acked once every one of its orders is stored.
+    """
+    failed = {}
+    for message_id, stage, error in failures:
+        failed.setdefault(message_id, (message_id, stage, error))
+    ack_ids = list(dict.fromkeys(message_id for message_id, _ in processed if message_id not in failed))
+    return ack_ids, list(failed.values())
+
+
+def handle_batch(firestore_client, messages):
+    """Decode, process and persist a batch. Returns the IDs to ack and the (ID, stage, error) of the failures."""
+    decoded, decode_failed = decode_batch(messages)
+    valid, rejected = validate_batch(decoded)
+    processed, process_failed = process_batch(valid)
+
+    try:
+        save_batch_to_firestore(firestore_client, processed)
+    except Exception as e:
+        print(f"Error storing batch in Firestore: {e}")
+        return settle_batch([], decode_failed + rejected + [(message_id, "persist", e) for message_id, _ in processed]
+                            + process_failed)
+
+    return settle_batch(processed, decode_failed + rejected + process_failed)
+
+
+def run_sync_pull(subscriber, subscription_path, firestore_client, batch_size=PULL_BATCH_SIZE):
+    """Pull, process and acknowledge batches with synchronous pull until interrupted."""
+    failure_handler = get_failure_handler("pull", PROJECT_ID)
+    pull_failures = 0
+    while True:
+        try:
+            response = subscriber.pull(
+                request={"subscription": subscription_path, "max_messages": batch_size},
+                timeout=PULL_TIMEOUT_SECONDS
+            )
+        except retryable_exceptions() as e:
+            # Transient API errors (unavailable, quota, timeouts) back off and pull again
+            pull_failures += 1
+            delay = backoff_delay(pull_failures)
+            print(f"Pull failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        pull_failures = 0
+        if not response.received_messages:
+            continue
+
+        received_by_ack_id = {received.ack_id: received for received in response.received_messages}
+        messages = [
+            (received.ack_id, received.message.data, dict(received.message.attributes))
+            for received in response.received_messages
+        ]
+        ack_ids, failures = handle_batch(firestore_client, messages)
+
+        # Dead letters are acked with the batch, other failures are redelivered once their backoff has passed
+        retries = {}
+        for ack_id, stage, error in failures:
+            received = received_by_ack_id[ack_id]
+            dead_lettered, attempt = failure_handler.handle_failure(
+                received.message.message_id, received.message.data, dict(received.message.attributes),
+                received.delivery_attempt, error, stage)
+            if dead_lettered:
+                ack_ids.append(ack_id)
+            else:
+                delay = min(MAX_ACK_DEADLINE_SECONDS, round(backoff_delay(attempt)))
+                retries.setdefault(delay, []).append(ack_id)
+
+        # Acknowledge the batch together, one deadline change per retry delay
+        if ack_ids:
+            subscriber.acknowledge(request={"subscription": subscription_path, "ack_ids": ack_ids})
+        for delay, retry_ids in retries.items():
+            DELAYED_RETRIES.inc(len(retry_ids), path="pull")
+            subscriber.modify_ack_deadline(
+                request={"subscription": subscription_path, "ack_ids": retry_ids, "ack_deadline_seconds": delay}
+            )
+        print(f"Pull batch done: {len(ack_ids)} acked, {sum(map(len, retries.values()))} retried")
+
+
+def run_streaming_pull(subscriber, subscription_path, firestore_client, batch_size=PULL_BATCH_SIZE,
+                       max_wait=PULL_MAX_WAIT_SECONDS):
+    """Buffer streaming-pull messages into batches flushed by size or by time."""
+    failure_handler = get_failure_handler("pull", PROJECT_ID)
+    buffer = []
+    buffer_lock = threading.Lock()
+    batch_ready = threading.Event()
+
+    def callback(message):
+        with buffer_lock:
+            buffer.append(message)
+            if len(buffer) >= batch_size:
+                batch_ready.set()
+
+    # Keep at most two batches outstanding so messages don't sit past their ack deadline
+    flow_control = pubsub_v1.types.FlowControl(max_messages=batch_size * 2)
+    streaming_pull_future = subscriber.subscribe(
+        subscription=subscription_path,
+        callback=callback,
+        flow_control=flow_control
+    )
+
+    try:
+        while not streaming_pull_future.done():
+            batch_ready.wait(max_wait)
+            with buffer_lock:
+                pending = buffer[:batch_size]
+                del buffer[:batch_size]
+                if len(buffer) < batch_size:
+                    batch_ready.clear()
+            if not pending:
+                continue
+
+            # Keyed by ack ID: a message redelivered while its first copy is still buffered is a separate delivery
+            # in the same batch, and every copy must be acked
+            by_ack_id = {message.ack_id: message for message in pending}
+            messages = [(message.ack_id, message.data, message.attributes) for message in pending]
+            ack_ids, failures = handle_batch(firestore_client, messages)
+            for ack_id in ack_ids:
+                by_ack_id[ack_id].ack()
+            # Held messages keep their leases, so retries are nacked by the handler once their backoff has passed
+            outcomes = [failure_handler.handle_message(by_ack_id[ack_id], error, stage) for ack_id, stage, error in failures]
+            print(f"Streaming batch done: {len(ack_ids)} acked, {outcomes.count('dead_lettered')} dead-lettered, "
+                  f"{outcomes.count('retry')} retried")
+    finally:
+        failure_handler.close()
+        streaming_pull_future.cancel()
+        streaming_pull_future.result()
+
+
+def main():
+    """Run the pull worker in the configured mode."""
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(PROJECT_ID, SUBSCRIPTION_NAME)
+    firestore_client = get_firestore_client()
+
+    # Warm the schema cache before the first batch arrives
+    get_schema_cache(PROJECT_ID, SCHEMA_NAME).latest()
+    print(f"Pull worker started in {PULL_MODE} mode on {subscription_path} (batch size {PULL_BATCH_SIZE})")
+
+    try:
+        if PULL_MODE == "streaming":
+            run_streaming_pull(subscriber, subscription_path, firestore_client)
+        else:
+            run_sync_pull(subscriber, subscription_path, firestore_client)
+    except KeyboardInterrupt:
+        print("Pull worker interrupted, shutting down")
+    finally:
+        subscriber.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Shared Pub/Sub schema registry cache.
+Holds Avro schemas by name and revision, refreshes the latest revision in the background
+on a TTL, and resolves the revision named by a message's `googclient_schemarevisionid`
+attribute without a network call once that revision has been seen.
+"""
+
+import os
+import time
+import threading
+from avro_codec import get_codec
+
+# Attributes Pub/Sub adds to messages published on a schema-enabled topic
+SCHEMA_NAME_ATTRIBUTE = "googclient_schemaname"
+SCHEMA_REVISION_ATTRIBUTE = "googclient_schemarevisionid"
+
+SCHEMA_CACHE_TTL_SECONDS = float(os.getenv("SCHEMA_CACHE_TTL_SECONDS", "300"))
+
+
+class SchemaEntry:
+    """A fetched schema revision and its compiled codec."""
+
+    __slots__ = ("name", "revision_id", "definition", "codec", "fetched_at")
+
+    def __init__(self, name, revision_id, definition):
+        self.name = name
+        self.revision_id = revision_id
+        self.definition = definition
+        self.codec = get_codec(definition)
+        self.fetched_at = time.monotonic()
+
+    def age(self):
+        return time.monotonic() - self.fetched_at
+
+
+class SchemaCache:
+    """Cache of Avro schemas for one registry schema, refreshed in the background."""
+
+    def __init__(self, project_id, schema_name, ttl_seconds=SCHEMA_CACHE_TTL_SECONDS, background_refresh=True):
+        self.project_id = project_id
+        self.schema_name = schema_name
+        self.ttl_seconds = ttl_seconds
+        self.background_refresh = background_refresh
+
+        self._client = None
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._latest = None
+        # Revisions are immutable, so they are cached without expiry
+        self._revisions = {}
+        self._stop = threading.Event()
+        self._refresher = None
+
+    def _schema_client(self):
+        if self._client is None:
+            # Only the schema service is needed, importing it alone keeps the Pub/Sub publisher/subscriber out of cold starts
+            from google.pubsub_v1.services.schema_service import SchemaServiceClient
+            self._client = SchemaServiceClient()
+        return self._client
+
+    def _fetch(self, revision_id=None):
+        """Fetch the latest schema (or a pinned revision) from the registry."""
+        client = self._schema_client()
+        schema_path = client.schema_path(self.project_id, self.schema_name)
+        if revision_id:
+            schema_path = f"{schema_path}@{revision_id}"
+
+        from google.pubsub_v1.types import Schema
+        schema = client.get_schema(name=schema_path)
+        # Check if the schema is of type AVRO and has a definition
+        # If not, raise an error
+        if not schema:
+            raise ValueError(f"Schema {self.schema_name} not found.")
+        if schema.type_ != Schema.Type.AVRO:
+            raise ValueError(f"Schema {self.schema_name} is not of type AVRO.")
+        if not schema.definition:
+            raise ValueError(f"Schema {self.schema_name} has no definition.")
+
+        entry = SchemaEntry(self.schema_name, schema.revision_id or revision_id, schema.definition)
+        with self._lock:
+            if entry.revision_id:
+                self._revisions.setdefault(entry.revision_id, entry)
+            if not revision_id:
+                self._latest = entry
+
+        print(f"Schema {self.schema_name}@{entry.revision_id or 'latest'} fetched from registry")
+        return entry
+
+    def latest(self):
+        """Return the latest schema entry, fetching it only when missing or expired."""
+        entry = self._latest
+        if self._needs_fetch(entry):
+            # Only one caller goes to the registry, the others wait for its result
+            with self._fetch_lock:
+                entry = self._latest
+                if self._needs_fetch(entry):
+                    entry = self._fetch()
+            self.start_refresh()
+        return entry
+
+    def _needs_fetch(self, entry):
+        # An expired entry is refreshed inline only when no background refresher keeps it warm
+        return entry is None or (entry.age() > self.ttl_seconds and not self._refreshing())
+
+    def revision(self, revision_id):
+        """Return a pinned schema revision, only calling the registry the first time it is seen."""
+        entry = self._revisions.get(revision_id)
+        if entry is None:
+            with self._fetch_lock:
+                entry = self._revisions.get(revision_id) or self._fetch(revision_id)
+        return entry
+
+    def entry_for_attributes(self, attributes=None):
+        """Resolve the schema entry for a Pub/Sub message from its attributes."""
+        if attributes:
+            revision_id = attributes.get(SCHEMA_REVISION_ATTRIBUTE)
+            schema_name = attributes.get(SCHEMA_NAME_ATTRIBUTE)
+            # Only trust the revision when it belongs to this cache's schema
+            if revision_id and (not schema_name or schema_name.rsplit("/", 1)[-1] == self.schema_name):
+                return self.revision(revision_id)
+        return self.latest()
+
+    def get_schema(self, revision_id=None):
+        """Return the schema definition for a revision, or the latest one."""
+        if revision_id:
+            return self.revision(revision_id).definition
+        return self.latest().definition
+
+    def _refreshing(self):
+        return self._refresher is not None and self._refresher.is_alive()
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.ttl_seconds):
+            try:
+                self._fetch()
+            except Exception as e:
+                # Keep serving the cached schema until the registry is reachable again
+                print(f"Error refreshing schema {self.schema_name}: {e}")
+
+    def start_refresh(self):
+        """Start the background refresh thread if enabled and not already running."""
+        if not self.background_refresh or self._refreshing():
+            return
+        with self._lock:
+            if self._refreshing():
+                return
+            self._stop.clear()
+            self._refresher = threading.Thread(
+                target=self._refresh_loop,
+                name=f"schema-refresh-{self.schema_name}",
+                daemon=True
+            )
+            self._refresher.start()
+
+    def close(self):
+        """Stop the background refresh thread."""
+        self._stop.set()
+        if self._refreshing():
+            self._refresher.join(timeout=5)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_schema_cache(project_id, schema_name):
+    """Return the process-wide schema cache for a registry schema."""
+    key = (project_id, schema_name)
+    cache = _caches.get(key)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(key)
+            if cache is None:
+                cache = SchemaCache(project_id, schema_name)
+                _caches[key] = cache
+    return cache
@@ -0,0 +1,174 @@
+"""
+Cold-start support for the Cloud Run order services.
+The services import their heavy client libraries (Flask, the Pub/Sub schema client, Firestore)
+only where they are used, and Warmup does that work in background threads right after boot:
+importing the libraries, creating the clients, fetching the schema and compiling its codec,
+and opening the gRPC channels, with independent steps running in parallel. /ready answers 503
+until the required steps are done, so with a Cloud Run HTTP startup probe on /ready no push
+reaches an instance before it is warm.
+
+Import times, warm-up step times and the latency of the first request are logged as one JSON
+line each, measured from the moment this module is imported (first thing in app.py).
+"""
+
+import os
+import sys
+import json
+import time
+import importlib
+import threading
+
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "true").lower() == "true"
+# Deadline of the RPCs made while warming up, a step that times out counts as failed
+STARTUP_RPC_TIMEOUT_SECONDS = float(os.getenv("STARTUP_RPC_TIMEOUT_SECONDS", "10"))
+
+STARTED_AT = time.perf_counter()
+
+# name -> milliseconds, for the boot phases and the imports made through import_module
+_phases = {}
+_imports = {}
+_first_request = None
+_first_request_lock = threading.Lock()
+
+
+def elapsed_ms(since=STARTED_AT):
+    return round((time.perf_counter() - since) * 1000, 1)
+
+
+def mark(phase):
+    """Record the time since boot at the end of a startup phase."""
+    _phases[phase] = elapsed_ms()
+
+
+def import_module(name):
+    """Import a module, recording how long it took when it was not loaded yet."""
+    if name in sys.modules:
+        return sys.modules[name]
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    _imports[name] = elapsed_ms(started)
+    return module
+
+
+class Warmup:
+    """Runs named warm-up steps in parallel background threads and reports readiness."""
+
+    def __init__(self, name="order-service"):
+        self.name = name
+        self._steps = []
+        self._results = {}
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._started = None
+
+    def add(self, name, fn, required=True):
+        """Add a step; the service is only ready once every required step has succeeded."""
+        self._steps.append((name, fn, required))
+        return self
+
+    def start(self):
+        """Start every step in its own thread, or mark the service ready at once when STARTUP_WARMUP is off."""
+        self._started = time.perf_counter()
+        if not STARTUP_WARMUP or not self._steps:
+            self._done.set()
+            return self
+        remaining = [len(self._steps)]
+
+        def run(name, fn, required):
+            started = time.perf_counter()
+            try:
+                fn()
+                result = {"status": "ok"}
+            except Exception as e:
+                print(f"Warm-up step {name} failed: {e}")
+                result = {"status": "failed", "error": str(e)}
+            result.update(ms=elapsed_ms(started), required=required)
+            with self._lock:
+                self._results[name] = result
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+            if finished:
+                self._done.set()
+                self.log()
+
+        for name, fn, required in self._steps:
+            threading.Thread(target=run, args=(name, fn, required), name=f"warmup-{name}", daemon=True).start()
+        return self
+
+    def done(self):
+        return self._done.is_set()
+
+    def ready(self):
+        """True once every step has finished and the required ones succeeded."""
+        if not self._done.is_set():
+            return False
+        with self._lock:
+            return all(result["status"] == "ok" for result in self._results.values() if result["required"])
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def status(self):
+        with self._lock:
+            steps = dict(self._results)
+        pending = [name for name, _, _ in self._steps if name not in steps]
+        return {"ready": self.ready(), "steps": steps, "pending": pending, "uptime_ms": elapsed_ms()}
+
+    def log(self):
+        """Print the import and warm-up breakdown."""
+        print(json.dumps({
+            "startup": self.name,
+            "phases_ms": _phases,
+            "imports_ms": _imports,
+            "warmup_ms": elapsed_ms(self._started),
+            "steps": self._results,
+            "ready": self.ready(),
+        }))
+
+
+def record_request(duration_seconds, warmup=None):
+    """Log the latency of the first request of this instance; later calls are ignored."""
+    global _first_request
+    if _first_request is not None:
+        return
+    with _first_request_lock:
+        if _first_request is not None:
+            return
+        _first_request = {
+            "first_request": True,
+            "request_ms": round(duration_seconds * 1000, 1),
+            "since_boot_ms": elapsed_ms(),
+            "warm": warmup.ready() if warmup is not None else None,
+        }
+    print(json.dumps(_first_request))
+
+
+def warm_firestore(collection):
+    """Create the pooled Firestore client and writer and open the channel with one document read."""
+    from firestore_writer import get_firestore_client, get_order_writer
+    import_module("google.cloud.firestore")
+    from google.api_core.retry import Retry
+    get_order_writer()
+    # Fetching auth tokens and the TLS handshake happen on the first RPC; a missing document costs one read.
+    # The retry deadline bounds the call, the default retry keeps trying an unreachable backend past the timeout.
+    document = get_firestore_client().collection(collection).document("_warmup")
+    document.get(retry=Retry(timeout=STARTUP_RPC_TIMEOUT_SECONDS), timeout=STARTUP_RPC_TIMEOUT_SECONDS)
+
+
+def warm_schema(project_id, schema_name):
+    """Create the schema client, fetch the latest schema and compile its codec."""
+    from schema_registry import get_schema_cache
+    import_module("google.pubsub_v1.services.schema_service")
+    get_schema_cache(project_id, schema_name).latest()
+
+
+def warm_enrichment():
+    from enrichment import get_enricher
+    enricher = get_enricher()
+    if enricher.client is not None:
+        enricher.load_routing()
+
+
+def warm_dedupe():
+    from dedupe import get_dedupe_cache
+    get_dedupe_cache()
@@ -0,0 +1,72 @@
+"""
+Leveled, sampled structured logging for the order pipeline.
+Log lines are single JSON objects with a `severity` field so Cloud Logging parses them,
+and per-message logs are sampled so they cost almost nothing under load.
+"""
+
+import os
+import sys
+import json
+import logging
+import itertools
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Fraction of per-message logs that are emitted (errors are never sampled)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "severity": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SampledLogger:
+    """Wraps a logger, emitting only every Nth call of the sampled methods."""
+
+    def __init__(self, logger, sample_rate=LOG_SAMPLE_RATE):
+        self.logger = logger
+        self._every = max(1, round(1 / sample_rate)) if sample_rate > 0 else 0
+        self._calls = itertools.count()
+
+    def _sampled(self, level):
+        if not self._every or not self.logger.isEnabledFor(level):
+            return False
+        return next(self._calls) % self._every == 0
+
+    def debug(self, message, **fields):
+        if self._sampled(logging.DEBUG):
+            self.logger.debug(message, extra={"fields": fields})
+
+    def info(self, message, **fields):
+        if self._sampled(logging.INFO):
+            self.logger.info(message, extra={"fields": fields})
+
+    def warning(self, message, **fields):
+        self.logger.warning(message, extra={"fields": fields})
+
+    def error(self, message, **fields):
+        self.logger.error(message, extra={"fields": fields})
+
+
+def get_logger(name, sample_rate=LOG_SAMPLE_RATE):
+    """Return a sampled JSON logger for the given component."""
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonFormatter())
+        logger.addHandler(handler)
+        logger.setLevel(LOG_LEVEL)
+        logger.propagate = False
+    return SampledLogger(logger, sample_rate)
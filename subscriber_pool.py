@@ -0,0 +1,162 @@
+"""
+Process-based subscriber mode.
+Runs SUBSCRIBER_PROCESSES worker processes, each with its own SubscriberClient, so Avro decoding
+and validation scale across cores instead of sharing one GIL. The supervisor restarts crashed
+workers, stops all of them in order on SIGINT/SIGTERM and aggregates the metrics each worker
+reports into its own registry (served on METRICS_PORT). Workers only ack a message after
+processing it, so messages in flight in a crashed worker are redelivered once their lease expires.
+"""
+
+import os
+import json
+import time
+import queue
+import signal
+import multiprocessing
+from metrics import REGISTRY, MESSAGES, ERRORS, NACKS, REDELIVERIES
+
+# Number of subscriber processes, 0 keeps the thread-based mode
+SUBSCRIBER_PROCESSES = int(os.getenv("SUBSCRIBER_PROCESSES", "0"))
+STATS_INTERVAL_SECONDS = float(os.getenv("STATS_INTERVAL_SECONDS", "10"))
+SHUTDOWN_TIMEOUT_SECONDS = float(os.getenv("SHUTDOWN_TIMEOUT_SECONDS", "30"))
+MAX_RESTART_DELAY_SECONDS = 30
+STOP_POLL_SECONDS = 0.5
+
+
+def report_stats(stats_queue, worker_id):
+    """Worker side: send the worker's cumulative metrics to the supervisor."""
+    stats_queue.put((worker_id, os.getpid(), REGISTRY.snapshot()))
+
+
+def wait_for_stop(streaming_pull_future, stop_flag, stats_queue, worker_id):
+    """Worker side: report metrics until the supervisor sets stop_flag, then stop pulling."""
+    next_report = time.monotonic() + STATS_INTERVAL_SECONDS
+    while not stop_flag.value:
+        time.sleep(STOP_POLL_SECONDS)
+        if streaming_pull_future.done():
+            return
+        if time.monotonic() >= next_report:
+            report_stats(stats_queue, worker_id)
+            next_report = time.monotonic() + STATS_INTERVAL_SECONDS
+    # Subscriptions are opened with await_callbacks_on_shutdown, so in-flight callbacks still ack or nack
+    streaming_pull_future.cancel()
+
+
+def _worker_entry(target, worker_id, args, stop_flag, stats_queue):
+    # Ctrl+C reaches the whole process group; workers leave shutdown to the supervisor
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        target(worker_id, *args, stop_flag, stats_queue)
+    finally:
+        report_stats(stats_queue, worker_id)
+
+
+def print_stats(label, workers, restarts):
+    print(json.dumps({
+        "subscribers": label,
+        "workers_alive": sum(1 for process in workers.values() if process.is_alive()),
+        "restarts": restarts,
+        "messages": MESSAGES.value(path=label),
+        "redeliveries": REDELIVERIES.value(path=label),
+        "errors": sum(value for (path, _), value in ERRORS.snapshot().items() if path == label),
+        "nacks": NACKS.value(path=label),
+    }))
+
+
+def run_subscriber_processes(target, args, num_processes, label):
+    """
+    Run target(worker_id, *args, stop_flag, stats_queue) in num_processes processes until SIGINT/SIGTERM.
+    target must be a module-level function so it can be started with the spawn method.
+    """
+    context = multiprocessing.get_context("spawn")
+    # A plain shared flag rather than an Event: Event.set can block forever once a waiting worker has crashed
+    stop_flag = context.RawValue("b", 0)
+    stats_queue = context.Queue()
+    workers = {}
+    started_at = {}
+    failures = {}
+    restart_at = {}
+    restarts = 0
+    # Latest cumulative snapshot per worker process; snapshots of crashed processes are kept
+    snapshots = {}
+
+    def start_worker(worker_id):
+        process = context.Process(
+            target=_worker_entry,
+            args=(target, worker_id, args, stop_flag, stats_queue),
+            name=f"{label}-subscriber-{worker_id}"
+        )
+        process.start()
+        workers[worker_id] = process
+        started_at[worker_id] = time.monotonic()
+        print(f"Started {label} subscriber process {worker_id} (pid {process.pid})")
+
+    stop_requested = []
+
+    def request_stop(signum, frame):
+        # Only record it here, the loop below does the work outside the signal handler
+        stop_requested.append(signum)
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    for worker_id in range(1, num_processes + 1):
+        start_worker(worker_id)
+
+    next_stats = time.monotonic() + STATS_INTERVAL_SECONDS
+    while True:
+        try:
+            worker_id, pid, snapshot = stats_queue.get(timeout=1.0)
+            snapshots[pid] = snapshot
+        except queue.Empty:
+            pass
+
+        if stop_requested:
+            print(f"Received signal {stop_requested[0]}, stopping {label} subscriber processes...")
+            stop_flag.value = 1
+            break
+
+        now = time.monotonic()
+        for worker_id, process in list(workers.items()):
+            if process.is_alive():
+                continue
+            if worker_id not in restart_at:
+                # Restart with an exponential delay, so a worker failing at startup does not spin
+                if now - started_at[worker_id] > MAX_RESTART_DELAY_SECONDS:
+                    failures[worker_id] = 0
+                failures[worker_id] = failures.get(worker_id, 0) + 1
+                delay = min(2 ** (failures[worker_id] - 1), MAX_RESTART_DELAY_SECONDS)
+                restart_at[worker_id] = now + delay
+                print(f"{label} subscriber process {worker_id} (pid {process.pid}) exited with code {process.exitcode}, restarting in {delay}s")
+            elif now >= restart_at[worker_id]:
+                del restart_at[worker_id]
+                restarts += 1
+                start_worker(worker_id)
+
+        if now >= next_stats:
+            REGISTRY.aggregate(snapshots.values())
+            print_stats(label, workers, restarts)
+            next_stats = now + STATS_INTERVAL_SECONDS
+
+    # Orderly shutdown: workers finish their in-flight callbacks and report final stats.
+    # The queue keeps being drained meanwhile, a worker cannot exit while its last report is unread.
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT_SECONDS
+    while any(process.is_alive() for process in workers.values()) and time.monotonic() < deadline:
+        try:
+            worker_id, pid, snapshot = stats_queue.get(timeout=0.5)
+            snapshots[pid] = snapshot
+        except queue.Empty:
+            pass
+    for worker_id, process in workers.items():
+        if process.is_alive():
+            print(f"{label} subscriber process {worker_id} did not stop in time, terminating")
+            process.terminate()
+        process.join()
+    while True:
+        try:
+            worker_id, pid, snapshot = stats_queue.get(timeout=0.5)
+            snapshots[pid] = snapshot
+        except queue.Empty:
+            break
+    REGISTRY.aggregate(snapshots.values())
+    print_stats(label, workers, restarts)
@@ -0,0 +1,252 @@
+"""
+Incremental windowed aggregation of the order stream.
+Keeps revenue, order count and units per state, product_id and status over tumbling and
+sliding event-time windows (order_date). Each dimension value is interned to an integer
+index and every window pane holds flat arrays indexed by it, so an order updates its pane
+in O(1) without nested dicts. Windows close once the watermark (latest event time minus
+the allowed lateness) passes their end; later events for them are counted and dropped.
+Closed windows are emitted periodically. An aggregator only sees the orders of its own process,
+so the subscribers refuse AGGREGATE with more than one subscriber process.
+"""
+
+import os
+import json
+import time
+import threading
+from array import array
+from datetime import datetime, timezone
+from metrics import REGISTRY
+
+AGG_TUMBLING_SECONDS = int(os.getenv("AGG_TUMBLING_SECONDS", "60"))
+AGG_SLIDING_SECONDS = int(os.getenv("AGG_SLIDING_SECONDS", "300"))
+AGG_SLIDE_SECONDS = int(os.getenv("AGG_SLIDE_SECONDS", "60"))
+AGG_ALLOWED_LATENESS_SECONDS = int(os.getenv("AGG_ALLOWED_LATENESS_SECONDS", "30"))
+AGG_EMIT_SECONDS = float(os.getenv("AGG_EMIT_SECONDS", "10"))
+
+DIMENSIONS = ("state", "product_id", "status")
+
+LATE_EVENTS = REGISTRY.counter("orders_aggregation_late_events_total", "Orders dropped for arriving after their window closed", ["window"])
+WINDOWS_EMITTED = REGISTRY.counter("orders_aggregation_windows_emitted_total", "Closed aggregation windows emitted", ["window"])
+
+
+def event_time(order):
+    """Event time of an order in epoch seconds; naive order_date values are taken as UTC."""
+    timestamp = datetime.fromisoformat(order['order_date'])
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+class KeyIndex:
+    """Interns dimension values to dense integer indexes shared by all panes."""
+
+    def __init__(self):
+        self.indexes = {}
+        self.keys = []
+
+    def index(self, key):
+        idx = self.indexes.get(key)
+        if idx is None:
+            idx = self.indexes[key] = len(self.keys)
+            self.keys.append(key)
+        return idx
+
+
+class Counters:
+    """Revenue, order and unit totals of one dimension, one array slot per interned key."""
+
+    __slots__ = ("revenue", "orders", "units")
+
+    def __init__(self):
+        self.revenue = array("d")
+        self.orders = array("q")
+        self.units = array("q")
+
+    def add(self, idx, revenue, orders, units):
+        if idx >= len(self.orders):
+            grow = idx + 1 - len(self.orders)
+            self.revenue.extend(array("d", bytes(8 * grow)))
+            self.orders.extend(array("q", bytes(8 * grow)))
+            self.units.extend(array("q", bytes(8 * grow)))
+        self.revenue[idx] += revenue
+        self.orders[idx] += orders
+        self.units[idx] += units
+
+    def merge(self, other):
+        """Add another pane's totals into these counters."""
+        for idx in range(len(other.orders)):
+            if other.orders[idx]:
+                self.add(idx, other.revenue[idx], other.orders[idx], other.units[idx])
+
+
+class Pane:
+    """Totals of the orders whose event time falls in [start, start + pane size)."""
+
+    __slots__ = ("start", "counters")
+
+    def __init__(self, start):
+        self.start = start
+        self.counters = {dimension: Counters() for dimension in DIMENSIONS}
+
+
+class PaneStore:
+    """Event-time panes of one window kind; a window is the sum of window_seconds / pane_seconds panes."""
+
+    def __init__(self, name, window_seconds, pane_seconds):
+        if window_seconds % pane_seconds:
+            raise ValueError(f"{name} window ({window_seconds}s) must be a multiple of its slide ({pane_seconds}s)")
+        self.name = name
+        self.window_seconds = window_seconds
+        self.pane_seconds = pane_seconds
+        self.panes = {}
+        # End of the last emitted window; panes ending at or before it are closed
+        self.emitted_until = None
+
+    def pane_for(self, timestamp):
+        """Return the open pane for an event time, or None if its window has already been emitted."""
+        start = int(timestamp // self.pane_seconds) * self.pane_seconds
+        if self.emitted_until is not None and start + self.pane_seconds <= self.emitted_until:
+            LATE_EVENTS.inc(window=self.name)
+            return None
+        pane = self.panes.get(start)
+        if pane is None:
+            pane = self.panes[start] = Pane(start)
+        return pane
+
+    def close(self, watermark):
+        """Yield (start, end, counters by dimension) for every window ending at or before the watermark."""
+        while self.panes:
+            # The next window ends one slide after the last emitted one, skipping event-time gaps without data
+            end = min(self.panes) + self.pane_seconds
+            if self.emitted_until is not None:
+                end = max(end, self.emitted_until + self.pane_seconds)
+            if end > watermark:
+                return
+            start = end - self.window_seconds
+            totals = {dimension: Counters() for dimension in DIMENSIONS}
+            for pane_start, pane in self.panes.items():
+                if start <= pane_start < end:
+                    for dimension in DIMENSIONS:
+                        totals[dimension].merge(pane.counters[dimension])
+            self.emitted_until = end
+            # The next window starts one slide later, so the oldest pane of this one is no longer needed
+            for pane_start in [pane_start for pane_start in self.panes if pane_start <= start]:
+                del self.panes[pane_start]
+            yield start, end, totals
+
+
+class WindowedAggregator:
+    """Aggregates orders into tumbling and sliding event-time windows and emits closed windows."""
+
+    def __init__(self, tumbling_seconds=AGG_TUMBLING_SECONDS, sliding_seconds=AGG_SLIDING_SECONDS,
+                 slide_seconds=AGG_SLIDE_SECONDS, allowed_lateness_seconds=AGG_ALLOWED_LATENESS_SECONDS,
+                 emit_seconds=AGG_EMIT_SECONDS, on_emit=None):
+        self.stores = [PaneStore("tumbling", tumbling_seconds, tumbling_seconds)]
+        if sliding_seconds:
+            self.stores.append(PaneStore("sliding", sliding_seconds, slide_seconds))
+        self.allowed_lateness_seconds = allowed_lateness_seconds
+        self.emit_seconds = emit_seconds
+        self.on_emit = on_emit or print_results
+        self.keys = {dimension: KeyIndex() for dimension in DIMENSIONS}
+        self.max_event_time = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self._emitter = None
+
+    def start(self):
+        """Start emitting closed windows every emit_seconds from a background thread."""
+        self._emitter = threading.Thread(target=self._emit_loop, name="aggregation-emitter", daemon=True)
+        self._emitter.start()
+        return self
+
+    def add(self, order):
+        """Add one order to the pane it falls in, in every window kind."""
+        timestamp = event_time(order)
+        total_amount = order['total_amount']
+        keys = self.keys
+
+        with self._lock:
+            state_idx = keys["state"].index(order['shipping_address']['state'])
+            status_idx = keys["status"].index(order['status'])
+            items = [
+                (keys["product_id"].index(item['product_id']), item['quantity'] * item['unit_price'], item['quantity'])
+                for item in order['items']
+            ]
+            units = sum(quantity for _, _, quantity in items)
+            if self.max_event_time is None or timestamp > self.max_event_time:
+                self.max_event_time = timestamp
+            for store in self.stores:
+                pane = store.pane_for(timestamp)
+                if pane is None:
+                    continue
+                counters = pane.counters
+                counters["state"].add(state_idx, total_amount, 1, units)
+                counters["status"].add(status_idx, total_amount, 1, units)
+                product_counters = counters["product_id"]
+                for product_idx, line_amount, quantity in items:
+                    product_counters.add(product_idx, line_amount, 1, quantity)
+
+    def watermark(self):
+        if self.max_event_time is None:
+            return None
+        return self.max_event_time - self.allowed_lateness_seconds
+
+    def emit(self, watermark=None):
+        """Close and emit every window that ended before the watermark; returns the emitted results."""
+        with self._lock:
+            watermark = self.watermark() if watermark is None else watermark
+            if watermark is None:
+                return []
+            results = []
+            for store in self.stores:
+                for start, end, totals in store.close(watermark):
+                    results.append(self._window_result(store.name, start, end, totals))
+                    WINDOWS_EMITTED.inc(window=store.name)
+        if results:
+            self.on_emit(results)
+        return results
+
+    def _window_result(self, name, start, end, totals):
+        result = {
+            "window": name,
+            "start": datetime.fromtimestamp(start, timezone.utc).isoformat(),
+            "end": datetime.fromtimestamp(end, timezone.utc).isoformat(),
+        }
+        for dimension in DIMENSIONS:
+            keys = self.keys[dimension].keys
+            counters = totals[dimension]
+            result[dimension] = {
+                keys[idx]: {"orders": counters.orders[idx], "units": counters.units[idx], "revenue": round(counters.revenue[idx], 2)}
+                for idx in range(len(counters.orders)) if counters.orders[idx]
+            }
+        return result
+
+    def _emit_loop(self):
+        while not self._closed:
+            time.sleep(self.emit_seconds)
+            try:
+                self.emit()
+            except Exception as e:
+                print(f"Error emitting aggregation windows: {e}")
+
+    def close(self):
+        """Stop the emitter and emit every remaining window, open or not."""
+        self._closed = True
+        if self.max_event_time is not None:
+            largest_window = max(store.window_seconds for store in self.stores)
+            self.emit(watermark=self.max_event_time + largest_window)
+
+
+def print_results(results):
+    """Default emit target: one JSON line per closed window with its totals by state."""
+    for result in results:
+        states = result["state"]
+        print(json.dumps({
+            "window": result["window"],
+            "start": result["start"],
+            "end": result["end"],
+            "orders": sum(totals["orders"] for totals in states.values()),
+            "units": sum(totals["units"] for totals in states.values()),
+            "revenue": round(sum(totals["revenue"] for totals in states.values()), 2),
+            "by_state": states,
+        }))